@@ -0,0 +1,473 @@
+#!/usr/bin/env python2
+"""Hermetic benchmark of rbackup's orchestration overhead.
+
+Runs the wrapper against stand-in lvm, mount, ssh and duplicity executables
+with configurable latency and output, and against synthetic /proc/mounts
+and /proc/<pid>/cmdline trees. Needs neither root, LVM nor a backup server.
+
+  $ python2 bench/rbackup_bench.py --mountpoints 50 --processes 5000
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+
+from rbackup.filesystems    import Filesystems
+from rbackup.history        import History
+from rbackup.lvm            import LVM
+from rbackup.metrics        import NullSpan
+from rbackup.networking     import Networking
+from rbackup.pkgmgr         import PackageManager
+from rbackup.scheduler      import Scheduler
+from rbackup.ssh            import SSH
+
+__description__ = 'Benchmark rbackup orchestration overhead'
+
+_d_mountpoints = 20
+_d_processes = 2000
+_d_snapshots = 10
+_d_networks = 100
+_d_stat_lines = 10000
+_d_latency = 0.0
+_d_repeat = 5
+_d_destinations = 1
+
+_fake_commands = ['vgs', 'lvs', 'lvdisplay', 'lvcreate', 'lvremove',
+        'lvchange', 'mount', 'umount', 'ssh', 'duplicity']
+
+# one script serves all fake commands, it logs the call, sleeps for the
+# configured latency and prints the configured output
+_fake_script = """#!/bin/sh
+name=$(basename "$0")
+echo "$name $*" >> "$FAKE_ROOT/calls.log"
+if [ -f "$FAKE_ROOT/latency/$name" ]; then
+    sleep $(cat "$FAKE_ROOT/latency/$name")
+fi
+for arg; do
+    case $arg in --log-fd=*) fd=${arg#--log-fd=};; esac
+done
+if [ -n "$fd" ] && [ -f "$FAKE_ROOT/output/$name.log" ]; then
+    # sh only redirects single digit descriptors
+    cat "$FAKE_ROOT/output/$name.log" > /dev/fd/$fd
+fi
+if [ -f "$FAKE_ROOT/output/$name" ]; then
+    cat "$FAKE_ROOT/output/$name"
+fi
+
+# snapshots and mounts show up in the lvs report and in /proc/mounts until
+# they are removed again
+for last; do :; done
+lvs="$FAKE_ROOT/output/lvs"
+mounts="$FAKE_ROOT/proc/mounts"
+case $name in
+lvcreate)
+    while [ $# -gt 0 ]; do
+        [ "$1" = "-n" ] && lv=$2
+        shift
+    done
+    origin=${last#/dev/}
+    vg=${origin%%/*}
+    echo "  $vg|$lv|/dev/$vg/$lv|1024.00|${origin#*/}|0.00|swi-a-s---||" \
+        >> "$lvs"
+    ;;
+lvremove)
+    grep -v "|$last|" "$lvs" > "$lvs.tmp"
+    mv "$lvs.tmp" "$lvs"
+    ;;
+mount)
+    for arg; do
+        case $arg in /*) [ -z "$src" ] && src=$arg;; esac
+    done
+    device=$src
+    case $src in
+    /dev/*) ;;
+    *) device=$(awk -v m="$src" '$2 == m { d = $1 } END { print d }' \
+        "$mounts");;
+    esac
+    echo "$device $last ext4 ro 0 0" >> "$mounts"
+    ;;
+umount)
+    awk -v m="${last%/}" '{ p = $2; sub("/$", "", p) } p != m' \
+        "$mounts" > "$mounts.tmp"
+    mv "$mounts.tmp" "$mounts"
+    ;;
+esac
+exit 0
+"""
+
+class NullOutput:
+    """Output which discards everything, so only rbackup itself is timed"""
+    def info(self, msg):
+        pass
+
+    def debug(self, msg):
+        pass
+
+    def warning(self, msg):
+        pass
+
+    def error(self, msg):
+        raise RuntimeError(msg)
+
+    def progress(self, title, msg=''):
+        pass
+
+    def low(self, title, msg=''):
+        pass
+
+    def normal(self, title, msg=''):
+        pass
+
+    def critical(self, title, msg=''):
+        raise RuntimeError('{0}: {1}'.format(title, msg))
+
+    def span(self, name, kind='phase'):
+        return NullSpan()
+
+class BenchConfig(dict):
+    def get(self, cfgitem, default=None):
+        return dict.get(self, cfgitem, default)
+
+class Fixture:
+    def __init__(self, args):
+        self.args = args
+        self.root = tempfile.mkdtemp(prefix='rbackup-bench-')
+        self.bin_dir = os.path.join(self.root, 'bin')
+        self.proc_root = os.path.join(self.root, 'proc')
+        self.mnt_dir = os.path.join(self.root, 'mnt')
+        self.snap_dir = os.path.join(self.root, 'snapshot')
+        self.state_dir = os.path.join(self.root, 'state')
+        self.src_dir = os.path.join(self.root, 'src')
+        self.calls_log = os.path.join(self.root, 'calls.log')
+
+    def write(self, path, content):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').write(content)
+
+    def setup(self):
+        for name in _fake_commands:
+            fname = os.path.join(self.bin_dir, name)
+            self.write(fname, _fake_script)
+            os.chmod(fname, 0755)
+            self.write(os.path.join(self.root, 'latency', name),
+                    str(self.args.latency))
+
+        os.environ['FAKE_ROOT'] = self.root
+        os.environ['PATH'] = self.bin_dir + ':' + os.environ['PATH']
+
+        self.setup_mounts()
+        self.setup_processes()
+        self.setup_lvm()
+        self.setup_remote()
+        self.setup_duplicity()
+        os.makedirs(self.src_dir)
+
+    def setup_mounts(self):
+        lines = ['/dev/mapper/vg0-root / ext4 rw 0 0']
+        for i in range(self.args.mountpoints):
+            mountpoint = os.path.join(self.mnt_dir, 'lv{0}'.format(i))
+            os.makedirs(mountpoint)
+            lines.append('/dev/mapper/vg0-lv{0} {1} ext4 rw 0 0'.format(i,
+                mountpoint))
+        lines.append('proc /proc proc rw 0 0')
+        self.write(os.path.join(self.proc_root, 'mounts'),
+                '\n'.join(lines) + '\n')
+
+    def setup_processes(self):
+        for pid in range(1, self.args.processes + 1):
+            cmdline = '/usr/bin/worker\0--id\0{0}\0--rpm-like-arg\0'.format(
+                    pid)
+            self.write(os.path.join(self.proc_root, str(pid), 'cmdline'),
+                    cmdline)
+
+        # package managers run by their interpreter, which has to be found
+        pid = self.args.processes + 1
+        self.write(os.path.join(self.proc_root, str(pid), 'cmdline'),
+                '/usr/bin/python\0/usr/bin/yum\0install\0rpm\0')
+
+    def setup_lvm(self):
+        self.write(os.path.join(self.root, 'output', 'vgs'),
+                '  vg0|1024000.00|512000.00|4.00|256000|128000\n')
+
+        lines = ['  vg0|root|/dev/vg0/root|20480.00|||-wi-ao----||']
+        for i in range(self.args.mountpoints):
+            lines.append('  vg0|lv{0}|/dev/vg0/lv{0}|10240.00|||-wi-ao----||'
+                    .format(i))
+            for j in range(self.args.snapshots):
+                lines.append('  vg0|lv{0}_{1}|/dev/vg0/lv{0}_{1}|1024.00|' \
+                    'lv{0}|1.50|swi-a-s---||'.format(i, 1500000000 + j))
+        self.write(os.path.join(self.root, 'output', 'lvs'),
+                '\n'.join(lines) + '\n')
+
+    def setup_remote(self):
+        lines = ['backup_dir=1']
+        files = ['duplicity-full.20200101T000000Z.manifest',
+                 'duplicity-full.20200101T000000Z.vol1.difftar.gz',
+                 'duplicity-full-signatures.20200101T000000Z.sigtar.gz']
+        for day in range(2, 8):
+            name = 'duplicity-inc.202001{0:02d}T000000Z.to.202001{1:02d}' \
+                    'T000000Z'.format(day - 1, day)
+            files.extend([name + '.manifest', name + '.vol1.difftar.gz'])
+        for name in files:
+            lines.append('file -rw-r--r-- 1 1000 1000 1048576 Jan 1 00:00' \
+                    ' {0}'.format(name))
+        self.write(os.path.join(self.root, 'output', 'ssh'),
+                '\n'.join(lines) + '\n')
+
+    def setup_duplicity(self):
+        stats = [
+            'StartTime 1500000000.00 (Fri Jul 14 02:40:00 2017)',
+            'EndTime 1500000100.00 (Fri Jul 14 02:41:40 2017)',
+            'ElapsedTime 100.00 (1 minute 40.00 seconds)',
+            'SourceFiles 100000',
+            'SourceFileSize 1073741824 (1.00 GB)',
+            'NewFiles 10',
+            'NewFileSize 10240 (10.0 KB)',
+            'DeletedFiles 1',
+            'ChangedFiles 100',
+            'ChangedFileSize 1048576 (1.00 MB)',
+            'ChangedDeltaSize 0 (0 bytes)',
+            'DeltaEntries 111',
+            'RawDeltaSize 524288 (512 KB)',
+            'TotalDestinationSizeChange 262144 (256 KB)',
+            'Errors 0',
+        ]
+        log = []
+        for i in range(self.args.stat_lines):
+            log.append('INFO 5 M path/to/file{0}'.format(i))
+            log.append('. M path/to/file{0}'.format(i))
+            log.append('')
+            if i % 100 == 0:
+                log.append('NOTICE 16 {0} {1} {2:.1f} 10.5 1048576.0 ' \
+                    'False'.format(i * 1024, i / 100,
+                    i * 100.0 / self.args.stat_lines))
+                log.append('')
+        self.write(os.path.join(self.root, 'output', 'duplicity'),
+                '\n'.join(stats) + '\n')
+        self.write(os.path.join(self.root, 'output', 'duplicity.log'),
+                '\n'.join(log) + '\n')
+
+    def count_calls(self):
+        if not os.path.exists(self.calls_log):
+            return 0
+        return len(open(self.calls_log, 'r').readlines())
+
+    def reset_calls(self):
+        if os.path.exists(self.calls_log):
+            os.unlink(self.calls_log)
+
+    def cleanup(self):
+        shutil.rmtree(self.root, True)
+
+class Benchmark:
+    def __init__(self, args, fixture):
+        self.args = args
+        self.fixture = fixture
+        self.output = NullOutput()
+        self.config = BenchConfig({
+            'remote_host': 'backup.example.net',
+            'remote_path': '/backups/bench',
+            'ssh_config': os.path.join(fixture.root, 'ssh_config'),
+            'state_dir': fixture.state_dir,
+            'max_incrementals': 0,
+            'excluded': ['/proc', '/sys', '/home/*/.cache', 'CACHEDIR.TAG'],
+            'runon_networks': ['10.{0}.0.0/16'.format(i)
+                for i in range(self.args.networks)],
+        })
+        self.results = []
+
+    def measure(self, name, func, setup=None):
+        timings = []
+        calls = 0
+        for i in range(self.args.repeat):
+            state = None
+            if setup:
+                state = setup()
+            self.fixture.reset_calls()
+            t_start = time.time()
+            func(state)
+            timings.append(time.time() - t_start)
+            calls = max(calls, self.fixture.count_calls())
+
+        result = {
+            'name': name,
+            'mean': sum(timings) / len(timings),
+            'min': min(timings),
+            'max': max(timings),
+            'forks': calls,
+        }
+        self.results.append(result)
+        print('{0:<24} {1:>10.2f} {2:>10.2f} {3:>10.2f} {4:>6}'.format(name,
+            result['mean'] * 1000, result['min'] * 1000,
+            result['max'] * 1000, calls))
+
+    def filesystems(self):
+        return Filesystems(self.output, self.fixture.proc_root)
+
+    def lvm(self):
+        return LVM(self.output, self.filesystems(), 'auto', 1024,
+                snap_dir=self.fixture.snap_dir, config=self.config)
+
+    def bench_filesystems(self, state):
+        self.filesystems()
+
+    def bench_pkgmgr_cold(self, state):
+        found = PackageManager(self.output, self.fixture.proc_root).scan()
+        if found != 1:
+            raise RuntimeError('found {0} package managers instead of' \
+                    ' 1'.format(found))
+
+    def bench_pkgmgr_warm(self, pkgmgr):
+        pkgmgr.scan()
+
+    def setup_pkgmgr_warm(self):
+        pkgmgr = PackageManager(self.output, self.fixture.proc_root)
+        pkgmgr.scan()
+        return pkgmgr
+
+    def bench_networks(self, state):
+        networking = Networking(self.output, self.config)
+        compiled = networking.compile_networks(self.config['runon_networks'])
+        for i in range(1000):
+            networking.in_networks(compiled, socket.AF_INET,
+                    chr(10) + chr(i % 256) + chr(0) + chr(1))
+
+    def bench_lvm_inventory(self, state):
+        self.lvm().update_inventory()
+
+    def setup_create_snapshots(self):
+        # remove the snapshots of the previous round
+        self.lvm().cleanup_snapshots()
+        return self.lvm()
+
+    def bench_create_snapshots(self, lvm):
+        lvm.create_snapshots()
+
+    def setup_cleanup_snapshots(self):
+        lvm = self.setup_create_snapshots()
+        lvm.create_snapshots()
+        return lvm
+
+    def bench_cleanup_snapshots(self, lvm):
+        lvm.cleanup_snapshots()
+
+    def bench_duplicity_parse(self, state):
+        from rbackup.collection import Collection
+        from rbackup.duplicity import Duplicity
+        from rbackup.excludes import Excludes
+        from rbackup.planner import Planner
+
+        job = {'name': 'bench', 'source': '/', 'destination': '',
+                'excluded': [], 'max_incrementals': 0}
+        collection = Collection(self.output, self.fixture.state_dir, 'bench')
+        planner = Planner(self.output, self.config, job, collection, [])
+        duplicity = Duplicity(self.output, self.config,
+                SSH(self.output, self.config), collection, planner, job,
+                Excludes(self.output, []))
+        duplicity._duplicity(['incr', '/src', 'rsync://host/path'])
+
+    def destinations(self):
+        destinations = []
+        for i in range(self.args.destinations):
+            destination = {
+                'name': 'bench{0}'.format(i),
+                'suffix': '@bench{0}'.format(i),
+                'remote_host': self.config['remote_host'],
+                'remote_path': self.config['remote_path'],
+                'ssh_config': self.config['ssh_config'],
+                'keep_full': 1,
+            }
+            if i == 0:
+                destination['name'] = 'default'
+                destination['suffix'] = ''
+            destinations.append(destination)
+        return destinations
+
+    def bench_end_to_end(self, state):
+        targets = [{'destination': dest,
+            'ssh': SSH(self.output, self.config, dest)}
+            for dest in self.destinations()]
+        for target in targets:
+            target['ssh'].start()
+        try:
+            history = History(self.output, self.fixture.state_dir)
+            scheduler = Scheduler(self.output, self.config, targets, history)
+            jobs = [{'name': 'bench{0}'.format(i), 'source': '/',
+                'destination': 'bench{0}'.format(i),
+                'excluded': self.config['excluded'], 'max_incrementals': 0}
+                for i in range(4)]
+            results = scheduler.run(jobs, self.fixture.src_dir)
+            history.record_results(results)
+            history.close()
+        finally:
+            for target in targets:
+                target['ssh'].stop()
+
+    def run(self):
+        print('{0:<24} {1:>10} {2:>10} {3:>10} {4:>6}'.format('phase',
+            'mean ms', 'min ms', 'max ms', 'forks'))
+        self.measure('filesystems', self.bench_filesystems)
+        self.measure('pkgmgr_scan_cold', self.bench_pkgmgr_cold)
+        self.measure('pkgmgr_scan_warm', self.bench_pkgmgr_warm,
+                self.setup_pkgmgr_warm)
+        self.measure('runon_networks', self.bench_networks)
+        self.measure('lvm_inventory', self.bench_lvm_inventory)
+        self.measure('create_snapshots', self.bench_create_snapshots,
+                self.setup_create_snapshots)
+        self.measure('cleanup_snapshots', self.bench_cleanup_snapshots,
+                self.setup_cleanup_snapshots)
+        self.measure('duplicity_parse', self.bench_duplicity_parse)
+        self.measure('end_to_end', self.bench_end_to_end)
+        return self.results
+
+def main():
+    parser = argparse.ArgumentParser(description=__description__)
+    parser.add_argument('--mountpoints', type=int, default=_d_mountpoints,
+        help='Number of synthetic LVM backed mountpoints')
+    parser.add_argument('--processes', type=int, default=_d_processes,
+        help='Number of synthetic processes in /proc')
+    parser.add_argument('--snapshots', type=int, default=_d_snapshots,
+        help='Number of snapshots per logical volume not made by' \
+        ' rbackup')
+    parser.add_argument('--networks', type=int, default=_d_networks,
+        help='Number of trusted networks')
+    parser.add_argument('--stat-lines', dest='stat_lines', type=int,
+        default=_d_stat_lines, help='Number of file events duplicity logs')
+    parser.add_argument('--latency', type=float, default=_d_latency,
+        help='Latency in seconds of every fake command')
+    parser.add_argument('--destinations', type=int,
+        default=_d_destinations,
+        help='Number of backup destinations end_to_end runs against')
+    parser.add_argument('--repeat', type=int, default=_d_repeat,
+        help='Number of times every phase is measured')
+    parser.add_argument('--json', dest='json_file', default=None,
+        help='Write the results as JSON to this file')
+    parser.add_argument('--keep', action='store_true', default=False,
+        help='Keep the fixture directory')
+    args = parser.parse_args()
+
+    fixture = Fixture(args)
+    try:
+        fixture.setup()
+        results = Benchmark(args, fixture).run()
+    finally:
+        if args.keep:
+            print('fixtures kept in {0}'.format(fixture.root))
+        else:
+            fixture.cleanup()
+
+    if args.json_file:
+        json.dump({'args': vars(args), 'results': results},
+                open(args.json_file, 'w'), indent=2)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,31 @@
 
 import math
+import os
+import pipes
 import sys
-import subprocess
+
+from rbackup.process import Executor, Process
+
+def atomic_write(fname, content):
+    """Replaces fname with content, so a crash leaves either the old
+    or the new version on disk"""
+    dirname = os.path.dirname(fname) or '.'
+    if not os.path.exists(dirname):
+        os.makedirs(dirname, 0700)
+
+    tmp_file = fname + '.tmp'
+    fd = open(tmp_file, 'wb')
+    fd.write(content)
+    fd.flush()
+    os.fsync(fd.fileno())
+    fd.close()
+    os.rename(tmp_file, fname)
+
+    dir_fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
 
 class BaseClass:
     _unit_list = zip(['B', 'kB', 'MB', 'GB', 'TB', 'PB'], [0, 0, 1, 2, 2, 2])
@@ -11,9 +35,11 @@ class BaseClass:
         setattr(self, 'debug', output.debug)
         setattr(self, 'warning', output.warning)
         setattr(self, 'error', output.error)
+        setattr(self, 'progress', output.progress)
         setattr(self, 'low', output.low)
         setattr(self, 'normal', output.normal)
         setattr(self, 'critical', output.critical)
+        setattr(self, 'span', output.span)
 
 
     def path_to_name(self, path=None):
@@ -26,22 +52,38 @@ class BaseClass:
             path = path[1:]
         return path.replace('/', '_')
 
-    def run(self, cmdline):
-        self.debug(cmdline)
+    def process(self, argv, name=None, **kwargs):
+        """Returns a Process for argv which is timed as a command"""
+        name = name or os.path.basename(argv[0])
+        return Process(argv, name=name, span=self.span(name, 'command'),
+                **kwargs)
+
+    def run_many(self, processes, max_parallel=1):
+        for process in processes:
+            self.debug(' '.join([pipes.quote(arg) for arg in process.argv]))
+
+        Executor(max_parallel).run(processes)
 
-        proc = subprocess.Popen(cmdline, shell=True, stderr=subprocess.PIPE,
-                stdout=subprocess.PIPE)
+        for process in processes:
+            if process.timed_out:
+                self.warning('{0} killed after {1}s timeout'.format(
+                    process.name, process.timeout))
+            if process.status_lost:
+                self.warning('exit status of {0} was lost, treating it as' \
+                    ' failed'.format(process.name))
+        return processes
 
-        output = []
-        for raw_line in proc.communicate():
-            if len(raw_line) == 0:
-                continue
-            for line in raw_line.split('\n'):
-                if len(line) == 0:
-                    continue
-                output.append(line)
+    def run(self, argv, timeout=None, on_line=None, stdin=None,
+            preexec=None):
+        """Runs argv without a shell, and returns its exit code together
+        with the lines of output on stdout and stderr"""
+        process = self.process(argv, timeout=timeout, on_line=on_line,
+                stdin=stdin, preexec=preexec)
+        self.run_many([process])
+        return (process.returncode, process.output)
 
-        return (proc.returncode, output)
+    def atomic_write(self, fname, content):
+        atomic_write(fname, content)
 
     def human_byte(self, num):
         """Human friendly file size"""
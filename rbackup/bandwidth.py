@@ -0,0 +1,82 @@
+
+import json
+import os
+import time
+
+from rbackup import BaseClass
+
+class Bandwidth(BaseClass):
+    """Measures the upload speed to the backup server with a timed bulk
+    transfer over the ssh connection, and caches recent measurements per
+    network"""
+    _d_probe_size = 4 * 1024 * 1024
+    _d_max_age = 86400
+
+    _chunk_size = 64 * 1024
+    _max_measurements = 5
+    _probe_timeout = 120
+
+    def __init__(self, output, config, ssh, state_dir):
+        BaseClass.__init__(self, output)
+        self._cfg = config
+        self._ssh = ssh
+        self._state_dir = state_dir
+        self._cache_file = os.path.join(state_dir, 'bandwidth.json')
+        self._cache = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self._cache_file):
+            return
+        try:
+            self._cache = json.load(open(self._cache_file, 'r'))
+        except ValueError, errmsg:
+            self.warning('{0}: {1}'.format(self._cache_file, errmsg))
+
+    def save(self):
+        self.atomic_write(self._cache_file, json.dumps(self._cache))
+
+    def probe(self):
+        """Upload probe_size bytes of incompressible data and return the
+        measured speed in bytes per second"""
+        size = self._cfg.get('bandwidth_probe_size', self._d_probe_size)
+        chunk = os.urandom(self._chunk_size)
+        data = chunk * max(size / self._chunk_size, 1)
+
+        t_start = time.time()
+        (returncode, output) = self._ssh.run_remote('cat > /dev/null',
+                timeout=self._probe_timeout, stdin=data)
+        elapsed = time.time() - t_start
+
+        if returncode != 0 or elapsed <= 0:
+            self.warning('bandwidth probe failed: {0}'.format(
+                ', '.join(output)))
+            return None
+
+        bandwidth = len(data) / elapsed
+        self.debug('measured {0}/s upload bandwidth'.format(
+            self.human_byte(bandwidth)))
+        return bandwidth
+
+    def get_bandwidth(self, network):
+        """Returns the median of the measurements for network younger than
+        bandwidth_cache_age. A new probe is added once the newest is older
+        than a _max_measurements'th of that, so the median is taken over
+        up to _max_measurements samples"""
+        max_age = self._cfg.get('bandwidth_cache_age', self._d_max_age)
+        refresh = max_age / self._max_measurements
+        now = time.time()
+
+        measurements = [m for m in self._cache.get(network, [])
+                if now - m['time'] < max_age]
+        if not measurements or now - measurements[-1]['time'] >= refresh:
+            bandwidth = self.probe()
+            if bandwidth:
+                measurements.append({'time': now, 'bandwidth': bandwidth})
+                self._cache[network] = measurements[-self._max_measurements:]
+                self.save()
+        if not measurements:
+            return None
+
+        values = sorted([m['bandwidth'] for m in measurements])
+        return values[len(values) / 2]
@@ -0,0 +1,156 @@
+
+import calendar
+import json
+import os
+import re
+import time
+
+from rbackup import BaseClass
+
+class Collection(BaseClass):
+    """Local index of the backup sets on the remote, so planning a backup
+    does not need to look at the remote on every run"""
+    _index_version = 1
+
+    _re_backup_file = re.compile('^duplicity-(full|inc)\.([0-9]{8}T[0-9]{6}Z)' \
+            '(?:\.to\.([0-9]{8}T[0-9]{6}Z))?\.(manifest|vol[0-9]+\.difftar)')
+    _re_signature_file = re.compile('^duplicity-(full|new)-signatures' \
+            '\.([0-9]{8}T[0-9]{6}Z)(?:\.to\.([0-9]{8}T[0-9]{6}Z))?\.sigtar')
+
+    def __init__(self, output, state_dir, name='collection', max_age=86400*7):
+        BaseClass.__init__(self, output)
+        self._state_dir = state_dir
+        self._index_file = os.path.join(state_dir, '{0}.json'.format(name))
+        self._max_age = max_age
+        self._index = self.empty_index()
+        self.load()
+
+    def empty_index(self):
+        return {
+            'version': self._index_version,
+            'reconciled': 0,
+            'dirty': True,
+            'chains': [],
+        }
+
+    def load(self):
+        if not os.path.exists(self._index_file):
+            return
+
+        try:
+            index = json.load(open(self._index_file, 'r'))
+        except ValueError, errmsg:
+            self.warning('{0}: {1}'.format(self._index_file, errmsg))
+            return
+
+        if index.get('version') != self._index_version:
+            self.warning('{0}: version mismatch, ignoring'.format(
+                self._index_file))
+            return
+
+        self._index = index
+
+    def save(self):
+        """Atomically replace the index, so a crash leaves either the old
+        or the new version on disk"""
+        self.atomic_write(self._index_file, json.dumps(self._index))
+
+    def is_stale(self):
+        if self._index['dirty']:
+            return True
+        return time.time() - self._index['reconciled'] > self._max_age
+
+    def begin_run(self):
+        """Mark the index dirty until the result of this run is recorded,
+        so an interrupted run forces a reconcile with the remote"""
+        self._index['dirty'] = True
+        self.save()
+
+    def add_backup(self, backup_type, stats):
+        backup_set = {
+            'time': stats.get('start_time', time.time()),
+            'end_time': stats.get('end_time'),
+            'volumes': stats.get('volumes'),
+            'size': stats.get('dest_size_change', 0),
+        }
+
+        chains = self._index['chains']
+        if backup_type == 'full' or len(chains) == 0:
+            chains.append({'full': backup_set, 'incrementals': []})
+        else:
+            chains[-1]['incrementals'].append(backup_set)
+
+        self._index['dirty'] = False
+        self.save()
+
+    def remove_all_but_n_full(self, n):
+        self._index['chains'] = self._index['chains'][-n:]
+        self.save()
+
+    def parse_time(self, timestamp):
+        return calendar.timegm(time.strptime(timestamp, '%Y%m%dT%H%M%SZ'))
+
+    def reconcile(self, files):
+        """Rebuild the index from a listing of (name, size) tuples of the
+        remote backup directory"""
+        backup_sets = {}
+        for (name, size) in files:
+            match = self._re_backup_file.search(name)
+            if not match:
+                match = self._re_signature_file.search(name)
+            if not match:
+                continue
+
+            (set_type, start, end) = match.group(1, 2, 3)
+            if set_type == 'new':
+                set_type = 'inc'
+            key = (set_type, start, end)
+
+            if key not in backup_sets:
+                backup_sets[key] = {
+                    'time': self.parse_time(end or start),
+                    'end_time': None,
+                    'volumes': 0,
+                    'size': 0,
+                    'complete': False,
+                }
+            backup_set = backup_sets[key]
+            backup_set['size'] += size
+
+            if match.re is self._re_signature_file:
+                continue
+            elif match.group(4) == 'manifest':
+                # duplicity writes the manifest last
+                backup_set['complete'] = True
+            else:
+                backup_set['volumes'] += 1
+
+        chains = []
+        keys = backup_sets.keys()
+        keys.sort(key=lambda k: backup_sets[k]['time'])
+        for key in keys:
+            backup_set = backup_sets[key]
+            if not backup_set.pop('complete'):
+                self.debug('skipping incomplete backup set {0}'.format(key))
+                continue
+
+            if key[0] == 'full':
+                chains.append({'full': backup_set, 'incrementals': []})
+            elif len(chains) > 0:
+                chains[-1]['incrementals'].append(backup_set)
+
+        self._index['chains'] = chains
+        self._index['reconciled'] = time.time()
+        self._index['dirty'] = False
+        self.save()
+
+    def get_chains(self):
+        return self._index['chains']
+
+    def has_backups(self):
+        return len(self._index['chains']) > 0
+
+    def get_number_of_incrementals(self):
+        if not self.has_backups():
+            return 0
+        return len(self._index['chains'][-1]['incrementals'])
@@ -4,7 +4,6 @@ import re
 import shlex
 import socket
 
-import yaml
 
 from rbackup import BaseClass
 
@@ -22,9 +21,23 @@ remote_host: %HOST%
 remote_user: %USER%
 remote_path: %PATH%
 ssh_config: /etc/rbackup/ssh_config
+state_dir: /var/lib/rbackup
 use_snapshots: auto
 snapshot_size: 1024
-max_incrementals: 6
+snapshot_extend_threshold: 70
+max_incrementals: 0
+keep_full: 1
+full_backup_threshold: 1.0
+max_restore_time: 0
+max_transfer_time: 0
+connect_timeout: 5
+remote_timeout: 300
+duplicity_timeout: 0
+restore_parallel: 4
+verify_volumes: 4
+verify_files: 16
+verify_cycle: 30
+verify_staging_dir: /dev/shm
 excluded:
  - /dev
  - /sys
@@ -37,6 +50,28 @@ excluded:
  - /var/tmp
 runon_networks:
  - 192.168.0.0/16
+max_parallel_jobs: 0
+prescan: yes
+prescan_threads: 4
+bandwidth_budget: 0
+throttle: auto
+io_weight: 50
+cpu_weight: 50
+throttle_pressure_high: 20
+throttle_pressure_low: 5
+backup_interval: 86400
+min_backup_interval: 3600
+require_ac_power: no
+control_socket: /run/rbackup.sock
+notify:
+ - dbus
+mail_to: ''
+metrics_report: ''
+metrics_textfile: ''
+destinations: []
+jobs:
+ - source: /
+   destination: ''
  """
 
     def __init__(self, output, cfg_dir='/etc/rbackup'):
@@ -52,6 +87,55 @@ runon_networks:
         except KeyError:
             self.error('no such configuration item {0}'.format(cfgitem))
 
+    def get(self, cfgitem, default=None):
+        return self._config.get(cfgitem, default)
+
+    def get_jobs(self):
+        """Returns the configured backup jobs, with the global settings
+        filled in for anything a job does not override"""
+        jobs = []
+        for job_cfg in self._config.get('jobs') or [{'source': '/'}]:
+            if 'source' not in job_cfg:
+                self.error('backup job without source')
+            job = {
+                'source': job_cfg['source'],
+                'destination': job_cfg.get('destination') or '',
+                'excluded': job_cfg.get('excluded',
+                    self._config.get('excluded', [])),
+                'max_incrementals': job_cfg.get('max_incrementals',
+                    self._config.get('max_incrementals', 0)),
+            }
+            job['name'] = self.path_to_name(job['destination'] or
+                    job['source'])
+            jobs.append(job)
+        return jobs
+
+    def get_destinations(self):
+        """Returns the backup server from the global settings, followed by
+        the additional destinations, which inherit anything they do not
+        override from the global settings"""
+        destinations = [{
+            'name': 'default',
+            'suffix': '',
+            'remote_host': self._config['remote_host'],
+            'remote_path': self._config['remote_path'],
+            'ssh_config': self._config['ssh_config'],
+            'keep_full': self._config.get('keep_full', 1),
+            'max_incrementals': None,
+            'bandwidth_budget': self._config.get('bandwidth_budget'),
+            'max_parallel_jobs': self._config.get('max_parallel_jobs'),
+        }]
+
+        for dest_cfg in self._config.get('destinations') or []:
+            destination = dict(destinations[0])
+            destination.update(dest_cfg)
+            destination['name'] = dest_cfg.get('name') or \
+                    dest_cfg['remote_host']
+            # state of other destinations is kept apart from the default
+            destination['suffix'] = '@{0}'.format(destination['name'])
+            destinations.append(destination)
+        return destinations
+
     def update(self):
         self._config = self.verify_all()
 
@@ -59,6 +143,7 @@ runon_networks:
         self.verify_config_paths()
         config = self.verify_yaml()
         self.verify_ssh_config(config)
+        self.verify_destinations(config)
         return config
 
     def verify_config_paths(self):
@@ -69,6 +154,9 @@ runon_networks:
             self.error('{0} does not exist'.format(self._cfg_file))
 
     def verify_yaml(self):
+        # yaml takes a while to import and is only needed here
+        import yaml
+
         raw_yaml = open(self._cfg_file, 'r').read()
         config = yaml.load(raw_yaml)
         if config['version'] is not self._config_version:
@@ -76,6 +164,18 @@ runon_networks:
                 self._config_version, config['version']))
         return config
 
+    def verify_destinations(self, config):
+        names = ['default']
+        for dest_cfg in config.get('destinations') or []:
+            if 'remote_host' not in dest_cfg:
+                self.error('backup destination without remote_host')
+            name = dest_cfg.get('name') or dest_cfg['remote_host']
+            if name in names:
+                self.error('duplicate backup destination {0}'.format(name))
+            names.append(name)
+            if 'ssh_config' in dest_cfg:
+                self.verify_ssh_config(dest_cfg)
+
     def verify_ssh_config(self, config):
         ssh_config_file = config['ssh_config']
         if not os.path.exists(ssh_config_file):
@@ -114,15 +214,14 @@ runon_networks:
 
         if not os.path.exists(self._identity):
             self.info('generating ssh key')
-            cmd = 'ssh-keygen -q -b 4096 -t rsa' \
-                  + ' -C "rbackup@{0}"'.format(socket.gethostname()) \
-                  + ' -f {0}'.format(self._identity) \
-                  + ' -N ""'
+            cmd = ['ssh-keygen', '-q', '-b', '4096', '-t', 'rsa',
+                   '-C', 'rbackup@{0}'.format(socket.gethostname()),
+                   '-f', self._identity, '-N', '']
             self.run(cmd)
 
             self.info('copying ssh key to {0}@{1}'.format(user, host))
-            cmd = 'ssh-copy-id -i /etc/rbackup/id_rsa {0}@{1}'.format(
-                    user, host)
+            cmd = ['ssh-copy-id', '-i', self._identity,
+                   '{0}@{1}'.format(user, host)]
             self.run(cmd)
         else:
             self.warning('{0} already exists, not overwriting'.format(
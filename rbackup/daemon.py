@@ -0,0 +1,266 @@
+
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import threading
+import time
+
+from rbackup import BaseClass
+from rbackup.power import Power
+
+class Daemon(BaseClass):
+    """Keeps rbackup resident and starts backups from a schedule, when the
+    host joins a trusted network or is plugged into AC power, and when it
+    is asked to over the control socket"""
+    _d_control_socket = '/run/rbackup.sock'
+    _d_backup_interval = 86400
+    _d_min_backup_interval = 3600
+    _d_retry_interval = 900
+    _d_require_ac_power = False
+
+    # longest time the main loop sleeps
+    _max_wait = 60
+
+    _commands = ['status', 'run']
+
+    def __init__(self, output, config, history, runner=None):
+        BaseClass.__init__(self, output)
+        self._output = output
+        self._cfg = config
+        self._history = history
+        self._runner = runner
+        self._power = Power(output)
+        self._stop = False
+        self._reload = False
+        self._thread = None
+        self._run_requested = False
+        self._last_run = None
+        self._last_attempt = None
+        self._last_result = None
+        self._last_trigger = None
+        self._failed_runs = 0
+        self._on_runon_network = False
+        self._on_ac_power = True
+        self._lock = threading.Lock()
+
+    def get_socket_path(self):
+        return self._cfg.get('control_socket', self._d_control_socket)
+
+    def setting(self, name):
+        return self._cfg.get(name, getattr(self, '_d_' + name))
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def get_status(self):
+        with self._lock:
+            return {
+                'state': self.is_running() and 'running' or 'idle',
+                'last_run': self._last_run,
+                'last_attempt': self._last_attempt,
+                'last_result': self._last_result,
+                'last_trigger': self._last_trigger,
+                'failed_runs': self._failed_runs,
+                'next_run': self.get_next_run(),
+                'on_runon_network': self._on_runon_network,
+                'on_ac_power': self._on_ac_power,
+            }
+
+    def get_next_run(self):
+        next_run = time.time()
+        if self._last_run:
+            next_run = self._last_run + self.setting('backup_interval')
+        if self._last_attempt and self._last_result != 'ok':
+            next_run = max(next_run,
+                    self._last_attempt + self.setting('retry_interval'))
+        return next_run
+
+    def run_backup(self, trigger):
+        """Runs on a separate thread, so the control socket stays
+        responsive during a backup"""
+        self.info('starting backup, triggered by {0}'.format(trigger))
+        result = 'failed'
+        try:
+            if not self._runner.run(keep_connection=True):
+                result = 'ok'
+        except SystemExit:
+            # error() and critical() exit, which only ends this run
+            pass
+        except Exception, errmsg:
+            self.warning('backup failed: {0}'.format(errmsg))
+
+        with self._lock:
+            self._last_attempt = time.time()
+            self._last_result = result
+            if result == 'ok':
+                self._last_run = self._last_attempt
+                self._failed_runs = 0
+            else:
+                self._failed_runs += 1
+                failed_runs = self._failed_runs
+
+        if result != 'ok' and failed_runs > 1:
+            self.warning('backup failed {0} times in a row'.format(
+                failed_runs))
+
+    def start_backup(self, trigger):
+        if self.is_running():
+            return False
+        with self._lock:
+            self._last_trigger = trigger
+        self._thread = threading.Thread(target=self.run_backup,
+                args=(trigger,), name='backup')
+        self._thread.start()
+        return True
+
+    def check_triggers(self, network_changed=False, power_changed=False):
+        now = time.time()
+        was_on_runon_network = self._on_runon_network
+        was_on_ac_power = self._on_ac_power
+        if network_changed or self._on_runon_network is None:
+            self._on_runon_network = self._runner.get_networking() \
+                    .on_runon_network()
+        if power_changed:
+            self._on_ac_power = self._power.on_ac_power()
+
+        if self._run_requested:
+            self._run_requested = False
+            self.start_backup('request')
+            return
+
+        if not self._on_runon_network:
+            return
+        if self.setting('require_ac_power') and not self._on_ac_power:
+            return
+
+        since_last = now - (self._last_run or 0)
+        if now >= self.get_next_run():
+            self.start_backup('schedule')
+        elif since_last < self.setting('min_backup_interval'):
+            return
+        elif was_on_runon_network is False:
+            self.start_backup('network')
+        elif self._on_ac_power and not was_on_ac_power:
+            self.start_backup('ac power')
+
+    def open_control_socket(self):
+        path = self.get_socket_path()
+        if os.path.exists(path):
+            os.unlink(path)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(path)
+        os.chmod(path, 0600)
+        s.listen(5)
+        return s
+
+    def handle_client(self, s):
+        """Answers a single command with a single line of JSON"""
+        s.settimeout(1.0)
+        try:
+            command = s.recv(1024).strip()
+            if command == 'run':
+                self._run_requested = True
+                reply = {'result': 'ok', 'running': self.is_running()}
+            elif command == 'status':
+                reply = self.get_status()
+            else:
+                reply = {'result': 'error', 'error': 'unknown command,' \
+                    ' use one of {0}'.format(', '.join(self._commands))}
+            s.sendall(json.dumps(reply) + '\n')
+        except socket.error, errmsg:
+            self.debug('control socket: {0}'.format(errmsg))
+        finally:
+            s.close()
+
+    def send(self, command):
+        """Client side of the control socket"""
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self.get_socket_path())
+            s.sendall(command + '\n')
+            reply = ''
+            while True:
+                data = s.recv(65536)
+                if not data:
+                    break
+                reply += data
+        except socket.error, errmsg:
+            self.error('{0}: {1}'.format(self.get_socket_path(), errmsg))
+        finally:
+            s.close()
+        return json.loads(reply)
+
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self._reload = True
+        else:
+            self._stop = True
+
+    def reload(self):
+        self.info('reloading configuration')
+        self._reload = False
+        try:
+            self._cfg.update()
+        except SystemExit:
+            # error() exits, the previous configuration stays in use
+            return
+        self._output.setup_notifications(self._cfg)
+        if not self.is_running():
+            self._runner.reload()
+
+    def run(self):
+        for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]:
+            signal.signal(signum, self.handle_signal)
+
+        self._last_run = self._history.get_last_run_time()
+        self._failed_runs = self._history.get_failed_runs()
+        self._history.close()
+
+        control = self.open_control_socket()
+        addresses = self._runner.get_networking().subscribe_addresses()
+        uevents = self._power.subscribe()
+        self._on_runon_network = None
+        self._on_ac_power = self._power.on_ac_power()
+        self.info('waiting for backups, control socket at {0}'.format(
+            self.get_socket_path()))
+
+        try:
+            while not self._stop:
+                if self._reload:
+                    self.reload()
+
+                readers = [s for s in [control, addresses, uevents] if s]
+                timeout = min(max(self.get_next_run() - time.time(), 1),
+                        self._max_wait)
+                try:
+                    (readable, _, _) = select.select(readers, [], [], timeout)
+                except select.error, errmsg:
+                    if errmsg[0] == errno.EINTR:
+                        continue
+                    raise
+
+                network_changed = False
+                power_changed = False
+                for s in readable:
+                    if s is control:
+                        (client, address) = control.accept()
+                        self.handle_client(client)
+                    elif s is addresses:
+                        network_changed = self._runner.get_networking() \
+                                .read_address_events(s)
+                    elif s is uevents:
+                        power_changed = self._power.read_events(s)
+
+                self.check_triggers(network_changed, power_changed)
+        finally:
+            self.info('stopping')
+            if self._thread:
+                self._thread.join()
+            self._runner.stop()
+            for s in [control, addresses, uevents]:
+                if s:
+                    s.close()
+            os.unlink(self.get_socket_path())
@@ -0,0 +1,72 @@
+
+import json
+import os
+import time
+
+from rbackup import BaseClass
+
+class DiskStats(BaseClass):
+    """Keeps track of the write rate of block devices, using the sectors
+    written counters from /proc/diskstats which are recorded on each run"""
+    _sector_size = 512
+
+    # index of the sectors written counter in a /proc/diskstats line
+    _sectors_written = 9
+
+    def __init__(self, output, state_dir, proc_root='/proc'):
+        BaseClass.__init__(self, output)
+        self._state_dir = state_dir
+        self._proc_root = proc_root
+        self._state_file = os.path.join(state_dir, 'diskstats.json')
+
+    def read(self):
+        """Returns major:minor -> bytes written since boot"""
+        written = {}
+        for line in open(os.path.join(self._proc_root, 'diskstats'),
+                'r').readlines():
+            fields = line.split()
+            if len(fields) <= self._sectors_written:
+                continue
+            devno = '{0}:{1}'.format(fields[0], fields[1])
+            written[devno] = int(fields[self._sectors_written]) * \
+                    self._sector_size
+        return written
+
+    def get_uptime(self):
+        return float(open(os.path.join(self._proc_root, 'uptime'),
+            'r').read().split()[0])
+
+    def load(self):
+        if not os.path.exists(self._state_file):
+            return None
+        try:
+            return json.load(open(self._state_file, 'r'))
+        except ValueError, errmsg:
+            self.warning('{0}: {1}'.format(self._state_file, errmsg))
+            return None
+
+    def save(self, sample):
+        self.atomic_write(self._state_file, json.dumps(sample))
+
+    def get_write_rates(self):
+        """Returns major:minor -> bytes written per second, averaged since
+        the previous run, or since boot when the counters were reset or
+        no previous sample exists"""
+        now = time.time()
+        uptime = self.get_uptime()
+        sample = {'time': now, 'boot': now - uptime, 'written': self.read()}
+        previous = self.load()
+        self.save(sample)
+
+        rates = {}
+        for devno, written in sample['written'].items():
+            elapsed = uptime
+            since = 0
+            if previous and abs(previous['boot'] - sample['boot']) < 60 and \
+                    devno in previous['written'] and \
+                    previous['written'][devno] <= written:
+                elapsed = now - previous['time']
+                since = previous['written'][devno]
+            if elapsed > 0:
+                rates[devno] = (written - since) / elapsed
+        return rates
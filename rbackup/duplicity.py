@@ -1,169 +1,260 @@
 import os
+import pipes
 import re
-import shlex
-import socket
-import subprocess
-import tempfile
 import time
 
-import pprint
-
 from rbackup import BaseClass
 
 class Duplicity(BaseClass):
     _re_identityfile = re.compile('.*IdentityFile[\ \t]+(/.*)')
 
     _re_duplicity_error = re.compile('duplicity: error: (.*)$')
-    _re_duplicity = {
-        'last_full':        re.compile('^Last full backup date: (.*)'),
-        'start_time':       re.compile('^StartTime ([0-9\.]+) .*$'),
-        'end_time':         re.compile('^EndTime ([0-9\.]+) .*$'),
-        'elapsed_time':     re.compile('^ElapsedTime ([0-9\.]+) .*$'),
-        'source_files':     re.compile('^SourceFiles ([0-9]+)$'),
-        'source_file_s':    re.compile('^SourceFileSize ([0-9]+) .*$'),
-        'new_files':        re.compile('^NewFiles ([0-9]+)$'),
-        'new_files_s':      re.compile('^NewFileSize ([0-9]+) .*$'),
-        'deleted_files':    re.compile('^DeletedFiles ([0-9]+)$'),
-        'changed_files':    re.compile('^ChangedFiles ([0-9]+)$'),
-        'changed_file_s':   re.compile('^ChangedFileSize ([0-9]+) .*$'),
-        'changed_delta_s':  re.compile('^ChangedDeltaSize ([0-9]+) .*$'),
-        'delta_entries':    re.compile('^DeltaEntries ([0-9]+)$'),
-        'raw_delta_s':      re.compile('^RawDeltaSize ([0-9]+) .*$'),
-        'dest_size_change': re.compile('^TotalDestinationSizeChange ([0-9]+) .*$'),
-        'errors':           re.compile('^Errors ([0-9]+)$'),
+    _re_last_full = re.compile('^Last full backup date: (.*)')
+
+    # statistic name -> (stats key, converter); each line is looked up
+    # once on its first word instead of being matched against every regex
+    _duplicity_stats = {
+        'StartTime':                  ('start_time', float),
+        'EndTime':                    ('end_time', float),
+        'ElapsedTime':                ('elapsed_time', float),
+        'SourceFiles':                ('source_files', int),
+        'SourceFileSize':             ('source_file_s', int),
+        'NewFiles':                   ('new_files', int),
+        'NewFileSize':                ('new_files_s', int),
+        'DeletedFiles':               ('deleted_files', int),
+        'ChangedFiles':               ('changed_files', int),
+        'ChangedFileSize':            ('changed_file_s', int),
+        'ChangedDeltaSize':           ('changed_delta_s', int),
+        'DeltaEntries':               ('delta_entries', int),
+        'RawDeltaSize':               ('raw_delta_s', int),
+        'TotalDestinationSizeChange': ('dest_size_change', int),
+        'Errors':                     ('errors', int),
     }
 
-    def __init__(self, output, config):
+    # duplicity --log-fd info codes
+    _log_levels = ['DEBUG', 'INFO', 'NOTICE', 'WARNING', 'ERROR']
+    _log_file_codes = [4, 5, 6]     # diff_file_{new,changed,deleted}
+    _log_upload_done = [13, 14]     # {,a}synchronous_upload_done
+    _log_upload_progress = 16
+
+    _progress_interval = 30
+
+    _d_state_dir = '/var/lib/rbackup'
+
+    def __init__(self, output, config, ssh, collection, planner, job,
+            excludes, bwlimit=0, throttle=None, destination=None):
         BaseClass.__init__(self, output)
         self._cfg = config
+        self._ssh_session = ssh
+        self._collection = collection
+        self._planner = planner
+        self._job = job
+        self._excludes = excludes
+        self._bwlimit = bwlimit
+        self._throttle = throttle
+        self._remote_state = None
+        self._dest = destination or config
+        self._remote_host = self._dest['remote_host']
+        self._remote_path = self._dest['remote_path']
+        if job['destination']:
+            self._remote_path = os.path.join(self._remote_path,
+                    job['destination'])
         self._destination = 'rsync://{0}/{1}'.format(
-                self._cfg['remote_host'], self._cfg['remote_path'])
+                self._remote_host, self._remote_path)
 
     def _ssh(self, options):
-        cmd = 'ssh -F {0} {1} '.format(self._cfg['ssh_config'],
-                self._cfg['remote_host'])
-        (returncode, output) = self.run(cmd + options)
+        (returncode, output) = self._ssh_session.run_remote(options)
         return output
 
+    def _parse_last_full(self, line):
+        match = self._re_last_full.search(line)
+        if not match:
+            return
+        value = match.group(1)
+        if value == 'none':
+            return None
+        struct_t = time.strptime(value, '%a %b %d %H:%M:%S %Y')
+        return time.mktime(struct_t)
+
+    def _parse_progress(self, fields, state):
+        """Fields are changed bytes, elapsed seconds, percentage done,
+        estimated seconds left, bytes per second and True or False for a
+        stalled upload, all but the last one can be floats"""
+        if len(fields) < 6:
+            return
+        try:
+            (changed_bytes, elapsed, progress, eta, speed) = \
+                    [float(f) for f in fields[:5]]
+        except ValueError:
+            return
+        stalled = fields[5] == 'True'
 
-    def _duplicity(self, options):
-        cmd = 'duplicity' + options
-        self.debug(cmd)
+        now = time.time()
+        if now - state['last_progress'] < self._progress_interval:
+            return
+        state['last_progress'] = now
 
-        proc = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE,
-                stdout=subprocess.PIPE)
+        if stalled:
+            eta = 'stalled'
+        else:
+            eta = time.strftime('%H:%M:%S', time.gmtime(eta))
+        self.progress('Backup progress', '{0:.0f}%, {1}, {2} files, {3}/s, ETA {4}'.format(
+            progress, self.human_byte(int(changed_bytes)), state['files'],
+            self.human_byte(int(speed)), eta))
+
+    def _parse_duplicity_line(self, line, state):
+        # --log-fd messages are prefixed with '. '
+        if line.startswith('. '):
+            line = line[2:]
+
+        fields = line.split()
+        if len(fields) == 0:
+            return
+
+        name = fields[0]
+        if name in self._duplicity_stats:
+            (key, converter) = self._duplicity_stats[name]
+            if len(fields) > 1 and key not in state['stats']:
+                try:
+                    state['stats'][key] = converter(fields[1])
+                except ValueError:
+                    pass
+
+        elif name in self._log_levels:
+            if len(fields) < 2 or not fields[1].isdigit():
+                return
+            code = int(fields[1])
+            if code in self._log_file_codes:
+                state['files'] += 1
+            elif code in self._log_upload_done:
+                state['uploads'] += 1
+            elif code == self._log_upload_progress:
+                self._parse_progress(fields[2:], state)
+
+        elif name == 'Last' and 'last_full' not in state['stats']:
+            state['stats']['last_full'] = self._parse_last_full(line)
+
+        elif name == 'duplicity:':
+            match = self._re_duplicity_error.search(line)
+            if match:
+                state['error'] = match.group(1)
 
-        output = []
-        for raw_line in proc.communicate():
-            if len(raw_line) == 0:
+    def _duplicity(self, options):
+        state = {
+            'stats': {},
+            'error': None,
+            'files': 0,
+            'uploads': 0,
+            'last_progress': 0,
+        }
+
+        # output and log lines are parsed as they arrive instead of being
+        # collected
+        parse_line = lambda line: self._parse_duplicity_line(line, state)
+        argv = ['duplicity', '--progress', '--verbosity', 'info',
+                '--log-fd=%LOG_FD%'] + options
+        preexec = None
+        if self._throttle:
+            argv = self._throttle.wrap(argv)
+            preexec = self._throttle.preexec
+        process = self.process(argv,
+                timeout=self._cfg.get('duplicity_timeout'),
+                on_line=parse_line, log=True, on_log_line=parse_line,
+                keep_output=False, preexec=preexec, name='duplicity')
+        self.run_many([process])
+
+        if process.returncode != 0:
+            if state['error']:
+                self.critical('Backup failed', state['error'])
+            return {}
+
+        # every backup set is uploaded as its volumes, a manifest and
+        # a signature file
+        if state['uploads'] > 0:
+            state['stats']['volumes'] = max(state['uploads'] - 2, 0)
+
+        return state['stats']
+
+    def probe_remote(self):
+        """Look at the remote backup directory with a single remote command
+        and reconcile the local collection index with its contents"""
+        script = 'p={0};' \
+            ' if [ -d "$p" ]; then echo backup_dir=1;' \
+            ' else echo backup_dir=0; fi;' \
+            ' ls -ln "$p" 2>/dev/null | sed "s/^/file /"'.format(
+                pipes.quote(self._remote_path))
+
+        state = {}
+        files = []
+        for line in self._ssh(script):
+            if line.startswith('backup_dir='):
+                state['backup_dir'] = line.strip().endswith('1')
                 continue
-            for line in raw_line.split('\n'):
-                if len(line) == 0:
-                    continue
-                output.append(line)
-
-        stats = {}
-        if proc.returncode == 0:
-            for key, regexp in self._re_duplicity.items():
-                if key in stats.keys():
-                    continue
-                for line in output:
-                    match = regexp.search(line)
-                    if match:
-                        if key in ['elapsed_time', 'end_time', 'start_time']:
-                            value = float(match.group(1))
-                        elif key in ['last_full']:
-                            value = match.group(1)
-                            if value == 'none':
-                                value = None
-                            else:
-                                struct_t = time.strptime(match.group(1),
-                                        '%a %b %d %H:%M:%S %Y')
-                                value = time.mktime(struct_t)
-                        else:
-                            value = int(match.group(1))
-
-                        stats[key] = value
-        else:
-            for line in output:
-                match = self._re_duplicity_error.search(line)
-                if match:
-                    self.critical('Backup failed', match.group(1))
 
-        return stats
+            fields = line.split()
+            if len(fields) < 9 or fields[0] != 'file':
+                continue
+            try:
+                files.append((fields[-1], int(fields[5])))
+            except ValueError:
+                continue
+
+        if 'backup_dir' not in state:
+            self.critical('Not running backup', 'failed to probe {0}:{1}'.format(
+                self._remote_host, self._remote_path))
+
+        if state['backup_dir']:
+            self._collection.reconcile(files)
+
+        self._remote_state = state
+        return state
 
     def has_backup_dir(self):
-        cmd = 'ls -d {0} 2>&1'.format(self._cfg['remote_path'])
-        result = self._ssh(cmd)
-        return 'not found' not in result
+        if not self._remote_state:
+            self.probe_remote()
+        return self._remote_state['backup_dir']
 
     def has_backups(self):
-        cmd = 'ls {0} 2>/dev/null'.format(self._cfg['remote_path'])
-        result = self._ssh(cmd)
-        if not result or len(result) == 0:
-            return False
-        return True
+        return self._collection.has_backups()
 
     def get_number_of_incrementals(self):
-        cmd = 'ls {0}/*-inc*.manifest 2>/dev/null | wc -l'.format(
-                self._cfg['remote_path'])
-        output = self._ssh(cmd)
-        return int(output[0])
+        return self._collection.get_number_of_incrementals()
+
+    def rsync_options(self):
+        options = '-e \'{0}\''.format(self._ssh_session.command())
+        if self._bwlimit:
+            options += ' --bwlimit={0}'.format(self._bwlimit)
+        return '--rsync-options={0}'.format(options)
 
     def run_duplicity_backup(self, backup_type, path):
-        stats = {}
-        duplicity_options = ''
-        excluded_options = ''
-        if len(self._cfg['excluded']) > 0:
-            (f, fname) = tempfile.mkstemp(prefix='rbackup-', text=True)
-            fd = os.fdopen(f, 'w')
-            for excluded_path in self._cfg['excluded']:
-                fd.write('.{0}\n'.format(excluded_path))
-            fd.close()
-            excluded_options = '--exclude-filelist={0}'.format(fname)
-
-        rsync_options = '--rsync-options=\"-e \'ssh -F {0}\'\"'.format(
-            self._cfg['ssh_config'])
-
-        duplicity_options =  ' {0}'.format(backup_type)
-        duplicity_options += ' --exclude-device-files'
-        duplicity_options += ' --no-encryption'
-        duplicity_options += ' {0}'.format(excluded_options)
-        duplicity_options += ' {0}'.format(rsync_options)
-        duplicity_options += ' {0}'.format(path)
-        duplicity_options += ' {0}'.format(self._destination)
-
-        stats = self._duplicity(duplicity_options)
-
-        if len(excluded_options) > 0:
-            os.unlink(fname)
+        excluded_options = self._excludes.get_duplicity_options(path,
+                self._cfg.get('state_dir', self._d_state_dir))
 
-        return stats
+        duplicity_options = [backup_type, '--exclude-device-files',
+                '--no-encryption'] + excluded_options + [self.rsync_options(),
+                path, self._destination]
+
+        return self._duplicity(duplicity_options)
+
+    def get_keep_full(self):
+        return max(self._dest.get('keep_full') or 1, 1)
 
     def run_duplicity_cleanup(self):
-        rsync_options = ' --rsync-options=\"-e \'ssh -F {0}\'\"'.format(
-            self._cfg['ssh_config'])
-
-        duplicity_options = ' remove-all-but-n-full 1' \
-            + ' --force' \
-            + ' --no-encryption' \
-            + rsync_options \
-            + ' {0}'.format(self._destination)
-        result = self._duplicity(duplicity_options)
-
-        duplicity_options = ' cleanup' \
-            + ' --force' \
-            + ' --no-encryption' \
-            + rsync_options \
-            + ' {0}'.format(self._destination)
-        result = self._duplicity(duplicity_options)
+        rsync_options = self.rsync_options()
+
+        self._duplicity(['remove-all-but-n-full', str(self.get_keep_full()),
+            '--force', '--no-encryption', rsync_options, self._destination])
+
+        self._duplicity(['cleanup', '--force', '--no-encryption',
+            rsync_options, self._destination])
 
     def full_backup(self, path):
-        self.normal('Starting full backup')
+        self.normal('Starting full backup of {0}'.format(self._job['name']))
         return self.run_duplicity_backup('full', path)
 
     def incremental_backup(self, path):
-        self.normal('Starting incremental backup')
+        self.normal('Starting incremental backup of {0}'.format(
+            self._job['name']))
         return self.run_duplicity_backup('incr', path)
 
     def backup(self, path=None):
@@ -175,51 +266,49 @@ class Duplicity(BaseClass):
             self.warning('{0} does not exist'.format(path))
             return
 
-        num_incrementals = self.get_number_of_incrementals()
-
-        if not self.has_backup_dir():
-            self.error('{0}:{1} does not exist'.format(
-                self._cfg['remote_host'], self._cfg['remote_path']))
-
-        elif not self.has_backups():
-            stats = self.full_backup(path)
-
-        elif num_incrementals >= self._cfg['max_incrementals']:
-            self.full_backup(path)
-            stats = self.run_duplicity_cleanup()
-
-        else:
-            stats = self.incremental_backup(path)
+        # the remote is only looked at when the local index can not be
+        # trusted, otherwise planning needs no network calls at all
+        if self._collection.is_stale():
+            self.debug('collection index is stale, probing remote')
+            with self.span('remote_probe'):
+                has_backup_dir = self.has_backup_dir()
+            if not has_backup_dir:
+                self.error('{0}:{1} does not exist'.format(
+                    self._remote_host, self._remote_path))
+
+        has_backups = self.has_backups()
+        (backup_type, reason) = self._planner.plan()
+        self.debug('{0}: {1} backup, {2}'.format(self._job['name'],
+            backup_type, reason))
+
+        if backup_type == 'skip':
+            self.warning('{0}: skipping backup, {1}'.format(
+                self._job['name'], reason))
+            return {'backup_type': backup_type, 'reason': reason}
+
+        self._collection.begin_run()
+        t_start = time.time()
+        with self.span('duplicity'):
+            if backup_type == 'full':
+                stats = self.full_backup(path)
+            else:
+                stats = self.incremental_backup(path)
 
         if len(stats) == 0:
             self.critical('Backup failed', 'Unknown error')
 
-        output = 'E:{0}, T:{1}, S:{2}, C:{3}, D:{4}, N:{5}'.format(
-            stats['errors'],
-            time.strftime('%H:%M:%S', time.gmtime(stats['elapsed_time'])),
-            self.human_byte(stats['dest_size_change']),
-            stats['changed_files'],
-            stats['deleted_files'],
-            stats['new_files'],
-        )
-
-        if stats['errors'] > 0:
-            self.critical('Backup completed', output)
-        else:
-            self.normal('Backup completed', output)
+        self._collection.add_backup(backup_type, stats)
+        phases = {'duplicity': time.time() - t_start}
 
-def _duplicity(options):
-    cmd = options
+        if backup_type == 'full' and has_backups and \
+                len(self._collection.get_chains()) > self.get_keep_full():
+            t_start = time.time()
+            with self.span('retention_cleanup'):
+                self.run_duplicity_cleanup()
+                self._collection.remove_all_but_n_full(
+                        self.get_keep_full())
+            phases['cleanup'] = time.time() - t_start
 
-    proc = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-
-    output = []
-    for raw_line in proc.communicate():
-        if len(raw_line) == 0:
-            continue
-        for line in raw_line.split('\n'):
-            if len(line) == 0:
-                continue
-            output.append(line)
-
-    return((proc.returncode, output))
+        stats['backup_type'] = backup_type
+        stats['phases'] = phases
+        return stats
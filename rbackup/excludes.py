@@ -0,0 +1,237 @@
+
+import errno
+import hashlib
+import os
+import re
+import stat
+import tempfile
+import threading
+import time
+
+from rbackup import BaseClass
+
+class Excludes(BaseClass):
+    """Exclusion rules of a backup job, compiled once into a matcher which
+    is shared by duplicity and rbackup's own tree walkers.
+
+    Supported rules in the excluded list:
+      /some/path        literal path
+      /home/*/.cache    glob, '*' and '?' do not match '/', '**' does
+      re:<regexp>       regular expression matched against the path
+      size>100M         files larger than the given size
+      CACHEDIR.TAG      directories tagged as cache directory
+    """
+    _cachedir_tag = 'CACHEDIR.TAG'
+    _cachedir_signature = 'Signature: 8a477f597d28d172789f06886806bc55'
+
+    _re_size_rule = re.compile('^size>([0-9]+)([kKmMgGtT]?)$')
+    _size_units = {'': 0, 'k': 1, 'm': 2, 'g': 3, 't': 4}
+
+    # filelists which were not used for this long are removed
+    _filelist_max_age = 86400 * 7
+
+    def __init__(self, output, rules, source='/'):
+        BaseClass.__init__(self, output)
+        self._source = os.path.normpath(source)
+        self._literals = set()
+        self._globs = []
+        self._regexps = []
+        self._max_size = None
+        self._cachedir = False
+        self._found = set()
+        self._walked = False
+        self._walk_lock = threading.Lock()
+        self._re_path = None
+        self.compile(rules)
+
+    def compile(self, rules):
+        patterns = []
+        for rule in rules:
+            match = self._re_size_rule.search(rule)
+            if rule == self._cachedir_tag:
+                self._cachedir = True
+            elif match:
+                unit = self._size_units[match.group(2).lower()]
+                self._max_size = int(match.group(1)) * 1024**unit
+            elif rule.startswith('re:'):
+                self._regexps.append(rule[3:])
+                patterns.append(rule[3:])
+            elif any([c in rule for c in '*?[']):
+                self._globs.append(rule)
+                patterns.append(self.glob_to_regexp(rule))
+            else:
+                self._literals.add(os.path.normpath(rule))
+
+        if patterns:
+            self._re_path = re.compile('|'.join(['(?:{0})'.format(p)
+                for p in patterns]))
+
+    def glob_to_regexp(self, glob):
+        regexp = ''
+        i = 0
+        while i < len(glob):
+            c = glob[i]
+            if glob[i:i+2] == '**':
+                regexp += '.*'
+                i += 2
+                continue
+            elif c == '*':
+                regexp += '[^/]*'
+            elif c == '?':
+                regexp += '[^/]'
+            elif c == '[':
+                end = glob.find(']', i + 1)
+                if end == -1:
+                    regexp += '\\['
+                else:
+                    # a glob negates a class with '!', a regexp with '^'
+                    if glob[i+1:i+2] == '!':
+                        regexp += '[^' + glob[i+2:end+1]
+                    else:
+                        regexp += glob[i:end+1]
+                    i = end
+            else:
+                regexp += re.escape(c)
+            i += 1
+        return '^' + regexp + '$'
+
+    def match_path(self, path):
+        if path in self._literals:
+            return True
+        if self._re_path and self._re_path.search(path):
+            return True
+        return False
+
+    def is_cachedir(self, fspath):
+        try:
+            fd = open(os.path.join(fspath, self._cachedir_tag), 'rb')
+        except IOError:
+            return False
+        try:
+            return fd.read(len(self._cachedir_signature)) == \
+                    self._cachedir_signature
+        finally:
+            fd.close()
+
+    def excluded(self, path, fspath, is_dir, st):
+        """Returns True if path should not be backed up. path is the path
+        on the live system, fspath where it can be read from (which differs
+        when reading from a snapshot). Excluded directories are pruned as a
+        whole by the caller"""
+        if self.match_path(path):
+            return True
+
+        if is_dir:
+            if self._cachedir and self.is_cachedir(fspath):
+                self._found.add(path)
+                return True
+        elif self._max_size is not None and st.st_size > self._max_size:
+            self._found.add(path)
+            return True
+
+        return False
+
+    def set_walked(self):
+        """Called once the whole tree was passed through excluded(), so
+        every file matching a size rule was found"""
+        self._walked = True
+
+    def walk(self, path):
+        """Passes the job source below path through excluded(), to find
+        the files matching size rules when no prescan did so"""
+        root = self.get_root(path)
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            for name in list(dirnames):
+                fspath = os.path.join(dirpath, name)
+                if self.excluded(fspath[len(root):], fspath, True, None):
+                    dirnames.remove(name)
+            for name in filenames:
+                fspath = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(fspath)
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    self.excluded(fspath[len(root):], fspath, False, st)
+        self.set_walked()
+
+    def get_root(self, path):
+        """Returns the prefix under which the job source is found in path"""
+        path = os.path.normpath(path)
+        if self._source == '/':
+            return path.rstrip('/')
+        return path[:len(path)-len(self._source)]
+
+    def get_filelist(self, path):
+        """Lines of the duplicity exclude filelist when backing up the job
+        source from path"""
+        with self._walk_lock:
+            if self._max_size is not None and not self._walked:
+                self.walk(path)
+
+        root = self.get_root(path)
+        lines = []
+        for rule in sorted(self._literals | self._found) + self._globs:
+            relpath = os.path.relpath(rule, self._source)
+            if relpath.startswith('..'):
+                continue
+            lines.append(root + rule)
+        return lines
+
+    def write_filelist(self, path, state_dir):
+        """Write the exclude filelist into a cache directory, named after
+        its contents so the same list is only written once"""
+        lines = self.get_filelist(path)
+        if not lines:
+            return None
+
+        content = '\n'.join(lines) + '\n'
+        cache_dir = os.path.join(state_dir, 'filelists')
+        fname = os.path.join(cache_dir, hashlib.sha1(content).hexdigest())
+        try:
+            os.makedirs(cache_dir, 0700)
+        except OSError, errmsg:
+            if errmsg.errno != errno.EEXIST:
+                raise
+
+        if os.path.exists(fname):
+            os.utime(fname, None)
+            return fname
+
+        # jobs backing up the same source to several destinations write
+        # the same list at the same time
+        (fd, tmp_file) = tempfile.mkstemp(prefix='.', dir=cache_dir)
+        os.write(fd, content)
+        os.close(fd)
+        os.rename(tmp_file, fname)
+
+        self.prune_filelists(cache_dir)
+        return fname
+
+    def prune_filelists(self, cache_dir):
+        now = time.time()
+        for name in os.listdir(cache_dir):
+            fname = os.path.join(cache_dir, name)
+            try:
+                if now - os.stat(fname).st_mtime > self._filelist_max_age:
+                    os.unlink(fname)
+            except OSError:
+                continue
+
+    def get_duplicity_options(self, path, state_dir):
+        options = []
+        filelist = self.write_filelist(path, state_dir)
+        if filelist:
+            options.append('--exclude-filelist={0}'.format(filelist))
+
+        root = self.get_root(path)
+        for regexp in self._regexps:
+            if root and regexp.startswith('^'):
+                regexp = '^' + re.escape(root) + regexp[1:]
+            options.append('--exclude-regexp={0}'.format(regexp))
+
+        if self._cachedir:
+            options.append('--exclude-if-present={0}'.format(
+                self._cachedir_tag))
+
+        return options
@@ -6,8 +6,9 @@ from rbackup import BaseClass
 
 class Filesystems(BaseClass):
     _re_mount = re.compile('^(/dev/.*)\ (/[a-zA-Z0-9-_\./]*)\ ([a-z0-9]*)\ .*')
-    def __init__(self, output):
+    def __init__(self, output, proc_root='/proc'):
         BaseClass.__init__(self, output)
+        self._proc_root = proc_root
         self._filesystems = {}
         self.update()
 
@@ -30,7 +31,8 @@ class Filesystems(BaseClass):
 
     def update(self):
         filesystems = {}
-        for line in open('/proc/mounts', 'r').readlines():
+        for line in open(os.path.join(self._proc_root, 'mounts'),
+                'r').readlines():
             match = self._re_mount.search(line)
             if not match:
                 continue
@@ -0,0 +1,219 @@
+
+import json
+import os
+import sqlite3
+import time
+
+from rbackup import BaseClass
+
+class History(BaseClass):
+    """Append-only store with the statistics of every backup run"""
+    _schema = """CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    job TEXT NOT NULL,
+    time REAL NOT NULL,
+    backup_type TEXT,
+    elapsed_time REAL,
+    source_files INTEGER,
+    source_file_s INTEGER,
+    raw_delta_s INTEGER,
+    dest_size_change INTEGER,
+    changed_files INTEGER,
+    new_files INTEGER,
+    deleted_files INTEGER,
+    errors INTEGER,
+    phases TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_job_time ON runs (job, time);"""
+
+    _columns = ['elapsed_time', 'source_files', 'source_file_s',
+            'raw_delta_s', 'dest_size_change', 'changed_files', 'new_files',
+            'deleted_files', 'errors']
+
+    def __init__(self, output, state_dir):
+        BaseClass.__init__(self, output)
+        self._state_dir = state_dir
+        self._db_file = os.path.join(state_dir, 'history.db')
+        self._db = None
+
+    def connect(self):
+        if self._db:
+            return self._db
+
+        if not os.path.exists(self._state_dir):
+            os.makedirs(self._state_dir, 0700)
+
+        self._db = sqlite3.connect(self._db_file)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(self._schema)
+
+        # databases written before failed runs were recorded lack the
+        # error column
+        columns = [row[1] for row in self._db.execute(
+            'PRAGMA table_info(runs)')]
+        if 'error' not in columns:
+            with self._db:
+                self._db.execute('ALTER TABLE runs ADD COLUMN error TEXT')
+        return self._db
+
+    def close(self):
+        if self._db:
+            self._db.close()
+            self._db = None
+
+    def record(self, job, stats, phases=None, timestamp=None, error=None):
+        if not timestamp:
+            timestamp = stats.get('start_time', time.time())
+
+        values = [job, timestamp, stats.get('backup_type')]
+        values.extend([stats.get(column) for column in self._columns])
+        values.extend([json.dumps(phases or {}), error])
+
+        db = self.connect()
+        with db:
+            db.execute('INSERT INTO runs (job, time, backup_type, {0}, phases,'
+                ' error) VALUES ({1})'.format(', '.join(self._columns),
+                    ', '.join(['?'] * len(values))), values)
+
+    def record_failure(self, job, error, elapsed_time=None):
+        self.record(job, {'elapsed_time': elapsed_time}, error=error)
+
+    def record_results(self, results):
+        for result in results:
+            if result['error']:
+                self.record_failure(result['job']['name'], result['error'],
+                        result['duration'] or None)
+                continue
+            if not result['stats']:
+                continue
+            stats = result['stats']
+            self.record(result['job']['name'], stats, stats.get('phases'))
+
+    def query(self, job=None, since=None, succeeded=False):
+        """Returns all runs, oldest first, optionally limited to a single
+        job, to runs which started after since and to runs which did not
+        fail"""
+        where = []
+        args = []
+        if succeeded:
+            where.append('error IS NULL')
+        if job:
+            where.append('job = ?')
+            args.append(job)
+        if since:
+            where.append('time >= ?')
+            args.append(since)
+
+        sql = 'SELECT * FROM runs'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY time'
+
+        runs = []
+        for row in self.connect().execute(sql, args):
+            run = dict(zip(row.keys(), row))
+            run['phases'] = json.loads(run['phases'] or '{}')
+            runs.append(run)
+        return runs
+
+    def get_last_run_time(self):
+        """Start of the last run which did not fail"""
+        return self.connect().execute('SELECT MAX(time) FROM runs WHERE' \
+                ' error IS NULL').fetchone()[0]
+
+    def get_failed_runs(self):
+        """Number of runs which failed since the last one which did not,
+        runs of several jobs which started together count as one"""
+        since = self.get_last_run_time() or 0
+        return self.connect().execute('SELECT COUNT(DISTINCT CAST(time AS' \
+                ' INTEGER)) FROM runs WHERE error IS NOT NULL AND time > ?',
+                [since]).fetchone()[0]
+
+    def get_expected_duration(self, jobs, days=30, window=10):
+        """Seconds a run of jobs is expected to take. The jobs run at the
+        same time, so this is the longest recent run of any of them"""
+        since = time.time() - days * 86400
+        duration = 0
+        for job in jobs:
+            runs = self.query(job, since, succeeded=True)[-window:]
+            elapsed = [r['elapsed_time'] for r in runs if r['elapsed_time']]
+            if elapsed:
+                duration = max(duration, max(elapsed))
+        return duration
+
+    def get_jobs(self):
+        jobs = [row[0] for row in self.connect().execute(
+            'SELECT DISTINCT job FROM runs ORDER BY job')]
+        return jobs
+
+    def summary(self, job, days=30):
+        all_runs = self.query(job, time.time() - days * 86400)
+        if len(all_runs) == 0:
+            return
+        runs = [r for r in all_runs if not r['error']]
+        if len(runs) == 0:
+            return {'job': job, 'runs': len(all_runs), 'full': 0,
+                'failed': len(all_runs), 'last_error': all_runs[-1]['error']}
+
+        elapsed = sum([r['elapsed_time'] or 0 for r in runs])
+        delta = sum([r['raw_delta_s'] or 0 for r in runs])
+        source = sum([r['source_file_s'] or 0 for r in runs])
+        growth = sum([r['dest_size_change'] or 0 for r in runs])
+        period = max((runs[-1]['time'] - runs[0]['time']) / 86400.0, 1.0)
+
+        summary = {
+            'job': job,
+            'runs': len(all_runs),
+            'full': len([r for r in runs if r['backup_type'] == 'full']),
+            'failed': len([r for r in all_runs
+                if r['error'] or r['errors']]),
+            'last_error': all_runs[-1]['error'],
+            'throughput': 0,
+            'delta_ratio': 0,
+            'growth_per_day': growth / period,
+            'elapsed_first': runs[0]['elapsed_time'],
+            'elapsed_last': runs[-1]['elapsed_time'],
+            'source_size': runs[-1]['source_file_s'],
+        }
+        if elapsed > 0:
+            summary['throughput'] = delta / elapsed
+        if source > 0:
+            summary['delta_ratio'] = float(delta) / source
+
+        return summary
+
+    def human_size(self, num):
+        if num < 0:
+            return '-' + self.human_byte(-num)
+        return self.human_byte(num)
+
+    def show(self, days=30):
+        jobs = self.get_jobs()
+        if len(jobs) == 0:
+            self.info('no backup statistics recorded')
+            return
+
+        for job in jobs:
+            summary = self.summary(job, days)
+            if not summary:
+                self.info('{0}: no runs in the last {1} days'.format(job,
+                    days))
+                continue
+
+            self.info('{0}: {1} runs ({2} full, {3} with errors) in the' \
+                ' last {4} days'.format(job, summary['runs'], summary['full'],
+                    summary['failed'], days))
+            if summary['last_error']:
+                self.info('{0}: last run failed, {1}'.format(job,
+                    summary['last_error']))
+            if 'source_size' not in summary:
+                continue
+            self.info('{0}: source {1}, growth {2}/day, delta ratio {3:.1%},' \
+                ' throughput {4}/s, duration {5:.0f}s -> {6:.0f}s'.format(
+                    job, self.human_byte(summary['source_size'] or 0),
+                    self.human_size(int(summary['growth_per_day'])),
+                    summary['delta_ratio'],
+                    self.human_byte(int(summary['throughput'])),
+                    summary['elapsed_first'] or 0,
+                    summary['elapsed_last'] or 0))
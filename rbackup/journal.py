@@ -0,0 +1,72 @@
+
+import json
+import os
+
+from rbackup import BaseClass
+
+class Journal(BaseClass):
+    """Records every snapshot and mount before it is made, so cleanup can
+    undo exactly those, also after a crash or a power loss. Every entry is
+    on disk before the action it describes is started"""
+    _journal_name = 'snapshots.journal'
+
+    def __init__(self, output, state_dir):
+        BaseClass.__init__(self, output)
+        self._state_dir = state_dir
+        self._journal_file = os.path.join(state_dir, self._journal_name)
+
+    def sync_dir(self):
+        dir_fd = os.open(self._state_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def record(self, action, path):
+        """Appends an entry for action on path and waits until it is on
+        disk"""
+        if not os.path.exists(self._state_dir):
+            os.makedirs(self._state_dir, 0700)
+
+        created = not os.path.exists(self._journal_file)
+        fd = open(self._journal_file, 'a')
+        fd.write(json.dumps({'action': action, 'path': path}) + '\n')
+        fd.flush()
+        os.fsync(fd.fileno())
+        fd.close()
+        if created:
+            self.sync_dir()
+
+    def entries(self):
+        """Returns all entries, oldest first. A crash while recording
+        leaves a partial last line, which is skipped"""
+        if not os.path.exists(self._journal_file):
+            return []
+
+        entries = []
+        for line in open(self._journal_file, 'r').readlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                self.debug('{0}: skipping partial entry'.format(
+                    self._journal_file))
+                continue
+            if 'action' in entry and 'path' in entry:
+                entries.append(entry)
+        return entries
+
+    def replace(self, entries):
+        """Atomically replaces the journal with entries, removing it when
+        there are none left"""
+        if not entries:
+            self.clear()
+            return
+
+        self.atomic_write(self._journal_file, ''.join([json.dumps(entry) +
+            '\n' for entry in entries]))
+
+    def clear(self):
+        if not os.path.exists(self._journal_file):
+            return
+        os.unlink(self._journal_file)
+        self.sync_dir()
@@ -0,0 +1,41 @@
+
+import errno
+import fcntl
+import os
+
+from rbackup import BaseClass
+
+class Lock(BaseClass):
+    """Exclusive lock taken by everything which creates or removes
+    snapshots, so a backup, a verification and a cleanup never run at the
+    same time. It is an flock, which the kernel drops when rbackup dies"""
+    _lock_name = 'rbackup.lock'
+
+    def __init__(self, output, state_dir, what):
+        BaseClass.__init__(self, output)
+        self._state_dir = state_dir
+        self._lock_file = os.path.join(state_dir, self._lock_name)
+        self._what = what
+        self._fd = None
+
+    def __enter__(self):
+        if not os.path.exists(self._state_dir):
+            os.makedirs(self._state_dir, 0700)
+
+        fd = open(self._lock_file, 'a')
+        try:
+            fcntl.flock(fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, errmsg:
+            fd.close()
+            if errmsg.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                raise
+            self.critical('Not running {0}'.format(self._what),
+                    'another backup, verification or cleanup is running')
+        self._fd = fd
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+        return False
@@ -1,25 +1,52 @@
 
 import os
-import re
 import time
 
 from rbackup import BaseClass
+from rbackup.journal import Journal
 
 class LVM(BaseClass):
-    _re_lv_path = re.compile('\ +LV Path\ .*\ (/.*)')
-    _re_lv_path = re.compile('\ +LV Name\ .*\ (/.*)')
-    _re_no_such_vg = re.compile('\ +Volume group .* not found')
-    _re_vg_pe_size = re.compile('.*PE Size.*\ ([0-9\.]+) MiB')
-    _re_vg_free_pe = re.compile('\ +Free  PE / Size.*\ ([0-9]+)\ .*')
-    _re_lvs_snapshot = re.compile('\ +([a-zA-Z0-9]+)_([0-9]+)\ .*')
+    _report_options = ['--noheadings', '--nosuffix', '--units', 'm',
+            '--separator', '|']
+
+    # lvm commands wait for locks held by other lvm commands, but never
+    # for this long
+    _lvm_timeout = 300
+    _mount_timeout = 60
+    _vgs_fields = ['vg_name', 'vg_size', 'vg_free', 'vg_extent_size',
+            'vg_extent_count', 'vg_free_count']
+    _lvs_fields = ['vg_name', 'lv_name', 'lv_path', 'lv_size', 'origin',
+            'data_percent', 'lv_attr', 'pool_lv', 'metadata_percent']
+    _usage_fields = ['lv_path', 'lv_size', 'data_percent', 'lv_attr']
+
+    # predicted snapshot sizes get this much headroom, and are never
+    # smaller than _min_snap_size MiB
+    _cow_margin = 1.5
+    _min_snap_size = 64
+
+    # thin snapshots are not taken when their pool is fuller than this
+    _d_thin_pool_max_data = 90.0
+    _d_thin_pool_max_metadata = 80.0
+
+    _d_state_dir = '/var/lib/rbackup'
 
     def __init__(self, output, filesystems, use_snapshots='auto', snap_size=1,
-            vg_name=None, snap_dir='/.snapshot'):
+            vg_name=None, snap_dir='/.snapshot', config=None, journal=None):
         BaseClass.__init__(self, output)
+        self._cfg = config or {}
+        self._journal = journal or Journal(output,
+                self._cfg.get('state_dir', self._d_state_dir))
         self._filesystems = filesystems
         self._vg_name = vg_name
         self._snap_size = snap_size
         self._snap_dir = snap_dir
+        self._vgs = {}
+        self._lvs = {}
+        self._lv_devices = {}
+        self._inventory_valid = False
+        self._write_rates = {}
+        self._duration = 0
+        self._created = []
         self.setup_snapshots(use_snapshots)
 
     def setup_snapshots(self, use_snapshots):
@@ -39,158 +66,358 @@ class LVM(BaseClass):
             elif self._vg_name not in all_vgs:
                 self.error('volume group {0} does not exist')
 
-    def get_vgs(self):
-        vgs = []
-        (retcode, output) = self.run('vgs')
-        for line in output[1:]:
-            try:
-                vgs.append(line.split()[0])
-            except IndexError:
+    def _report(self, command, fields):
+        cmd = [command] + self._report_options + ['-o', ','.join(fields)]
+        (retcode, output) = self.run(cmd, timeout=self._lvm_timeout)
+        if retcode != 0:
+            self.warning('{0} failed with exit code {1}'.format(
+                command, retcode))
+            return []
+
+        rows = []
+        for line in output:
+            values = [value.strip() for value in line.split('|')]
+            # stderr is mixed in with the report, skip anything which
+            # does not look like a row
+            if len(values) != len(fields):
                 continue
+            rows.append(dict(zip(fields, values)))
+        return rows
+
+    def mapper_path(self, vg, lv):
+        return '/dev/mapper/{0}-{1}'.format(vg.replace('-', '--'),
+                lv.replace('-', '--'))
+
+    def update_inventory(self):
+        vgs = {}
+        for row in self._report('vgs', self._vgs_fields):
+            vgs[row['vg_name']] = {
+                'size': float(row['vg_size']),
+                'free': float(row['vg_free']),
+                'extent_size': float(row['vg_extent_size']),
+                'extent_count': int(row['vg_extent_count']),
+                'free_count': int(row['vg_free_count']),
+            }
+
+        lvs = {}
+        lv_devices = {}
+        for row in self._report('lvs', self._lvs_fields):
+            vg = row['vg_name']
+            lv = row['lv_name']
+            name = '{0}/{1}'.format(vg, lv)
+            if row['data_percent']:
+                data_percent = float(row['data_percent'])
+            else:
+                data_percent = None
+            if row['metadata_percent']:
+                metadata_percent = float(row['metadata_percent'])
+            else:
+                metadata_percent = None
+            lvs[name] = {
+                'vg': vg,
+                'lv': lv,
+                'path': row['lv_path'] or '/dev/{0}'.format(name),
+                'mapper_path': self.mapper_path(vg, lv),
+                'size': float(row['lv_size']),
+                'origin': row['origin'] or None,
+                'data_percent': data_percent,
+                'metadata_percent': metadata_percent,
+                'attr': row['lv_attr'],
+                'pool': row['pool_lv'] or None,
+            }
+            lv_devices[lvs[name]['path']] = name
+            lv_devices[lvs[name]['mapper_path']] = name
+
+        self._vgs = vgs
+        self._lvs = lvs
+        self._lv_devices = lv_devices
+        self._inventory_valid = True
+
+    def invalidate_inventory(self):
+        self._inventory_valid = False
+
+    def forget_lv(self, device):
+        """Drops a removed volume from the inventory, so it does not have
+        to be reloaded"""
+        name = self._lv_devices.get(device)
+        if name not in self._lvs:
+            return
+        lv = self._lvs.pop(name)
+        for path in [lv['path'], lv['mapper_path']]:
+            self._lv_devices.pop(path, None)
+        # thin volumes return their space to the pool, not to the VG
+        vg = self._vgs.get(lv['vg'])
+        if vg and lv['pool'] is None and vg['extent_size']:
+            vg['free'] += lv['size']
+            vg['free_count'] += int(round(lv['size'] / vg['extent_size']))
+
+    def _inventory(self):
+        if not self._inventory_valid:
+            self.update_inventory()
+
+    def get_lv(self, device):
+        self._inventory()
+        try:
+            return self._lvs[self._lv_devices[device]]
+        except KeyError:
+            return None
+
+    def get_vgs(self):
+        self._inventory()
+        vgs = self._vgs.keys()
+        vgs.sort()
         return vgs
 
     def get_lvs(self, vg):
-        lvs = []
-        (retcode, output) = self.run('lvs')
-        for line in output[1:]:
-            try:
-                lvs.append(line.split()[0])
-            except IndexError:
-                continue
+        self._inventory()
+        lvs = [lv['lv'] for lv in self._lvs.values() if lv['vg'] == vg]
+        lvs.sort()
         return lvs
 
     def is_lv(self, name):
-        cmd = 'lvdisplay {0}'.format(name)
-        (retcode, result) = self.run(cmd)
-        return len(result) > 3
-
-    def list_snapshots(self):
-        snapshot_timestamps = []
-        (retcode, output) = self.run('lvs')
-        for line in output:
-            match = self._re_lvs_snapshot.search(line)
-            if match:
-                timestamp = match.group(2)
-                if timestamp not in snapshot_timestamps:
-                    snapshot_timestamps.append(timestamp)
-        snapshot_timestamps.sort()
-        return snapshot_timestamps
+        return self.get_lv(name) is not None
+
+    def is_thin(self, lv):
+        """Thin volumes have V as first lv_attr character"""
+        return lv['attr'][:1] == 'V' and lv['pool'] is not None
+
+    def check_thin_pools(self, lvs):
+        """Thin snapshots need no free space in the VG, but share the
+        data and metadata space of the pool of their origin. Returns False
+        when a pool is too full to take snapshots"""
+        max_data = self._cfg.get('thin_pool_max_data',
+                self._d_thin_pool_max_data)
+        max_metadata = self._cfg.get('thin_pool_max_metadata',
+                self._d_thin_pool_max_metadata)
+
+        pools = set(['{0}/{1}'.format(lv['vg'], lv['pool']) for lv in lvs])
+        for name in sorted(pools):
+            pool = self._lvs.get(name)
+            if not pool:
+                self.warning('thin pool {0} not found'.format(name))
+                return False
+            if (pool['data_percent'] or 0) > max_data:
+                self.warning('thin pool {0} data is {1:.0f}% full'.format(
+                    name, pool['data_percent']))
+                return False
+            if (pool['metadata_percent'] or 0) > max_metadata:
+                self.warning('thin pool {0} metadata is {1:.0f}%' \
+                    ' full'.format(name, pool['metadata_percent']))
+                return False
+        return True
 
     def get_free_vg_space(self, vg_name):
-        cmd = 'vgdisplay {0}'.format(vg_name)
-        (retcode, output) = self.run(cmd)
-        pe_size = 0
-        free_pe = -1
-        for line in output:
-            match = self._re_no_such_vg.search(line)
-            if match:
-                self.error('no such VG: {0}'.format(vg_name))
+        self._inventory()
+        if vg_name not in self._vgs:
+            self.error('no such VG: {0}'.format(vg_name))
 
-            match = self._re_vg_pe_size.search(line)
-            if match:
-                pe_size = float(match.group(1))
-
-            match = self._re_vg_free_pe.search(line)
-            if match:
-                free_pe = float(match.group(1))
-
-        if pe_size == 0:
+        vg = self._vgs[vg_name]
+        if vg['extent_size'] == 0:
             self.error('PE size of VG is 0')
 
-        return int(round(pe_size * free_pe))
-
-    def mksnapshot(self, mountpoint, mount_data, timestamp):
+        return int(round(vg['extent_size'] * vg['free_count']))
+
+    def set_write_rates(self, write_rates, duration):
+        """Size snapshots for the writes expected on their origin while
+        a backup of duration seconds runs, instead of using a fixed size"""
+        self._write_rates = write_rates
+        self._duration = duration
+
+    def get_snapshot_size(self, lv):
+        """Snapshot size in MiB for lv"""
+        if not self._duration:
+            return self._snap_size
+
+        try:
+            st = os.stat(lv['path'])
+        except OSError:
+            return self._snap_size
+        devno = '{0}:{1}'.format(os.major(st.st_rdev), os.minor(st.st_rdev))
+        if devno not in self._write_rates:
+            return self._snap_size
+
+        size = self._write_rates[devno] * self._duration * self._cow_margin
+        size = int(size / (1024 * 1024)) + 1
+        return int(min(max(size, self._min_snap_size), lv['size']))
+
+    def get_created_snapshots(self):
+        return self._created
+
+    def get_usage(self, paths):
+        """Returns path -> (size, data_percent, attr) of the given LVs,
+        without touching the cached inventory"""
+        cmd = ['lvs'] + self._report_options + ['-o',
+                ','.join(self._usage_fields)] + paths
+        (retcode, output) = self.run(cmd, timeout=self._lvm_timeout)
+
+        usage = {}
+        for line in output:
+            values = [value.strip() for value in line.split('|')]
+            if len(values) != len(self._usage_fields):
+                continue
+            try:
+                usage[values[0]] = (float(values[1]),
+                        float(values[2] or 0), values[3])
+            except ValueError:
+                continue
+        return usage
+
+    def extend_snapshot(self, path, size):
+        """Grow the snapshot at path by size MiB"""
+        cmd = ['lvextend', '-L', '+{0}M'.format(int(size)), path]
+        (retcode, output) = self.run(cmd, timeout=self._lvm_timeout)
+        self.invalidate_inventory()
+        if retcode != 0:
+            self.warning('failed to extend {0}: {1}'.format(path,
+                ', '.join(output)))
+            return False
+        return True
+
+    def mkthinsnapshot(self, lv, snap_lv_name):
+        """Thin snapshots have no size and no copy-on-write penalty, but
+        are created with the activation skip flag set"""
+        cmd = ['lvcreate', '-s', '-n', snap_lv_name,
+               '{0}/{1}'.format(lv['vg'], lv['lv'])]
+        self.run(cmd, timeout=self._lvm_timeout)
+
+        cmd = ['lvchange', '-ay', '-K', '{0}/{1}'.format(lv['vg'],
+            snap_lv_name)]
+        self.run(cmd, timeout=self._lvm_timeout)
+
+    def mksnapshot(self, mountpoint, mount_data, lv, timestamp, size=None):
         snap_mountpoint = self._snap_dir + mountpoint
 
-        device = self._filesystems[mountpoint]['device']
-        if '/mapper/' in device:
-            lv_name = os.path.basename(device).split('-')[1]
-        else:
-            lv_name = os.path.basename(device)
-        print('device: {0}; lv_name: {1}'.format(device, lv_name))
-
-        snap_lv_name = '{0}_{1}'.format(lv_name, timestamp)
-        snap_lv_device = '{0}_{1}'.format(
-                self._filesystems[mountpoint]['device'], timestamp)
+        snap_lv_name = '{0}_{1}'.format(lv['lv'], timestamp)
+        snap_lv_device = '/dev/{0}/{1}'.format(lv['vg'], snap_lv_name)
 
         self.debug('snap_lv_name: {0}'.format(snap_lv_name))
         if not os.path.exists(mountpoint):
             self.error('{0} not found'.format(mountpoint))
 
-        if self.is_lv(snap_lv_device):
+        if '{0}/{1}'.format(lv['vg'], snap_lv_name) in self._lvs:
             self.warning('snapshot already exists')
             return
 
-        cmd = 'lvcreate -L {0}M -s -n {1} {2}'.format(
-            self._snap_size,
-            snap_lv_name,
-            mount_data['device'])
+        self._journal.record('lvcreate', snap_lv_device)
+        if self.is_thin(lv):
+            self.debug('{0}: thin snapshot'.format(snap_lv_name))
+            self.mkthinsnapshot(lv, snap_lv_name)
+            size = None
+        else:
+            if size is None:
+                size = self._snap_size
+            self.debug('{0}: {1}M snapshot'.format(snap_lv_name, size))
+
+            cmd = ['lvcreate', '-L', '{0}M'.format(size), '-s',
+                   '-n', snap_lv_name, lv['path']]
+            self.run(cmd, timeout=self._lvm_timeout)
 
-        self.run(cmd)
+        self.invalidate_inventory()
+        self._created.append({'path': snap_lv_device, 'origin': lv['path'],
+            'mountpoint': mountpoint, 'size': size, 'thin': size is None})
 
         if mount_data['fstype'] == 'xfs':
-            cmd = 'mount -o ro,nouuid {0} {1}'.format(snap_lv_device,
-                    snap_mountpoint)
+            cmd = ['mount', '-o', 'ro,nouuid', snap_lv_device,
+                   snap_mountpoint]
         else:
-            cmd = 'mount -o ro {0} {1}'.format(snap_lv_device, snap_mountpoint)
+            cmd = ['mount', '-o', 'ro', snap_lv_device, snap_mountpoint]
 
-        self.run(cmd)
+        self._journal.record('mount', snap_mountpoint)
+        self.run(cmd, timeout=self._mount_timeout)
 
     def do_bind_mount(self, mountpoint):
         snap_mountpoint = self._snap_dir + mountpoint
-        cmd = 'mount --bind -o ro {0} {1}'.format(mountpoint, snap_mountpoint)
-        self.run(cmd)
+        self._journal.record('mount', snap_mountpoint)
+        cmd = ['mount', '--bind', '-o', 'ro', mountpoint, snap_mountpoint]
+        self.run(cmd, timeout=self._mount_timeout)
 
     def create_snapshots(self):
         mountpoints = self._filesystems.keys()
         mountpoints.sort()
 
-        free_vg_space = self.get_free_vg_space(self._vg_name)
-
-        num_filesystems = len(self._filesystems.keys())
-        if (num_filesystems * self._snap_size) > (free_vg_space):
-            self.error('not enough free space in VG {0}'.format(self._vg_name))
-
         if not os.path.exists(self._snap_dir):
             os.mkdir(self._snap_dir)
 
         if '/' not in mountpoints:
             self.error('root filesystem not found')
 
-        timestamp = int(time.time())
+        # resolve all devices against a single inventory before any
+        # lvcreate invalidates it
+        lvs = {}
+        sizes = {}
         for mountpoint in mountpoints:
-            device = self._filesystems[mountpoint]['device']
+            lvs[mountpoint] = self.get_lv(
+                    self._filesystems[mountpoint]['device'])
+            if lvs[mountpoint] and not self.is_thin(lvs[mountpoint]):
+                sizes[mountpoint] = self.get_snapshot_size(lvs[mountpoint])
+
+        free_vg_space = self.get_free_vg_space(self._vg_name)
+        if sum(sizes.values()) > free_vg_space:
+            self.error('not enough free space in VG {0}'.format(self._vg_name))
 
-            if self.is_lv(device):
+        thin_lvs = [lv for lv in lvs.values() if lv and self.is_thin(lv)]
+        if thin_lvs and not self.check_thin_pools(thin_lvs):
+            self.error('not enough free space in thin pool')
+
+        self._created = []
+        timestamp = int(time.time())
+        for mountpoint in mountpoints:
+            if lvs[mountpoint]:
                 self.mksnapshot(mountpoint, self._filesystems[mountpoint],
-                        timestamp)
+                        lvs[mountpoint], timestamp, sizes.get(mountpoint))
             else:
                 self.do_bind_mount(mountpoint)
 
         self._filesystems.update()
         return timestamp
 
-    def cleanup_snapshots(self):
-        mountpoints = self._filesystems.keys()
-        mountpoints.sort(reverse=True)
+    def is_mounted(self, path):
+        path = path.rstrip('/') or '/'
+        return path in [m.rstrip('/') or '/' for m in self._filesystems.keys()]
 
-        for mountpoint in mountpoints:
-            if mountpoint.startswith('/.snapshot'):
-                if mountpoint.endswith('/'):
-                    mountpoint = mountpoint[:len(mountpoint)-1]
-                cmd = 'umount -f {0}'.format(mountpoint)
-                self.run(cmd)
+    def cleanup_snapshots(self):
+        """Undoes the mounts and snapshots recorded in the journal, newest
+        first. Entries which could not be undone stay in the journal for
+        the next cleanup, anything not in it is never touched"""
+        entries = self._journal.entries()
+        if not entries:
+            self._created = []
+            return
 
+        # the inventory is loaded once, removed volumes are dropped from it
+        # and it is only reloaded when lvremove fails
+        failed = []
         self._filesystems.update()
-        mountpoints = self._filesystems.keys()
-        mountpoints.sort(reverse=True)
-
-        snapshot_timestamps = self.list_snapshots()
-        for mountpoint in mountpoints:
-            device = self._filesystems[mountpoint]['device']
-            for timestamp in snapshot_timestamps:
-                snap_device = '{0}_{1}'.format(device, timestamp)
-                if self.is_lv(snap_device):
-                    cmd = 'lvremove -f {0}'.format(snap_device)
-                    print(cmd)
-                    self.run(cmd)
+        self._inventory()
+        for entry in reversed(entries):
+            path = entry['path']
+            if entry['action'] == 'mount':
+                if not self.is_mounted(path):
+                    continue
+                cmd = ['umount', '-f', path.rstrip('/') or '/']
+                (retcode, output) = self.run(cmd,
+                        timeout=self._mount_timeout)
+                self._filesystems.update()
+                if self.is_mounted(path):
+                    self.warning('failed to unmount {0}: {1}'.format(path,
+                        ', '.join(output)))
+                    failed.insert(0, entry)
+
+            elif entry['action'] == 'lvcreate':
+                # the lvs report also lists volumes which are not active,
+                # as is the case early during boot
+                if not self.is_lv(path):
+                    continue
+                cmd = ['lvremove', '-f', path]
+                (retcode, output) = self.run(cmd, timeout=self._lvm_timeout)
+                if retcode == 0:
+                    self.forget_lv(path)
+                    continue
+                self.invalidate_inventory()
+                if self.is_lv(path):
+                    self.warning('failed to remove {0}: {1}'.format(path,
+                        ', '.join(output)))
+                    failed.insert(0, entry)
+
+        self._journal.replace(failed)
+        self._created = []
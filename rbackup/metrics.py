@@ -0,0 +1,150 @@
+
+import json
+import threading
+import time
+
+from rbackup import atomic_write
+
+class NullSpan:
+    """Span used when metrics are disabled, it does nothing"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, key, value):
+        pass
+
+class Span:
+    def __init__(self, metrics, name, kind):
+        self._metrics = metrics
+        self._name = name
+        self._kind = kind
+        self._start = None
+        self._attrs = {}
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        success = exc_type is None and self._attrs.get('returncode', 0) == 0
+        self._metrics.add(self._name, self._kind, self._start,
+                time.time() - self._start, success, self._attrs)
+        return False
+
+    def set(self, key, value):
+        self._attrs[key] = value
+
+class Metrics:
+    """Records the duration of the phases of a run and of every command it
+    executes, and exports them as JSON and as node_exporter textfile"""
+    _prefix = 'rbackup'
+
+    def __init__(self):
+        self._start = time.time()
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def span(self, name, kind='phase'):
+        return Span(self, name, kind)
+
+    def add(self, name, kind, start, duration, success=True, attrs=None):
+        span = {
+            'name': name,
+            'kind': kind,
+            'start': start,
+            'duration': duration,
+            'success': success,
+            'thread': threading.current_thread().name,
+        }
+        if attrs:
+            span.update(attrs)
+        with self._lock:
+            self._spans.append(span)
+
+    def get_report(self):
+        phases = {}
+        commands = {}
+        for span in self._spans:
+            if span['kind'] == 'phase':
+                phases[span['name']] = phases.get(span['name'], 0) + \
+                        span['duration']
+            elif span['kind'] == 'command':
+                command = commands.setdefault(span['name'],
+                        {'count': 0, 'duration': 0, 'failed': 0,
+                         'cpu_user': 0, 'cpu_system': 0})
+                command['count'] += 1
+                command['duration'] += span['duration']
+                command['cpu_user'] += span.get('cpu_user', 0)
+                command['cpu_system'] += span.get('cpu_system', 0)
+                if not span['success']:
+                    command['failed'] += 1
+
+        return {
+            'start': self._start,
+            'duration': time.time() - self._start,
+            'phases': phases,
+            'commands': commands,
+            'spans': self._spans,
+        }
+
+    def write_json(self, fname):
+        atomic_write(fname, json.dumps(self.get_report(), indent=2))
+
+    def get_textfile(self):
+        report = self.get_report()
+        p = self._prefix
+        lines = [
+            '# HELP {0}_run_duration_seconds Wall clock time of the last' \
+                ' run.'.format(p),
+            '# TYPE {0}_run_duration_seconds gauge'.format(p),
+            '{0}_run_duration_seconds {1:.6f}'.format(p, report['duration']),
+            '# HELP {0}_last_run_timestamp_seconds Start of the last' \
+                ' run.'.format(p),
+            '# TYPE {0}_last_run_timestamp_seconds gauge'.format(p),
+            '{0}_last_run_timestamp_seconds {1:.3f}'.format(p,
+                report['start']),
+            '# HELP {0}_phase_duration_seconds Time spent per phase of the' \
+                ' last run.'.format(p),
+            '# TYPE {0}_phase_duration_seconds gauge'.format(p),
+        ]
+        for name in sorted(report['phases']):
+            lines.append('{0}_phase_duration_seconds{{phase="{1}"}}' \
+                ' {2:.6f}'.format(p, name, report['phases'][name]))
+
+        lines.extend([
+            '# HELP {0}_command_duration_seconds Time spent per command in' \
+                ' the last run.'.format(p),
+            '# TYPE {0}_command_duration_seconds gauge'.format(p),
+        ])
+        for name in sorted(report['commands']):
+            lines.append('{0}_command_duration_seconds{{command="{1}"}}' \
+                ' {2:.6f}'.format(p, name,
+                    report['commands'][name]['duration']))
+
+        lines.extend([
+            '# HELP {0}_commands Number of commands executed in the last' \
+                ' run.'.format(p),
+            '# TYPE {0}_commands gauge'.format(p),
+        ])
+        for name in sorted(report['commands']):
+            lines.append('{0}_commands{{command="{1}"}} {2}'.format(p, name,
+                report['commands'][name]['count']))
+
+        lines.extend([
+            '# HELP {0}_command_cpu_seconds CPU time used per command in' \
+                ' the last run.'.format(p),
+            '# TYPE {0}_command_cpu_seconds gauge'.format(p),
+        ])
+        for name in sorted(report['commands']):
+            for mode in ['user', 'system']:
+                lines.append('{0}_command_cpu_seconds{{command="{1}",' \
+                    'mode="{2}"}} {3:.6f}'.format(p, name, mode,
+                        report['commands'][name]['cpu_' + mode]))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, fname):
+        atomic_write(fname, self.get_textfile())
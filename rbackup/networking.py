@@ -1,10 +1,13 @@
 
+import binascii
+import bisect
+import errno
 import os
 import re
-import shlex
+import select
 import socket
-
-from ipcalc import IPCalc
+import struct
+import time
 
 from rbackup import BaseClass
 
@@ -13,82 +16,372 @@ class Networking(BaseClass):
     _re_ipv4_address = re.compile('^[0-9]: [A-Za-z0-9-_]* +inet\ ([0-9./]*) .* scope global')
     _re_ipv6_address = re.compile('^[0-9]: [A-Za-z0-9-_]* +inet6\ ([0-9a-f:/]*) scope global')
 
+    _families = {
+        socket.AF_INET: 'ipv4',
+        socket.AF_INET6: 'ipv6',
+    }
+
+    # rtnetlink, see linux/netlink.h and linux/rtnetlink.h
+    _netlink_route = 0
+    _nlmsg_error = 2
+    _nlmsg_done = 3
+    _rtm_newaddr = 20
+    _rtm_getaddr = 22
+    _nlm_f_request = 0x01
+    _nlm_f_dump = 0x300
+    _ifa_address = 1
+    _ifa_local = 2
+    _rt_scope_universe = 0
+    _rtmgrp_ipv4_ifaddr = 0x10
+    _rtmgrp_ipv6_ifaddr = 0x100
+    _rtm_deladdr = 21
+
+    # RFC 8305 connection attempt delay
+    _attempt_delay = 0.25
+    _d_connect_timeout = 5
+    _ip_timeout = 10
+
     def __init__(self, output, config):
         BaseClass.__init__(self, output)
         self._cfg = config
-        self._ipcalc = IPCalc()
+        self._runon_networks = None
+        self._connect_rtt = {}
 
     def getaddrinfo(self, fqdn):
         addresses = []
+        seen = []
         try:
-            for addrinfo in socket.getaddrinfo(fqdn, 22):
-                addr = addrinfo[4][0]
-                if addr not in addresses:
-                    addresses.append(addr)
+            for addrinfo in socket.getaddrinfo(fqdn, 22, 0,
+                    socket.SOCK_STREAM):
+                (family, socktype, proto, canonname, sockaddr) = addrinfo
+                if family not in self._families or sockaddr[0] in seen:
+                    continue
+                seen.append(sockaddr[0])
+                addresses.append((family, sockaddr))
         except socket.gaierror, errmsg:
             self.warning('getaddrinfo({0}): {1}'.format(fqdn, errmsg))
 
         return addresses
 
-    def connect(self, addr, af):
-        if af == 6:
-            s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM, 0)
-            t = (addr, 22, 0, 0)
-        elif af == 4:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            t = (addr, 22)
-        else:
-            self.warning('unknown address family')
-            return False
+    def interleave(self, addresses):
+        """Order addresses as per RFC 8305, alternating address families
+        starting with the family of the first address"""
+        if len(addresses) == 0:
+            return []
 
-        try:
-            s.connect(t)
-        except socket.error, errmsg:
-            self.warning('connect({0}): {1}'.format(addr, errmsg))
-            return False
-        except socket.gaierror, errmsg:
-            self.warning('connect({0}): {1}'.format(addr, errmsg))
-            return False
+        first = [a for a in addresses if a[0] == addresses[0][0]]
+        other = [a for a in addresses if a[0] != addresses[0][0]]
 
-        return True
+        ordered = []
+        for i in range(max(len(first), len(other))):
+            ordered.extend(first[i:i+1])
+            ordered.extend(other[i:i+1])
+        return ordered
 
-    def server_is_alive(self):
+    def connect(self, family, sockaddr):
+        s = socket.socket(family, socket.SOCK_STREAM)
+        s.setblocking(0)
+        err = s.connect_ex(sockaddr)
+        if err not in [0, errno.EINPROGRESS]:
+            self.warning('connect({0}): {1}'.format(sockaddr[0],
+                os.strerror(err)))
+            s.close()
+            return None
+        return s
+
+    def server_is_alive(self, host=None):
+        if not host:
+            host = self._cfg['remote_host']
         result = {'ipv4': False, 'ipv6': False}
-        addresses = self.getaddrinfo(self._cfg['remote_host'])
-        for address in addresses:
-            if ':' in address:
-                result['ipv6'] = self.connect(address, 6)
-            else:
-                result['ipv4'] = self.connect(address, 4)
+        connect_rtt = {'ipv4': None, 'ipv6': None}
+        self._connect_rtt[host] = connect_rtt
+        deadline = float(self._cfg.get('connect_timeout',
+                self._d_connect_timeout))
+
+        pending = self.interleave(self.getaddrinfo(host))
+        families = set([self._families[a[0]] for a in pending])
+        attempts = {}
+
+        start = time.time()
+        next_attempt = start
+        try:
+            while pending or attempts:
+                now = time.time()
+                if now - start >= deadline:
+                    for (family, sockaddr, t_start) in attempts.values():
+                        self.warning('connect({0}): timed out'.format(
+                            sockaddr[0]))
+                    break
+
+                # stagger new attempts, but start the next one right away
+                # when nothing is in flight anymore
+                if pending and (now >= next_attempt or not attempts):
+                    (family, sockaddr) = pending.pop(0)
+                    s = self.connect(family, sockaddr)
+                    if s:
+                        attempts[s] = (family, sockaddr, time.time())
+                    next_attempt = time.time() + self._attempt_delay
+                    continue
+
+                timeout = start + deadline - now
+                if pending:
+                    timeout = min(timeout, next_attempt - now)
+
+                (_, writable, _) = select.select([], attempts.keys(), [],
+                        max(timeout, 0))
+                for s in writable:
+                    (family, sockaddr, t_start) = attempts.pop(s)
+                    err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    s.close()
+                    if err != 0:
+                        self.warning('connect({0}): {1}'.format(sockaddr[0],
+                            os.strerror(err)))
+                        continue
+
+                    af = self._families[family]
+                    rtt = time.time() - t_start
+                    self.debug('connect({0}): {1:.3f}s'.format(sockaddr[0],
+                        rtt))
+                    if not result[af] or rtt < connect_rtt[af]:
+                        connect_rtt[af] = rtt
+                    result[af] = True
+
+                # done once every resolved family has a working address
+                if all([result[af] for af in families]):
+                    break
+        finally:
+            for s in attempts.keys():
+                s.close()
+
         return result
 
-    def get_ipaddresses(self):
+    def fastest_transport(self, host):
+        """The address family which connected fastest to host when it was
+        last probed, or None"""
+        rtts = [(rtt, af) for af, rtt in
+                self._connect_rtt.get(host, {}).items() if rtt is not None]
+        if len(rtts) == 0:
+            return None
+        return min(rtts)[1]
+
+    def _netlink_addresses(self):
+        """Dump all global scope addresses using rtnetlink"""
+        s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                self._netlink_route)
+        try:
+            s.bind((0, 0))
+            request = struct.pack('=IHHII', 24, self._rtm_getaddr,
+                    self._nlm_f_request | self._nlm_f_dump, 1, 0)
+            request += struct.pack('=BBBBI', socket.AF_UNSPEC, 0, 0, 0, 0)
+            s.send(request)
+
+            addresses = []
+            done = False
+            while not done:
+                data = s.recv(65536)
+                offset = 0
+                while offset + 16 <= len(data):
+                    (msg_len, msg_type, flags, seq, pid) = struct.unpack_from(
+                            '=IHHII', data, offset)
+                    if msg_len < 16:
+                        done = True
+                        break
+                    if msg_type == self._nlmsg_done:
+                        done = True
+                        break
+                    elif msg_type == self._nlmsg_error:
+                        raise socket.error('RTM_GETADDR failed')
+                    elif msg_type == self._rtm_newaddr:
+                        address = self._parse_ifaddrmsg(
+                                data[offset+16:offset+msg_len])
+                        if address:
+                            addresses.append(address)
+                    offset += (msg_len + 3) & ~3
+        finally:
+            s.close()
+
+        return addresses
+
+    def _parse_ifaddrmsg(self, data):
+        (family, prefixlen, flags, scope, index) = struct.unpack_from(
+                '=BBBBI', data)
+        if family not in self._families or scope != self._rt_scope_universe:
+            return
+
+        attrs = {}
+        offset = 8
+        while offset + 4 <= len(data):
+            (rta_len, rta_type) = struct.unpack_from('=HH', data, offset)
+            if rta_len < 4:
+                break
+            attrs[rta_type] = data[offset+4:offset+rta_len]
+            offset += (rta_len + 3) & ~3
+
+        # IFA_LOCAL is the local address on point-to-point links
+        packed = attrs.get(self._ifa_local, attrs.get(self._ifa_address))
+        if not packed:
+            return
+        return (family, packed, prefixlen)
+
+    def _ip_addresses(self):
         addresses = []
-        command_line = '/sbin/ip -o address show'
-        (retcode, output) = self.run(command_line)
+        (retcode, output) = self.run(['/sbin/ip', '-o', 'address', 'show'],
+                timeout=self._ip_timeout)
         if not output:
             return []
 
         for line in output:
             match = self._re_ipv4_address.search(line)
-            if match:
-                address = match.group(1)
-                if address not in addresses:
-                    addresses.append(address)
+            if not match:
+                match = self._re_ipv6_address.search(line)
+            if not match:
                 continue
-            match = self._re_ipv6_address.search(line)
-            if match:
-                address = match.group(1)
-                if address not in addresses:
-                    addresses.append(address)
+            (address, prefixlen) = match.group(1).split('/')
+            if ':' in address:
+                family = socket.AF_INET6
+            else:
+                family = socket.AF_INET
+            addresses.append((family, socket.inet_pton(family, address),
+                int(prefixlen)))
+
+        return addresses
+
+    def _local_addresses(self):
+        try:
+            return self._netlink_addresses()
+        except socket.error, errmsg:
+            self.warning('rtnetlink: {0}, falling back to ip'.format(errmsg))
+            return self._ip_addresses()
+
+    def get_ipaddresses(self):
+        addresses = []
+        for (family, packed, prefixlen) in self._local_addresses():
+            address = '{0}/{1}'.format(socket.inet_ntop(family, packed),
+                    prefixlen)
+            if address not in addresses:
+                addresses.append(address)
 
         addresses.sort()
         return addresses
 
+    def get_network_prefix(self, family, packed, prefixlen):
+        bits = len(packed) * 8
+        host_mask = (1 << (bits - prefixlen)) - 1
+        network = '{0:0{1}x}'.format(self._to_int(packed) & ~host_mask,
+                len(packed) * 2)
+        return '{0}/{1}'.format(socket.inet_ntop(family,
+            binascii.unhexlify(network)), prefixlen)
+
+    def get_network_id(self):
+        """Identifies the trusted networks this host is on, used as cache
+        key for per-network measurements. Only the network prefixes are
+        used, as host addresses change with every DHCP lease or IPv6
+        privacy address"""
+        runon_networks = self.get_runon_networks()
+        prefixes = []
+        for (family, packed, prefixlen) in self._local_addresses():
+            if not self.in_networks(runon_networks, family, packed):
+                continue
+            prefix = self.get_network_prefix(family, packed, prefixlen)
+            if prefix not in prefixes:
+                prefixes.append(prefix)
+
+        prefixes.sort()
+        return ','.join(prefixes)
+
+    def _to_int(self, packed):
+        return int(binascii.hexlify(packed), 16)
+
+    def compile_networks(self, networks):
+        """Merge networks into sorted, non-overlapping (start, end) ranges
+        per address family, so matching an address is a single bisect"""
+        ranges = {socket.AF_INET: [], socket.AF_INET6: []}
+        for network in networks:
+            if '/' in network:
+                (address, prefixlen) = network.split('/')
+            else:
+                (address, prefixlen) = (network, None)
+
+            if ':' in address:
+                family = socket.AF_INET6
+            else:
+                family = socket.AF_INET
+
+            try:
+                packed = socket.inet_pton(family, address)
+            except socket.error:
+                self.warning('invalid network {0}'.format(network))
+                continue
+
+            bits = len(packed) * 8
+            if prefixlen is None:
+                prefixlen = bits
+            host_mask = (1 << (bits - int(prefixlen))) - 1
+            start = self._to_int(packed) & ~host_mask
+            ranges[family].append((start, start | host_mask))
+
+        compiled = {}
+        for family, family_ranges in ranges.items():
+            family_ranges.sort()
+            starts = []
+            ends = []
+            for (start, end) in family_ranges:
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                    continue
+                starts.append(start)
+                ends.append(end)
+            compiled[family] = (starts, ends)
+
+        return compiled
+
+    def in_networks(self, compiled, family, packed):
+        (starts, ends) = compiled[family]
+        address = self._to_int(packed)
+        i = bisect.bisect_right(starts, address) - 1
+        return i >= 0 and address <= ends[i]
+
+    def subscribe_addresses(self):
+        """Returns a netlink socket which receives a message whenever an
+        address is added or removed"""
+        try:
+            s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                    self._netlink_route)
+            s.bind((0, self._rtmgrp_ipv4_ifaddr | self._rtmgrp_ipv6_ifaddr))
+        except socket.error, errmsg:
+            self.warning('failed to listen for address changes: {0}'.format(
+                errmsg))
+            return None
+        s.setblocking(0)
+        return s
+
+    def read_address_events(self, s):
+        """Drains the socket, returns True if any address changed"""
+        changed = False
+        while True:
+            try:
+                data = s.recv(65536)
+            except socket.error:
+                break
+            offset = 0
+            while offset + 16 <= len(data):
+                (msg_len, msg_type) = struct.unpack_from('=IH', data, offset)
+                if msg_len < 16:
+                    break
+                if msg_type in [self._rtm_newaddr, self._rtm_deladdr]:
+                    changed = True
+                offset += (msg_len + 3) & ~3
+        return changed
+
+    def get_runon_networks(self):
+        if self._runon_networks is None:
+            self._runon_networks = self.compile_networks(
+                    self._cfg['runon_networks'])
+        return self._runon_networks
+
     def on_runon_network(self):
-        addresses = self.get_ipaddresses()
-        for network in self._cfg['runon_networks']:
-            for address in addresses:
-                if self._ipcalc.in_network(address, network):
-                    return True
+        runon_networks = self.get_runon_networks()
+        for (family, packed, prefixlen) in self._local_addresses():
+            if self.in_networks(runon_networks, family, packed):
+                return True
         return False
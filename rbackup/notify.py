@@ -0,0 +1,206 @@
+
+import atexit
+import socket
+import threading
+import time
+
+class Sink:
+    """Delivers notifications somewhere, send() may block for at most
+    timeout seconds"""
+    name = 'none'
+
+    def __init__(self, logger, config):
+        self._logger = logger
+        self._cfg = config
+
+    def send(self, urgency, title, msg, timeout):
+        pass
+
+class DbusSink(Sink):
+    """Desktop notifications through notificationd"""
+    name = 'dbus'
+    _bus_name = 'net.as65342.notifications'
+    _bus_path = '/net/as65342/notifications'
+
+    # after a failure to reach notificationd, wait this long before trying
+    # to connect again
+    _retry_interval = 60
+
+    def __init__(self, logger, config):
+        Sink.__init__(self, logger, config)
+        self._notificationd = None
+        self._next_attempt = 0
+
+    def connect(self):
+        if self._notificationd:
+            return self._notificationd
+        if time.time() < self._next_attempt:
+            return None
+
+        try:
+            import dbus
+            bus = dbus.SystemBus()
+            self._notificationd = bus.get_object(self._bus_name,
+                    self._bus_path)
+        except Exception, errmsg:
+            self._logger.debug('notificationd: {0}'.format(errmsg))
+            self._next_attempt = time.time() + self._retry_interval
+        return self._notificationd
+
+    def send(self, urgency, title, msg, timeout):
+        notificationd = self.connect()
+        if not notificationd:
+            return
+        try:
+            getattr(notificationd, urgency)(title, msg, timeout=timeout)
+        except Exception, errmsg:
+            self._logger.debug('notificationd: {0}'.format(errmsg))
+            self._notificationd = None
+            self._next_attempt = time.time() + self._retry_interval
+
+class SyslogSink(Sink):
+    name = 'syslog'
+
+    def __init__(self, logger, config):
+        Sink.__init__(self, logger, config)
+        import syslog
+        self._syslog = syslog
+        self._priorities = {
+            'low': syslog.LOG_INFO,
+            'normal': syslog.LOG_NOTICE,
+            'critical': syslog.LOG_CRIT,
+        }
+        syslog.openlog('rbackup', 0, syslog.LOG_DAEMON)
+
+    def send(self, urgency, title, msg, timeout):
+        if msg:
+            title = '{0}: {1}'.format(title, msg)
+        self._syslog.syslog(self._priorities[urgency], title)
+
+class MailSink(Sink):
+    """Mails normal and critical notifications to mail_to"""
+    name = 'mail'
+    _d_smtp_host = 'localhost'
+
+    def send(self, urgency, title, msg, timeout):
+        if urgency == 'low' or not self._cfg.get('mail_to'):
+            return
+
+        import smtplib
+        from email.mime.text import MIMEText
+
+        mail_from = self._cfg.get('mail_from') or \
+                'rbackup@{0}'.format(socket.getfqdn())
+        message = MIMEText(msg or title)
+        message['Subject'] = 'rbackup: {0}'.format(title)
+        message['From'] = mail_from
+        message['To'] = self._cfg.get('mail_to')
+
+        try:
+            smtp = smtplib.SMTP(self._cfg.get('smtp_host', self._d_smtp_host),
+                    timeout=timeout)
+            smtp.sendmail(mail_from, [self._cfg.get('mail_to')],
+                    message.as_string())
+            smtp.quit()
+        except (smtplib.SMTPException, socket.error), errmsg:
+            self._logger.debug('mail: {0}'.format(errmsg))
+
+class Notifier:
+    """Delivers notifications from a background thread, so a slow or
+    missing notification service never holds up a backup. Notifications
+    with the same urgency and title which are still queued are coalesced:
+    a newer low or normal one replaces the queued one, since it reports
+    the current state, while the messages of critical ones are merged so
+    no error gets lost. The oldest ones are dropped when the queue is
+    full"""
+    _sink_types = {
+        'none': Sink,
+        'dbus': DbusSink,
+        'syslog': SyslogSink,
+        'mail': MailSink,
+    }
+
+    _max_queued = 32
+    _send_timeout = 5
+
+    # notifications still queued at exit get this long to be delivered
+    _flush_timeout = 5
+
+    def __init__(self, logger, config=None):
+        self._logger = logger
+        self._queue = []
+        self._busy = False
+        self._cond = threading.Condition()
+        self._sinks = []
+        self.configure(config or {})
+
+        self._thread = threading.Thread(target=self.deliver,
+                name='notifier')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def configure(self, config):
+        configured = []
+        for name in config.get('notify', ['dbus']):
+            if name not in self._sink_types:
+                self._logger.warning('unknown notification sink {0}'.format(
+                    name))
+                continue
+            configured.append(self._sink_types[name](self._logger, config))
+
+        with self._cond:
+            self._sinks = configured
+
+    def merge(self, queued, msg):
+        """Adds msg to the message of a queued notification, once"""
+        lines = []
+        if queued:
+            lines = queued.split('\n')
+        if msg and msg not in lines:
+            lines.append(msg)
+        return '\n'.join(lines)
+
+    def notify(self, urgency, title, msg=''):
+        with self._cond:
+            for i, queued in enumerate(self._queue):
+                if queued[0] != urgency or queued[1] != title:
+                    continue
+                if urgency == 'critical':
+                    msg = self.merge(queued[2], msg)
+                self._queue[i] = (urgency, title, msg)
+                return
+            if len(self._queue) >= self._max_queued:
+                self._queue.pop(0)
+            self._queue.append((urgency, title, msg))
+            self._cond.notify()
+
+    def deliver(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._busy = False
+                    self._cond.notify_all()
+                    self._cond.wait()
+                self._busy = True
+                (urgency, title, msg) = self._queue.pop(0)
+                sinks = self._sinks
+
+            for sink in sinks:
+                try:
+                    sink.send(urgency, title, msg, self._send_timeout)
+                except Exception, errmsg:
+                    self._logger.debug('{0}: {1}'.format(sink.name, errmsg))
+
+    def flush(self, timeout=None):
+        """Waits until all queued notifications have been delivered"""
+        if timeout is None:
+            timeout = self._flush_timeout
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._queue or self._busy:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
@@ -2,26 +2,29 @@
 import logging
 import sys
 
-import dbus
+from rbackup.metrics import Metrics, NullSpan
+from rbackup.notify import Notifier
 
 class Output:
-    _bus_name = 'net.as65342.notifications'
-    _bus_path = '/net/as65342/notifications'
-
     _logformat = '%(asctime)s [%(levelname)s]: %(message)s'
 
+    _null_span = NullSpan()
+
     def __init__(self, log_level):
         self._logger = None
-        self._notificationd = None
+        self._notifier = None
         self._log_level = log_level
+        self._metrics = None
         self.setup_output()
 
     def setup_output(self):
         self.setup_main_logger()
         self.setup_console_logger()
+        self._notifier = Notifier(self._logger)
 
-        self._bus = dbus.SystemBus()
-        self._notificationd = self._bus.get_object(self._bus_name, self._bus_path)
+    def setup_notifications(self, config):
+        """Use the notification sinks from the configuration"""
+        self._notifier.configure(config)
 
     def setup_main_logger(self):
         self._logger = logging.getLogger('main')
@@ -34,6 +37,17 @@ class Output:
         console_logger.setFormatter(formatter)
         self._logger.addHandler(console_logger)
 
+    def enable_metrics(self):
+        self._metrics = Metrics()
+        return self._metrics
+
+    def span(self, name, kind='phase'):
+        """Context manager which times a phase or a command, this costs
+        nothing but a method call when metrics are not enabled"""
+        if self._metrics is None:
+            return self._null_span
+        return self._metrics.span(name, kind)
+
     def info(self, msg):
         self._logger.info(msg)
 
@@ -47,22 +61,28 @@ class Output:
         self._logger.error(msg)
         sys.exit(1)
 
+    def progress(self, title, msg=''):
+        if len(msg) > 0:
+            self.info('{0}: {1}'.format(title, msg))
+        else:
+            self.info('{0}'.format(title))
+
     def low(self, title, msg=''):
-        self._notificationd.low(title, msg)
+        self._notifier.notify('low', title, msg)
         if len(msg) > 0:
             self.debug('{0}: {1}'.format(title, msg))
         else:
             self.debug('{0}'.format(title))
 
     def normal(self, title, msg=''):
-        self._notificationd.normal(title, msg)
+        self._notifier.notify('normal', title, msg)
         if len(msg) > 0:
             self.info('{0}: {1}'.format(title, msg))
         else:
             self.info('{0}'.format(title))
 
     def critical(self, title, msg=''):
-        self._notificationd.critical(title, msg)
+        self._notifier.notify('critical', title, msg)
         if len(msg) > 0:
             self.error('{0}: {1}'.format(title, msg))
         else:
@@ -1,5 +1,10 @@
 
+import ctypes
+import errno
 import os
+import re
+import select
+import time
 
 from rbackup import BaseClass
 
@@ -13,25 +18,110 @@ class PackageManager(BaseClass):
         'pak',
         'makeinstall'
     ]
-    def __init__(self, output):
+
+    # package managers written in these languages can be started with the
+    # interpreter as argv[0] and the package manager as argv[1]
+    _re_interpreter = re.compile('^(python|perl|ruby)[0-9.]*$|^(ba)?sh$')
+
+    # pidfd_open(2) has the same syscall number on all architectures
+    _nr_pidfd_open = 434
+
+    # how often to look for newly started package managers while waiting
+    _rescan_interval = 1.0
+
+    def __init__(self, output, proc_root='/proc'):
         BaseClass.__init__(self, output)
+        self._proc_root = proc_root
+        self._seen_pids = set()
+        self._pkgmgr_pids = {}
+        self._libc = None
 
     def is_package_manager(self, cmdline):
-        for pkgmgr in self._package_managers:
-            if pkgmgr in cmdline:
-                return True
-        return False
+        argv = [os.path.basename(arg) for arg in cmdline.split('\0')[:2]]
+        if argv[0] in self._package_managers:
+            return True
+        return len(argv) > 1 and self._re_interpreter.search(argv[0]) \
+                is not None and argv[1] in self._package_managers
 
-    def has_running_pkgmgr(self):
-        pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
+    def scan(self):
+        """Look at processes which were not seen before and record the ones
+        which are package managers. Returns the number of running package
+        managers found so far"""
+        pids = set([int(pid) for pid in os.listdir(self._proc_root)
+            if pid.isdigit()])
 
-        for pid in pids:
+        # forget pids which are gone, so a reused pid is looked at again.
+        # pids with an open pidfd are cleaned up once it polls readable
+        self._seen_pids &= pids
+        for pid, pidfd in self._pkgmgr_pids.items():
+            if pid not in pids and pidfd is None:
+                del(self._pkgmgr_pids[pid])
+
+        for pid in pids - self._seen_pids:
+            self._seen_pids.add(pid)
             try:
-                cmdline = open(os.path.join('/proc', pid, 'cmdline'), 'rb').read()
+                cmdline = open(os.path.join(self._proc_root, str(pid),
+                    'cmdline'), 'rb').read()
             except IOError:
                 # process has vanished
                 continue
             if self.is_package_manager(cmdline):
-                return True
+                self.debug('found package manager {0} ({1})'.format(
+                    cmdline.split('\0')[0], pid))
+                self._pkgmgr_pids[pid] = None
+
+        return len(self._pkgmgr_pids)
+
+    def pidfd_open(self, pid):
+        """Returns a pidfd for pid, None if pidfds are not supported and
+        -1 if the process is already gone"""
+        if self._libc is None:
+            self._libc = ctypes.CDLL(None, use_errno=True)
+
+        fd = self._libc.syscall(self._nr_pidfd_open, pid, 0)
+        if fd >= 0:
+            return fd
+
+        err = ctypes.get_errno()
+        if err == errno.ESRCH:
+            return -1
+        return None
+
+    def wait_for_pkgmgr(self, timeout):
+        """Block until all running package managers have exited. Returns
+        False if they are still running after timeout seconds"""
+        deadline = time.time() + timeout
+        poller = select.poll()
+
+        try:
+            while self.scan() > 0:
+                for pid, pidfd in self._pkgmgr_pids.items():
+                    if pidfd is not None:
+                        continue
+                    pidfd = self.pidfd_open(pid)
+                    if pidfd == -1:
+                        del(self._pkgmgr_pids[pid])
+                        continue
+                    elif pidfd is not None:
+                        poller.register(pidfd, select.POLLIN)
+                    self._pkgmgr_pids[pid] = pidfd
+
+                now = time.time()
+                if now >= deadline:
+                    return False
+
+                self.debug('waiting for package manager')
+                wait = min(self._rescan_interval, deadline - now)
+                for (pidfd, event) in poller.poll(wait * 1000):
+                    poller.unregister(pidfd)
+                    os.close(pidfd)
+                    for pid in self._pkgmgr_pids.keys():
+                        if self._pkgmgr_pids[pid] == pidfd:
+                            del(self._pkgmgr_pids[pid])
+        finally:
+            for pid, pidfd in self._pkgmgr_pids.items():
+                if pidfd is not None:
+                    os.close(pidfd)
+                    self._pkgmgr_pids[pid] = None
 
-        return False
+        return True
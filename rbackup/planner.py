@@ -0,0 +1,154 @@
+
+from rbackup import BaseClass
+
+class Planner(BaseClass):
+    """Decides between a full and an incremental backup by comparing the
+    cost of growing the current chain with the cost of a new full backup.
+    A max_incrementals limit takes precedence over the cost model, and is
+    off when set to 0"""
+    _d_full_backup_threshold = 1.0
+    _d_max_restore_time = 0
+    _d_max_transfer_time = 0
+
+    # number of recent runs used for estimates
+    _history_window = 10
+
+    def __init__(self, output, config, job, collection, runs,
+            bandwidth=None):
+        BaseClass.__init__(self, output)
+        self._cfg = config
+        self._job = job
+        self._collection = collection
+        self._runs = runs[-self._history_window:]
+        self._bandwidth = bandwidth
+        self._changes = None
+
+    def set_changes(self, changes):
+        """Use the changes found by the pre-scan to estimate the size of
+        the next incremental"""
+        self._changes = changes
+
+    def estimate_throughput(self):
+        """Average upload speed in bytes per second of recent runs"""
+        size = 0
+        elapsed = 0
+        for run in self._runs:
+            if run['elapsed_time'] and run['dest_size_change'] > 0:
+                size += run['dest_size_change']
+                elapsed += run['elapsed_time']
+        if elapsed == 0:
+            return None
+        return size / elapsed
+
+    def estimate_incremental_size(self, chain):
+        if self._changes and self._changes['indexed']:
+            return self._changes['changed_size']
+
+        sizes = [run['dest_size_change'] for run in self._runs
+                if run['backup_type'] == 'incr' and run['dest_size_change']]
+        if len(sizes) == 0:
+            sizes = [inc['size'] for inc in chain['incrementals']]
+        if len(sizes) == 0:
+            return 0
+        return sum(sizes) / len(sizes)
+
+    def estimate_full_size(self, chain):
+        if chain['full']['size']:
+            return chain['full']['size']
+        for run in reversed(self._runs):
+            if run['source_file_s']:
+                return run['source_file_s']
+        return 0
+
+    def plan(self):
+        """Returns 'full', 'incr' or 'skip' together with the reason"""
+        (backup_type, reason) = self.plan_by_cost()
+        return self.gate_by_bandwidth(backup_type, reason)
+
+    def gate_by_bandwidth(self, backup_type, reason):
+        """Postpone a full backup or skip the run if the upload would not
+        fit in max_transfer_time at the measured bandwidth"""
+        max_transfer_time = self._cfg.get('max_transfer_time',
+                self._d_max_transfer_time)
+        if not max_transfer_time or not self._bandwidth:
+            return (backup_type, reason)
+
+        if self._collection.has_backups():
+            chain = self._collection.get_chains()[-1]
+            full_size = self.estimate_full_size(chain)
+            next_size = self.estimate_incremental_size(chain)
+        else:
+            chain = None
+            full_size = 0
+            for run in reversed(self._runs):
+                if run['source_file_s']:
+                    full_size = run['source_file_s']
+                    break
+            next_size = 0
+
+        if backup_type == 'full':
+            transfer_time = full_size / self._bandwidth
+            if transfer_time <= max_transfer_time:
+                return (backup_type, reason)
+            elif not chain:
+                return ('skip', 'full backup would take {0:.0f}s at' \
+                    ' {1}/s'.format(transfer_time,
+                        self.human_byte(self._bandwidth)))
+            backup_type = 'incr'
+            reason = 'postponing full backup ({0}), it would take {1:.0f}s' \
+                ' at {2}/s'.format(reason, transfer_time,
+                    self.human_byte(self._bandwidth))
+
+        transfer_time = next_size / self._bandwidth
+        if transfer_time > max_transfer_time:
+            return ('skip', 'incremental backup would take {0:.0f}s at' \
+                ' {1}/s'.format(transfer_time,
+                    self.human_byte(self._bandwidth)))
+        return (backup_type, reason)
+
+    def plan_by_cost(self):
+        name = self._job['name']
+        if not self._collection.has_backups():
+            return ('full', 'no backups found')
+
+        chain = self._collection.get_chains()[-1]
+        num_incrementals = len(chain['incrementals'])
+
+        max_incrementals = self._job['max_incrementals']
+        if max_incrementals and num_incrementals >= max_incrementals:
+            return ('full', '{0} incrementals, limit is {1}'.format(
+                num_incrementals, max_incrementals))
+
+        full_size = self.estimate_full_size(chain)
+        next_size = self.estimate_incremental_size(chain)
+        chain_size = sum([inc['size'] or 0 for inc in chain['incrementals']])
+        chain_size += next_size
+
+        self.debug('{0}: full {1}, chain {2} incl. next incremental of' \
+            ' {3}'.format(name, self.human_byte(full_size),
+                self.human_byte(chain_size), self.human_byte(next_size)))
+
+        # a longer chain costs its size in storage and restore transfer,
+        # a new full costs the upload of the full size once
+        threshold = self._cfg.get('full_backup_threshold',
+                self._d_full_backup_threshold)
+        if full_size and chain_size >= threshold * full_size:
+            return ('full', 'chain of {0} exceeds {1:.0%} of the full' \
+                ' backup size {2}'.format(self.human_byte(chain_size),
+                    threshold, self.human_byte(full_size)))
+
+        max_restore_time = self._cfg.get('max_restore_time',
+                self._d_max_restore_time)
+        throughput = self.estimate_throughput()
+        if max_restore_time and throughput:
+            restore_time = (full_size + chain_size) / throughput
+            full_time = full_size / throughput
+            self.debug('{0}: restore {1:.0f}s, full upload {2:.0f}s at' \
+                ' {3}/s'.format(name, restore_time, full_time,
+                    self.human_byte(throughput)))
+            if restore_time > max_restore_time:
+                return ('full', 'restore would take {0:.0f}s, limit is' \
+                    ' {1}s'.format(restore_time, max_restore_time))
+
+        return ('incr', 'chain of {0} incrementals is cheaper than a full' \
+            ' backup'.format(num_incrementals))
@@ -0,0 +1,58 @@
+
+import os
+import socket
+
+from rbackup import BaseClass
+
+class Power(BaseClass):
+    """Tells whether the system runs on AC power, and listens for kernel
+    uevents of power supplies to notice when it is plugged in"""
+    _netlink_kobject_uevent = 15
+    _uevent_group = 1
+
+    def __init__(self, output, sys_root='/sys'):
+        BaseClass.__init__(self, output)
+        self._supply_dir = os.path.join(sys_root, 'class', 'power_supply')
+
+    def read(self, supply, name):
+        try:
+            return open(os.path.join(self._supply_dir, supply, name),
+                    'r').read().strip()
+        except IOError:
+            return None
+
+    def on_ac_power(self):
+        """Returns True when a mains supply is online, and also on systems
+        without any mains supply, such as most servers"""
+        if not os.path.isdir(self._supply_dir):
+            return True
+
+        mains = [name for name in os.listdir(self._supply_dir)
+                if self.read(name, 'type') == 'Mains']
+        if not mains:
+            return True
+        return any([self.read(name, 'online') == '1' for name in mains])
+
+    def subscribe(self):
+        """Returns a socket which becomes readable on uevents"""
+        try:
+            s = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                    self._netlink_kobject_uevent)
+            s.bind((0, self._uevent_group))
+        except socket.error, errmsg:
+            self.warning('failed to listen for uevents: {0}'.format(errmsg))
+            return None
+        s.setblocking(0)
+        return s
+
+    def read_events(self, s):
+        """Drains the uevent socket, returns True if a power supply changed"""
+        changed = False
+        while True:
+            try:
+                data = s.recv(65536)
+            except socket.error:
+                break
+            if 'SUBSYSTEM=power_supply' in data.split('\0'):
+                changed = True
+        return changed
@@ -0,0 +1,320 @@
+
+import errno
+import fcntl
+import os
+import select
+import signal
+import subprocess
+import time
+
+class Process:
+    """A command which is executed without a shell. Its output is streamed
+    line by line to a callback and/or collected, and it is killed when it
+    runs longer than its timeout.
+
+    With log=True an extra pipe is passed to the child, and %LOG_FD% in
+    argv is replaced by its file descriptor; lines written to it are passed
+    to on_log_line"""
+
+    def __init__(self, argv, timeout=None, on_line=None, stdin=None,
+            log=False, on_log_line=None, keep_output=True, span=None,
+            preexec=None, name=None, on_exit=None):
+        self.argv = list(argv)
+        self.name = name or os.path.basename(self.argv[0])
+        self.timeout = timeout
+        self.returncode = None
+        self.output = []
+        self.rusage = None
+        self.timed_out = False
+        self.status_lost = False
+        self.start_time = None
+        self.duration = None
+
+        self._on_line = on_line
+        self._on_log_line = on_log_line
+        self._on_exit = on_exit
+        self._keep_output = keep_output
+        self._span = span
+        self._preexec_hook = preexec
+        self._stdin = stdin
+        self._stdin_offset = 0
+        self._log = log
+        self._log_w = None
+        self._proc = None
+        self._readers = {}
+        self._buffers = {}
+        self._writer = None
+        self._kill_at = None
+        self._reap_wait = 0.0005
+
+    def _preexec(self):
+        """Runs in the child: put it in its own process group, so the whole
+        tree can be killed, and close everything but the log pipe. Only the
+        open descriptors are closed, close_fds tries every possible one"""
+        os.setpgid(0, 0)
+        for name in os.listdir('/proc/self/fd'):
+            fd = int(name)
+            if fd < 3 or fd == self._log_w:
+                continue
+            try:
+                if not fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC:
+                    os.close(fd)
+            except (IOError, OSError):
+                # the descriptor used to list /proc/self/fd is gone
+                continue
+        if self._preexec_hook:
+            self._preexec_hook()
+
+    def start(self):
+        self.start_time = time.time()
+        if self._span:
+            self._span.__enter__()
+
+        log_r = None
+        if self._log:
+            (log_r, self._log_w) = os.pipe()
+            self.argv = [arg.replace('%LOG_FD%', str(self._log_w))
+                    for arg in self.argv]
+
+        stdin = None
+        if self._stdin is not None:
+            stdin = subprocess.PIPE
+
+        try:
+            self._proc = subprocess.Popen(self.argv, stdin=stdin,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    close_fds=False, preexec_fn=self._preexec)
+        except OSError, errmsg:
+            if log_r is not None:
+                os.close(log_r)
+                os.close(self._log_w)
+            self.output.append('{0}: {1}'.format(self.name, errmsg.strerror))
+            self._finish(127)
+            return False
+
+        self._readers[self._proc.stdout.fileno()] = 'stdout'
+        self._readers[self._proc.stderr.fileno()] = 'stderr'
+        if log_r is not None:
+            os.close(self._log_w)
+            self._readers[log_r] = 'log'
+        for fd in self._readers:
+            self._buffers[fd] = ''
+
+        if self._stdin is not None:
+            self._writer = self._proc.stdin.fileno()
+            flags = fcntl.fcntl(self._writer, fcntl.F_GETFL)
+            fcntl.fcntl(self._writer, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        return True
+
+    def is_done(self):
+        return self.returncode is not None
+
+    def read_fds(self):
+        return self._readers.keys()
+
+    def write_fds(self):
+        if self._writer is None:
+            return []
+        return [self._writer]
+
+    def _line(self, stream, line):
+        if stream == 'log':
+            if self._on_log_line:
+                self._on_log_line(line)
+            return
+        if len(line) == 0:
+            return
+        if self._keep_output:
+            self.output.append(line)
+        if self._on_line:
+            self._on_line(line)
+
+    def _close_reader(self, fd):
+        stream = self._readers.pop(fd)
+        if self._buffers[fd]:
+            self._line(stream, self._buffers[fd])
+        del self._buffers[fd]
+        if stream == 'log':
+            os.close(fd)
+
+    def read(self, fd):
+        data = os.read(fd, 65536)
+        if not data:
+            self._close_reader(fd)
+            return
+        lines = (self._buffers[fd] + data).split('\n')
+        self._buffers[fd] = lines.pop()
+        for line in lines:
+            self._line(self._readers[fd], line)
+
+    def _close_writer(self):
+        self._proc.stdin.close()
+        self._writer = None
+
+    def write(self, fd):
+        try:
+            written = os.write(fd, self._stdin[self._stdin_offset:
+                self._stdin_offset+65536])
+        except OSError, errmsg:
+            if errmsg.errno == errno.EAGAIN:
+                return
+            self._close_writer()
+            return
+        self._stdin_offset += written
+        if self._stdin_offset >= len(self._stdin):
+            self._close_writer()
+
+    def signal(self, signum):
+        try:
+            os.killpg(self._proc.pid, signum)
+        except OSError:
+            pass
+
+    def check_timeout(self, now, kill_grace):
+        """Sends SIGTERM to the process group once the timeout expired and
+        SIGKILL after kill_grace seconds. Returns the number of seconds
+        until the next check is needed, or None"""
+        if self._kill_at is not None:
+            if now >= self._kill_at:
+                self.signal(signal.SIGKILL)
+                self._kill_at = None
+                return None
+            return self._kill_at - now
+
+        if not self.timeout or self.timed_out:
+            return None
+
+        deadline = self.start_time + self.timeout
+        if now < deadline:
+            return deadline - now
+
+        self.timed_out = True
+        self.signal(signal.SIGTERM)
+        self._kill_at = now + kill_grace
+        return kill_grace
+
+    def kill(self):
+        if self._proc and not self.is_done():
+            self.signal(signal.SIGKILL)
+
+    def reap_interval(self, max_interval):
+        """A process usually exits right after closing its output, so the
+        exit status is polled for at exponentially growing intervals"""
+        self._reap_wait = min(self._reap_wait * 2, max_interval)
+        return self._reap_wait
+
+    def reap(self, block=False):
+        """Collects the exit status and resource usage of the process once
+        all of its output has been read"""
+        if self._readers:
+            return False
+
+        options = 0
+        if not block:
+            options = os.WNOHANG
+        try:
+            (pid, status, rusage) = os.wait4(self._proc.pid, options)
+        except OSError, errmsg:
+            if errmsg.errno != errno.ECHILD:
+                raise
+            # somebody else reaped the process, its exit status is gone
+            (pid, status, rusage) = (self._proc.pid, None, None)
+        if pid == 0:
+            return False
+
+        if self._writer is not None:
+            self._close_writer()
+        self._proc.stdout.close()
+        self._proc.stderr.close()
+
+        if status is None:
+            self.status_lost = True
+            returncode = -1
+        elif os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        # keep subprocess from trying to reap the process again
+        self._proc.returncode = returncode
+        self.rusage = rusage
+        self._finish(returncode)
+        return True
+
+    def _finish(self, returncode):
+        self.returncode = returncode
+        self.duration = time.time() - self.start_time
+        if self._span:
+            if self.rusage:
+                self._span.set('cpu_user', self.rusage.ru_utime)
+                self._span.set('cpu_system', self.rusage.ru_stime)
+                self._span.set('maxrss', self.rusage.ru_maxrss)
+            self._span.set('returncode', returncode)
+            self._span.__exit__(None, None, None)
+        if self._on_exit:
+            self._on_exit(self)
+
+class Executor:
+    """Runs processes with at most max_parallel of them at the same time,
+    multiplexing all of their pipes in a single select loop"""
+    _kill_grace = 5
+
+    # how often processes which closed their output are checked for exit,
+    # at most
+    _reap_interval = 0.1
+
+    def __init__(self, max_parallel=1):
+        self._max_parallel = max(max_parallel, 1)
+
+    def run(self, processes):
+        pending = list(processes)
+        running = []
+        try:
+            while pending or running:
+                while pending and len(running) < self._max_parallel:
+                    process = pending.pop(0)
+                    if process.start():
+                        running.append(process)
+
+                self.step(running)
+                running = [p for p in running if not p.reap()]
+        except BaseException:
+            for process in running:
+                process.kill()
+                process.reap(True)
+            raise
+
+        return processes
+
+    def step(self, running):
+        now = time.time()
+        timeout = None
+        readers = {}
+        writers = {}
+        for process in running:
+            wait = process.check_timeout(now, self._kill_grace)
+            if not process.read_fds():
+                wait = process.reap_interval(self._reap_interval)
+            if wait is not None and (timeout is None or wait < timeout):
+                timeout = wait
+            for fd in process.read_fds():
+                readers[fd] = process
+            for fd in process.write_fds():
+                writers[fd] = process
+
+        if not readers and not writers:
+            if timeout:
+                time.sleep(timeout)
+            return
+
+        try:
+            (readable, writable, _) = select.select(readers.keys(),
+                    writers.keys(), [], timeout)
+        except select.error, errmsg:
+            if errmsg[0] == errno.EINTR:
+                return
+            raise
+
+        for fd in writable:
+            writers[fd].write(fd)
+        for fd in readable:
+            readers[fd].read(fd)
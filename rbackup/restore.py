@@ -0,0 +1,405 @@
+
+import calendar
+import os
+import pipes
+import re
+import shutil
+import tempfile
+import time
+
+from rbackup import BaseClass
+from rbackup.collection import Collection
+
+class Restore(BaseClass):
+    """Restores paths as they were at a point in time. The manifests on the
+    remote tell which volumes hold each path, every volume needed by any of
+    the paths is fetched once with concurrent rsyncs over the shared ssh
+    connection, after which all paths are extracted concurrently from the
+    local copy"""
+    _d_parallel = 4
+
+    _progress_interval = 5
+
+    _re_interval = re.compile('^([0-9]+)([smhDWMY])$')
+    _interval_seconds = {
+        's': 1,
+        'm': 60,
+        'h': 3600,
+        'D': 86400,
+        'W': 7 * 86400,
+        'M': 30 * 86400,
+        'Y': 365 * 86400,
+    }
+    _time_formats = ['%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S',
+            '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S']
+
+    _re_manifest_path = re.compile('^\s*(StartingPath|EndingPath)\s+(.*)$')
+    _re_manifest_volume = re.compile('^Volume ([0-9]+):')
+    _re_manifest_hash = re.compile('^\s*Hash SHA1 ([0-9a-f]+)')
+
+    def __init__(self, output, config, ssh, destination, jobs):
+        BaseClass.__init__(self, output)
+        self._cfg = config
+        self._ssh = ssh
+        self._dest = destination
+        self._jobs = jobs
+        self._progress = None
+
+    def parse_time(self, value):
+        """Accepts now, seconds since the epoch, an age such as 3D or 2W,
+        or a local date and time such as 2020-01-31T12:00"""
+        if not value or value == 'now':
+            return time.time()
+        if value.isdigit():
+            return float(value)
+
+        match = self._re_interval.search(value)
+        if match:
+            return time.time() - int(match.group(1)) * \
+                    self._interval_seconds[match.group(2)]
+
+        for time_format in self._time_formats:
+            try:
+                return time.mktime(time.strptime(value, time_format))
+            except ValueError:
+                continue
+        self.error('can not parse time {0}'.format(value))
+
+    def get_job(self, path):
+        """Returns the job with the longest source containing path"""
+        found = None
+        for job in self._jobs:
+            source = job['source'].rstrip('/') + '/'
+            if not (path + '/').startswith(source):
+                continue
+            if not found or len(job['source']) > len(found['source']):
+                found = job
+        return found
+
+    def get_remote_path(self, job):
+        remote_path = self._dest['remote_path']
+        if job['destination']:
+            remote_path = os.path.join(remote_path, job['destination'])
+        return remote_path
+
+    def get_index(self, job, path):
+        """The path relative to the job source as a duplicity index"""
+        relpath = os.path.relpath(path, job['source'])
+        if relpath == '.':
+            return ()
+        return tuple(relpath.split('/'))
+
+    def group_paths(self, paths):
+        """Maps every job to the paths it holds, leaving out paths which
+        are restored as part of another path"""
+        paths = sorted(set([os.path.normpath(os.path.abspath(p))
+            for p in paths]))
+        groups = {}
+        restored = []
+        for path in paths:
+            if [p for p in restored if
+                    (path + '/').startswith(p.rstrip('/') + '/')]:
+                continue
+            restored.append(path)
+
+            job = self.get_job(path)
+            if not job:
+                self.error('{0} is not part of any backup job'.format(path))
+            groups.setdefault(job['name'], (job, []))[1].append(path)
+        return groups.values()
+
+    def parse_manifest_path(self, value):
+        """Returns the index of a StartingPath or EndingPath, which might
+        be quoted and followed by a block number"""
+        value = value.strip()
+        if value.startswith('"'):
+            end = 1
+            while end < len(value) and value[end] != '"':
+                if value[end] == '\\':
+                    end += 1
+                end += 1
+            path = value[1:end].decode('string_escape')
+        else:
+            path = value.split()[0]
+
+        if path == '.':
+            return ()
+        return tuple(path.split('/'))
+
+    def parse_manifest(self, lines):
+        """Returns (volume number, start index, end index, sha1) for every
+        volume listed in a manifest"""
+        volumes = []
+        volume = None
+        for line in lines:
+            match = self._re_manifest_volume.search(line)
+            if match:
+                volume = [int(match.group(1)), None, None, None]
+                volumes.append(volume)
+                continue
+
+            match = self._re_manifest_hash.search(line)
+            if match and volume:
+                volume[3] = match.group(1)
+                continue
+
+            match = self._re_manifest_path.search(line)
+            if not match or not volume:
+                continue
+            index = self.parse_manifest_path(match.group(2))
+            if match.group(1) == 'StartingPath':
+                volume[1] = index
+            else:
+                volume[2] = index
+        return [tuple(v) for v in volumes if v[1] is not None and
+                v[2] is not None]
+
+    def probe(self, remote_path):
+        """Lists the backup sets in remote_path, together with the volumes
+        of every set as described by its manifest, in one remote command"""
+        script = 'cd {0} || exit 1; echo listing; ls -ln;' \
+            ' for f in duplicity-*.manifest; do [ -f "$f" ] || continue;' \
+            ' echo "manifest $f"; cat "$f"; done'.format(
+                pipes.quote(remote_path))
+        (returncode, output) = self._ssh.run_remote(script)
+        if returncode != 0 or 'listing' not in output:
+            self.error('failed to list {0}:{1}'.format(
+                self._dest['remote_host'], remote_path))
+
+        sizes = {}
+        manifests = {}
+        manifest = None
+        for line in output[output.index('listing') + 1:]:
+            if line.startswith('manifest '):
+                manifest = line[len('manifest '):].strip()
+                manifests[manifest] = []
+                continue
+            if manifest:
+                manifests[manifest].append(line)
+                continue
+
+            fields = line.split()
+            if len(fields) < 9:
+                continue
+            try:
+                sizes[fields[-1]] = int(fields[4])
+            except ValueError:
+                continue
+
+        backup_sets = {}
+        for name in sizes:
+            match = Collection._re_backup_file.search(name)
+            if not match:
+                continue
+            (set_type, start, end, kind) = match.group(1, 2, 3, 4)
+            key = (set_type, start, end)
+            if key not in backup_sets:
+                backup_sets[key] = {
+                    'type': set_type,
+                    'start': start,
+                    'end': end,
+                    'time': calendar.timegm(time.strptime(end or start,
+                        '%Y%m%dT%H%M%SZ')),
+                    'manifest': None,
+                    'volumes': {},
+                    'ranges': [],
+                }
+            backup_set = backup_sets[key]
+            if kind == 'manifest':
+                backup_set['manifest'] = name
+                backup_set['ranges'] = self.parse_manifest(
+                        manifests.get(name, []))
+            else:
+                backup_set['volumes'][int(kind[3:].split('.')[0])] = name
+
+        return (sorted([s for s in backup_sets.values() if s['manifest']],
+            key=lambda s: s['time']), sizes)
+
+    def get_chain(self, backup_sets, timestamp):
+        """Returns the full backup set and the incrementals on top of it
+        which make up the backup at timestamp"""
+        chain = []
+        for backup_set in backup_sets:
+            if backup_set['time'] > timestamp:
+                break
+            if backup_set['type'] == 'full':
+                chain = [backup_set]
+            elif chain and backup_set['start'] == \
+                    (chain[-1]['end'] or chain[-1]['start']):
+                chain.append(backup_set)
+        return chain
+
+    def get_volumes(self, chain, indexes):
+        """Returns the names of the files needed to restore indexes"""
+        names = []
+        for backup_set in chain:
+            names.append(backup_set['manifest'])
+            for (number, start, end, sha1) in backup_set['ranges']:
+                for index in indexes:
+                    if not start[:len(index)] <= index <= end:
+                        continue
+                    if number not in backup_set['volumes']:
+                        self.error('volume {0} of {1} is missing'.format(
+                            number, backup_set['manifest']))
+                    names.append(backup_set['volumes'][number])
+                    break
+        return names
+
+    def get_batches(self, names, sizes, parallel):
+        """Spreads the files over parallel batches of about the same size,
+        largest files first"""
+        batches = [[0, []] for i in range(parallel)]
+        for name in sorted(names, key=lambda n: -sizes.get(n, 0)):
+            batch = min(batches, key=lambda b: b[0])
+            batch[0] += sizes.get(name, 0)
+            batch[1].append(name)
+        return [batch[1] for batch in batches if batch[1]]
+
+    def show_progress(self, force=False):
+        progress = self._progress
+        now = time.time()
+        if not force and now - progress['last'] < self._progress_interval:
+            return
+        progress['last'] = now
+
+        elapsed = max(now - progress['start'], 0.001)
+        speed = progress['done'] / elapsed
+        eta = 'unknown'
+        if speed > 0:
+            eta = time.strftime('%H:%M:%S', time.gmtime(
+                (progress['total'] - progress['done']) / speed))
+        self.progress('Restore progress', 'fetched {0} of {1}, {2}/s,' \
+            ' ETA {3}, restored {4} of {5} paths'.format(
+                self.human_byte(progress['done']),
+                self.human_byte(progress['total']), self.human_byte(speed),
+                eta, progress['restored'], progress['paths']))
+
+    def fetched(self, line, sizes):
+        """Called for every file rsync transferred"""
+        name = line.split(' ')[0]
+        self._progress['done'] += sizes.get(name, 0)
+        self.show_progress()
+
+    def restored(self, process, path):
+        if process.returncode == 0:
+            self._progress['restored'] += 1
+            self.info('restored {0}'.format(path))
+        else:
+            self.warning('failed to restore {0}: {1}'.format(path,
+                ', '.join(process.output[-3:])))
+        self.show_progress(True)
+
+    def fetch(self, job, names, sizes, staging_dir, parallel):
+        remote = '{0}:{1}/'.format(self._dest['remote_host'],
+                self.get_remote_path(job))
+        processes = []
+        for batch in self.get_batches(names, sizes, parallel):
+            argv = ['rsync', '-e', self._ssh.command(), '--files-from=-',
+                    '--out-format=%n %l', remote, staging_dir]
+            processes.append(self.process(argv, stdin='\n'.join(batch) + '\n',
+                on_line=lambda line: self.fetched(line, sizes),
+                keep_output=False, name='rsync'))
+        return processes
+
+    def extract(self, job, path, timestamp, staging_dir, cache_dir, target):
+        target_path = os.path.join(target, path.lstrip('/'))
+        argv = ['duplicity', 'restore', '--no-encryption', '--time',
+                str(int(timestamp)), '--archive-dir', cache_dir]
+        index = self.get_index(job, path)
+        if index:
+            argv.extend(['--file-to-restore', '/'.join(index)])
+        argv.extend(['file://' + staging_dir, target_path])
+        return self.process(argv, name='duplicity',
+                on_exit=lambda process: self.restored(process, path))
+
+    def check_target(self, target, paths):
+        for path in paths:
+            target_path = os.path.join(target, path.lstrip('/'))
+            if os.path.isdir(target_path) and not os.listdir(target_path):
+                continue
+            if os.path.lexists(target_path):
+                self.error('{0} already exists'.format(target_path))
+
+    def restore(self, paths, when, target):
+        """Restores paths into target as they were at when, returns 1 if
+        anything could not be restored"""
+        timestamp = self.parse_time(when)
+        parallel = self._cfg.get('restore_parallel', self._d_parallel)
+        target = os.path.abspath(target)
+        groups = self.group_paths(paths)
+        self.check_target(target, [p for (job, job_paths) in groups
+            for p in job_paths])
+
+        if not os.path.isdir(target):
+            os.makedirs(target, 0700)
+        # volumes are staged next to the target, so they usually do not
+        # need space on another filesystem
+        staging_dir = tempfile.mkdtemp(prefix='.rbackup-restore-',
+                dir=os.path.dirname(target.rstrip('/')) or '/')
+
+        self._progress = {
+            'start': time.time(),
+            'last': 0,
+            'done': 0,
+            'total': 0,
+            'restored': 0,
+            'paths': 0,
+        }
+        try:
+            fetches = []
+            extracts = []
+            for (job, job_paths) in groups:
+                with self.span('restore_probe'):
+                    (backup_sets, sizes) = self.probe(
+                            self.get_remote_path(job))
+                chain = self.get_chain(backup_sets, timestamp)
+                if not chain:
+                    self.error('no backup of {0} at {1}'.format(job['source'],
+                        time.ctime(timestamp)))
+                self.info('restoring {0} from the backup of {1}'.format(
+                    ', '.join(job_paths), time.ctime(chain[-1]['time'])))
+
+                names = self.get_volumes(chain, [self.get_index(job, p)
+                    for p in job_paths])
+                self._progress['total'] += sum([sizes.get(n, 0)
+                    for n in names])
+
+                job_dir = os.path.join(staging_dir, job['name'])
+                os.mkdir(job_dir)
+                fetches.extend(self.fetch(job, names, sizes, job_dir,
+                    parallel))
+
+                for path in job_paths:
+                    parent = os.path.dirname(os.path.join(target,
+                        path.lstrip('/')))
+                    if not os.path.isdir(parent):
+                        os.makedirs(parent)
+                    cache_dir = os.path.join(staging_dir, 'cache-{0}'.format(
+                        len(extracts)))
+                    extracts.append(self.extract(job, path, timestamp,
+                        job_dir, cache_dir, target))
+            self._progress['paths'] = len(extracts)
+
+            self.normal('Starting restore', '{0} paths, fetching {1}'.format(
+                len(extracts), self.human_byte(self._progress['total'])))
+            with self.span('restore_fetch'):
+                self.run_many(fetches, parallel)
+            failed = [p for p in fetches if p.returncode != 0]
+            if failed:
+                self.critical('Restore failed', 'failed to fetch volumes')
+                return 1
+
+            with self.span('restore_extract'):
+                self.run_many(extracts, parallel)
+        finally:
+            shutil.rmtree(staging_dir, True)
+
+        failed = len([p for p in extracts if p.returncode != 0])
+        if failed:
+            self.critical('Restore failed', '{0} of {1} paths could not be' \
+                ' restored'.format(failed, len(extracts)))
+            return 1
+
+        self.normal('Restore completed', '{0} paths restored into {1} in' \
+            ' {2}'.format(len(extracts), target, time.strftime('%H:%M:%S',
+                time.gmtime(time.time() - self._progress['start']))))
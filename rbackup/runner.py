@@ -0,0 +1,316 @@
+
+import os
+import time
+
+from rbackup import BaseClass
+from rbackup.bandwidth import Bandwidth
+from rbackup.diskstats import DiskStats
+from rbackup.excludes import Excludes
+from rbackup.filesystems import Filesystems
+from rbackup.lock import Lock
+from rbackup.lvm import LVM
+from rbackup.networking import Networking
+from rbackup.pkgmgr import PackageManager
+from rbackup.restore import Restore
+from rbackup.scheduler import Scheduler
+from rbackup.snapmonitor import SnapshotMonitor
+from rbackup.ssh import SSH
+from rbackup.throttle import Throttle
+from rbackup.verify import Verify
+
+class Runner(BaseClass):
+    """Runs a complete backup: checks whether it can run, takes snapshots,
+    runs all jobs and cleans up. The objects it uses are kept between runs,
+    so a resident process only pays for their setup once"""
+    _d_state_dir = '/var/lib/rbackup'
+    _pkgmgr_wait = 300
+    _snap_dir = '/.snapshot'
+
+    def __init__(self, output, config, history):
+        BaseClass.__init__(self, output)
+        self._output = output
+        self._cfg = config
+        self._history = history
+        self._networking = None
+        self._pkgmgr = None
+        self._filesystems = None
+        self._lvm = None
+        self._ssh = {}
+
+    def get_networking(self):
+        if not self._networking:
+            self._networking = Networking(self._output, self._cfg)
+        return self._networking
+
+    def get_filesystems(self):
+        if not self._filesystems:
+            self._filesystems = Filesystems(self._output)
+        else:
+            self._filesystems.update()
+        return self._filesystems
+
+    def get_lvm(self):
+        filesystems = self.get_filesystems()
+        if not self._lvm:
+            self._lvm = LVM(self._output, filesystems,
+                    self._cfg['use_snapshots'], self._cfg['snapshot_size'],
+                    config=self._cfg)
+        else:
+            self._lvm.invalidate_inventory()
+        return self._lvm
+
+    def use_snapshots(self):
+        return self._cfg['use_snapshots'] in ['yes', 'auto']
+
+    def reload(self):
+        """Drop everything which depends on the configuration"""
+        self.stop()
+        self._networking = None
+        self._lvm = None
+
+    def stop(self):
+        for ssh in self._ssh.values():
+            ssh.stop()
+        self._ssh = {}
+
+    def lock(self, what):
+        """Returns the lock which has to be held while snapshots are
+        created, used or removed"""
+        return Lock(self._output, self._cfg.get('state_dir',
+            self._d_state_dir), what)
+
+    def cleanup(self):
+        os.chdir('/')
+        with self.lock('cleanup'):
+            with self.span('snapshot_teardown'):
+                self.get_lvm().cleanup_snapshots()
+
+    def get_destination(self, name):
+        for destination in self._cfg.get_destinations():
+            if destination['name'] == name:
+                return destination
+        self.error('no such destination {0}'.format(name))
+
+    def get_task_names(self):
+        """Names of the configured jobs as they run against every
+        destination"""
+        return [job['name'] + dest['suffix']
+                for dest in self._cfg.get_destinations()
+                for job in self._cfg.get_jobs()]
+
+    def take_snapshots(self, lvm, state_dir):
+        """Returns the directory the snapshots are mounted on"""
+        with self.span('snapshot_create'):
+            lvm.cleanup_snapshots()
+            diskstats = DiskStats(self._output, state_dir)
+            lvm.set_write_rates(diskstats.get_write_rates(),
+                    self._history.get_expected_duration(self.get_task_names()))
+            lvm.create_snapshots()
+        os.chdir(self._snap_dir)
+        return self._snap_dir
+
+    def remove_snapshots(self, lvm):
+        os.chdir('/')
+        with self.span('snapshot_teardown'):
+            lvm.cleanup_snapshots()
+
+    def is_below(self, path, parent):
+        return parent == '/' or path == parent or \
+                path.startswith(parent.rstrip('/') + '/')
+
+    def reads_from(self, job, mountpoint, mountpoints):
+        """Returns True if the backup of job reads from the filesystem
+        mounted on mountpoint"""
+        source = job['source']
+        if self.is_below(source, mountpoint):
+            # the source itself is on the innermost filesystem above it
+            return max([m for m in mountpoints if self.is_below(source, m)],
+                    key=len) == mountpoint
+
+        excludes = Excludes(self._output, job['excluded'], source)
+        path = mountpoint
+        while path != source and self.is_below(path, source):
+            if excludes.match_path(path):
+                return False
+            path = os.path.dirname(path)
+        return path == source
+
+    def restore(self, paths, when, target, destination='default'):
+        """Restores paths from destination into target, returns 1 if
+        anything could not be restored"""
+        dest = self.get_destination(destination)
+        ssh = SSH(self._output, self._cfg, dest)
+        with self.span('ssh_connect'):
+            ssh.start()
+        try:
+            return Restore(self._output, self._cfg, ssh, dest,
+                    self._cfg.get_jobs()).restore(paths, when, target)
+        finally:
+            ssh.stop()
+
+    def verify(self, destination='default'):
+        """Verifies a sample of the backups on destination against the
+        snapshots, returns 1 if anything did not match"""
+        dest = self.get_destination(destination)
+        with self.lock('verification'):
+            return self.run_verify(dest)
+
+    def run_verify(self, dest):
+        lvm = self.get_lvm()
+        state_dir = self._cfg.get('state_dir', self._d_state_dir)
+        ssh = SSH(self._output, self._cfg, dest)
+        with self.span('ssh_connect'):
+            ssh.start()
+
+        root = '/'
+        monitor = SnapshotMonitor(self._output, self._cfg, lvm)
+        try:
+            if self.use_snapshots():
+                root = self.take_snapshots(lvm, state_dir)
+                monitor.start()
+            return Verify(self._output, self._cfg, ssh, dest,
+                    self._cfg.get_jobs()).verify(root)
+        finally:
+            monitor.stop()
+            if self.use_snapshots():
+                self.remove_snapshots(lvm)
+            ssh.stop()
+
+    def run(self, keep_connection=False):
+        """Runs a backup, returns 1 if it could not run. The ssh connection
+        is left open for the next run when keep_connection is set"""
+        metrics = None
+        if self._cfg.get('metrics_report') or \
+                self._cfg.get('metrics_textfile'):
+            metrics = self._output.enable_metrics()
+
+        try:
+            with self.lock('backup'):
+                return self.run_backup()
+        finally:
+            if not keep_connection:
+                self.stop()
+            # the history database can only be used by the thread which
+            # opened it, and the next run may be on another thread
+            self._history.close()
+            if metrics and self._cfg.get('metrics_report'):
+                metrics.write_json(self._cfg.get('metrics_report'))
+            if metrics and self._cfg.get('metrics_textfile'):
+                metrics.write_textfile(self._cfg.get('metrics_textfile'))
+
+    def run_backup(self):
+        networking = self.get_networking()
+        with self.span('network_check'):
+            on_runon_network = networking.on_runon_network()
+        if not on_runon_network:
+            self.critical('Not running backup', 'not on a trusted network')
+            return 1
+
+        targets = []
+        unreachable = []
+        for dest in self._cfg.get_destinations():
+            with self.span('server_probe'):
+                remote_transports = networking.server_is_alive(
+                        dest['remote_host'])
+            # the ssh connection uses the family which connected fastest
+            target = {'destination': dest, 'ssh': None, 'bandwidth': None,
+                    'error': None, 'family': networking.fastest_transport(
+                        dest['remote_host'])}
+            if not remote_transports['ipv4'] and \
+                    not remote_transports['ipv6']:
+                target['error'] = '{0} is unreachable'.format(
+                        dest['remote_host'])
+                unreachable.append(dest['remote_host'])
+            targets.append(target)
+
+        if len(unreachable) == len(targets):
+            self.record_aborted('{0} is unreachable'.format(
+                ', '.join(unreachable)))
+            self.critical('Not running backup', '{0} is unreachable'.format(
+                ', '.join(unreachable)))
+            return 1
+
+        if not self._pkgmgr:
+            self._pkgmgr = PackageManager(self._output)
+        with self.span('pkgmgr_wait'):
+            pkgmgr_done = self._pkgmgr.wait_for_pkgmgr(self._pkgmgr_wait)
+        if not pkgmgr_done:
+            self.record_aborted('package manager still running')
+            self.critical('Not running backup', 'waited {0} seconds for' \
+                    ' package manager, aborting'.format(self._pkgmgr_wait))
+            return 1
+
+        try:
+            (scheduler, results) = self.run_jobs(networking, targets)
+        except SystemExit:
+            # error() and critical() exit
+            self.record_aborted('backup aborted')
+            raise
+
+        self._history.record_results(results)
+        scheduler.report(results)
+
+    def record_aborted(self, error):
+        """Records a failed run of every job on every destination"""
+        for name in self.get_task_names():
+            self._history.record_failure(name, error)
+
+    def run_jobs(self, networking, targets):
+        """Runs all jobs from the snapshots, returns the scheduler and
+        the results"""
+        filesystems = self.get_filesystems()
+        lvm = self.get_lvm()
+        state_dir = self._cfg.get('state_dir', self._d_state_dir)
+
+        os.chdir('/')
+
+        # set up first, the ssh control connections are started throttled
+        throttle = Throttle(self._output, self._cfg, filesystems)
+        throttle.setup()
+
+        for target in targets:
+            if target['error']:
+                continue
+            dest = target['destination']
+            if dest['name'] not in self._ssh:
+                self._ssh[dest['name']] = SSH(self._output, self._cfg, dest)
+            target['ssh'] = self._ssh[dest['name']]
+            with self.span('ssh_connect'):
+                target['ssh'].start(throttle, target['family'])
+
+            if self._cfg.get('max_transfer_time'):
+                with self.span('bandwidth_probe'):
+                    target['bandwidth'] = Bandwidth(self._output, self._cfg,
+                            target['ssh'], state_dir).get_bandwidth(
+                                networking.get_network_id() + dest['suffix'])
+
+        scheduler = Scheduler(self._output, self._cfg, targets,
+                self._history, throttle)
+
+        root = '/'
+        mountpoints = filesystems.keys()
+        monitor = SnapshotMonitor(self._output, self._cfg, lvm)
+        # the snapshots are removed whatever happens, a resident process
+        # would otherwise keep them until its next run
+        try:
+            if self.use_snapshots():
+                root = self.take_snapshots(lvm, state_dir)
+                monitor.start()
+            with self.span('backup'):
+                results = scheduler.run(self._cfg.get_jobs(), root)
+        finally:
+            monitor.stop()
+            throttle.cleanup()
+            if self.use_snapshots():
+                self.remove_snapshots(lvm)
+
+        for snapshot in monitor.get_invalid():
+            for result in results:
+                if not self.reads_from(result['job'],
+                        snapshot['mountpoint'], mountpoints):
+                    continue
+                result['error'] = 'snapshot {0} overflowed'.format(
+                        snapshot['path'])
+                result['stats'] = None
+
+        return (scheduler, results)
@@ -0,0 +1,168 @@
+
+import marshal
+import os
+import stat
+import threading
+import Queue
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+from rbackup import BaseClass
+
+class Scanner(BaseClass):
+    """Walks a backup tree and compares it against the metadata recorded
+    after the last successful backup, to find out if anything changed"""
+    _d_threads = 4
+
+    def __init__(self, output, config, job, excludes, state_dir):
+        BaseClass.__init__(self, output)
+        self._cfg = config
+        self._job = job
+        self._excludes = excludes
+        self._state_dir = state_dir
+        self._index_file = os.path.join(state_dir, '{0}.scan'.format(
+            job['name']))
+
+    def load(self):
+        if not os.path.exists(self._index_file):
+            return None
+        try:
+            return marshal.load(open(self._index_file, 'rb'))
+        except (EOFError, ValueError, TypeError), errmsg:
+            self.warning('{0}: {1}'.format(self._index_file, errmsg))
+            return None
+
+    def save(self, index):
+        self.atomic_write(self._index_file, marshal.dumps(index))
+
+    def list_dir(self, path):
+        """Yields (name, is_dir, stat) for all entries of path, entries
+        which vanish or cannot be looked at are skipped"""
+        if scandir:
+            for entry in scandir(path):
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError, errmsg:
+                    self.debug('scan: {0}'.format(errmsg))
+                    continue
+                yield (entry.name, stat.S_ISDIR(st.st_mode), st)
+            return
+
+        for name in os.listdir(path):
+            try:
+                st = os.lstat(os.path.join(path, name))
+            except OSError, errmsg:
+                self.debug('scan: {0}'.format(errmsg))
+                continue
+            yield (name, stat.S_ISDIR(st.st_mode), st)
+
+    def walk(self, root):
+        """Collects relpath -> (inode, size, mtime, ctime) for the tree
+        below root, using a pool of threads which share a directory queue.
+        Returns None if the tree could not be walked completely"""
+        source = self._job['source']
+        index = {}
+        errors = []
+        lock = threading.Lock()
+        queue = Queue.Queue()
+        queue.put('')
+
+        def worker():
+            while True:
+                reldir = queue.get()
+                if reldir is None:
+                    queue.task_done()
+                    return
+
+                entries = {}
+                try:
+                    for (name, is_dir, st) in self.list_dir(
+                            os.path.join(root, reldir)):
+                        relpath = os.path.join(reldir, name)
+                        if self._excludes.excluded(
+                                os.path.join(source, relpath),
+                                os.path.join(root, relpath), is_dir, st):
+                            continue
+                        entries[relpath] = (st.st_ino, st.st_size,
+                                st.st_mtime, st.st_ctime)
+                        if is_dir:
+                            queue.put(relpath)
+                except OSError, errmsg:
+                    self.debug('scan: {0}'.format(errmsg))
+                except Exception, errmsg:
+                    with lock:
+                        errors.append('{0}: {1}'.format(
+                            os.path.join(root, reldir), errmsg))
+                finally:
+                    with lock:
+                        index.update(entries)
+                    queue.task_done()
+
+        num_threads = self._cfg.get('prescan_threads', self._d_threads)
+        threads = []
+        for i in range(num_threads):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        queue.join()
+        for t in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+
+        if errors:
+            self.warning('scan: {0}'.format(errors[0]))
+            return None
+        self._excludes.set_walked()
+        return index
+
+    def scan(self, root):
+        """Returns a dict describing the changes since the last recorded
+        scan, and the new index which should be saved once the backup has
+        succeeded"""
+        return self.compare(self.walk(root))
+
+    def compare(self, new_index):
+        """Like scan, for an index returned by walk"""
+        old_index = self.load()
+
+        changes = {
+            'new_files': 0,
+            'changed_files': 0,
+            'deleted_files': 0,
+            'changed_size': 0,
+            'indexed': old_index is not None and new_index is not None,
+        }
+        if new_index is None:
+            return (changes, None)
+
+        if old_index is None:
+            changes['new_files'] = len(new_index)
+            changes['changed_size'] = sum([e[1] for e in new_index.values()])
+            return (changes, new_index)
+
+        for relpath, entry in new_index.iteritems():
+            old_entry = old_index.get(relpath)
+            if old_entry is None:
+                changes['new_files'] += 1
+                changes['changed_size'] += entry[1]
+            elif old_entry != entry:
+                changes['changed_files'] += 1
+                changes['changed_size'] += entry[1]
+
+        for relpath in old_index:
+            if relpath not in new_index:
+                changes['deleted_files'] += 1
+
+        return (changes, new_index)
+
+    def has_changes(self, changes):
+        if not changes['indexed']:
+            return True
+        return changes['new_files'] + changes['changed_files'] + \
+                changes['deleted_files'] > 0
@@ -0,0 +1,277 @@
+
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+
+# time.strptime imports this module on first use, which fails when the job
+# threads race to do so
+import _strptime
+
+from rbackup import BaseClass
+from rbackup.collection import Collection
+from rbackup.duplicity import Duplicity
+from rbackup.excludes import Excludes
+from rbackup.planner import Planner
+from rbackup.scanner import Scanner
+
+class Scheduler(BaseClass):
+    """Runs the configured backup jobs as separate duplicity processes, with
+    the number of concurrent jobs bounded by the available cores and the
+    bandwidth budget. Every destination gets its own share of concurrent
+    jobs, so all destinations are served from the same snapshots at the
+    same time, and a slow destination does not hold up the others"""
+    _d_state_dir = '/var/lib/rbackup'
+
+    # minimum rsync --bwlimit in KiB/s a job is allowed to run with
+    _min_job_bandwidth = 128
+
+    # days of history the planner looks at
+    _history_days = 90
+
+    def __init__(self, output, config, targets, history, throttle=None):
+        """targets is a list of dicts with a destination, its ssh
+        connection, the measured bandwidth and an error if the destination
+        can not be used"""
+        BaseClass.__init__(self, output)
+        self._output = output
+        self._cfg = config
+        self._targets = targets
+        self._history = history
+        self._throttle = throttle
+        self._lock = threading.Lock()
+        self._done = threading.Condition()
+        self._walks = {}
+
+    def get_parallelism(self, num_jobs, destination=None):
+        dest = destination or self._cfg
+        parallel = dest.get('max_parallel_jobs') or \
+                multiprocessing.cpu_count()
+
+        budget = dest.get('bandwidth_budget') or 0
+        if budget:
+            parallel = min(parallel, max(budget / self._min_job_bandwidth, 1))
+
+        return max(min(parallel, num_jobs), 1)
+
+    def get_job_path(self, job, root):
+        return os.path.join(root, job['source'].lstrip('/'))
+
+    def get_task(self, job, destination):
+        """The job as it runs against destination. It is named after the
+        destination, so its state and history are kept apart"""
+        task = dict(job)
+        task['job_name'] = job['name']
+        task['name'] = job['name'] + destination['suffix']
+        if destination.get('max_incrementals') is not None:
+            task['max_incrementals'] = destination['max_incrementals']
+        return task
+
+    def get_result(self, job, destination, error=None):
+        return {
+            'job': job,
+            'destination': destination['name'],
+            'stats': None,
+            'error': error,
+            'skipped': None,
+            'duration': 0,
+        }
+
+    def get_walk(self, job):
+        """The tree of a job is walked once per run, the excludes and the
+        index are shared by all destinations"""
+        with self._lock:
+            if job['job_name'] not in self._walks:
+                self._walks[job['job_name']] = {
+                    'excludes': Excludes(self._output, job['excluded'],
+                        job['source']),
+                    'lock': threading.Lock(),
+                    'walked': False,
+                    'index': None,
+                }
+            return self._walks[job['job_name']]
+
+    def walk_once(self, walk, scanner, path):
+        with walk['lock']:
+            if not walk['walked']:
+                walk['index'] = scanner.walk(path)
+                walk['walked'] = True
+            return walk['index']
+
+    def run_job(self, job, target, path, bwlimit, runs, results):
+        result = self.get_result(job, target['destination'])
+
+        state_dir = self._cfg.get('state_dir', self._d_state_dir)
+        collection = Collection(self._output, state_dir, job['name'])
+        planner = Planner(self._output, self._cfg, job, collection, runs,
+                target.get('bandwidth'))
+        walk = self.get_walk(job)
+        excludes = walk['excludes']
+        duplicity = Duplicity(self._output, self._cfg, target['ssh'],
+                collection, planner, job, excludes, bwlimit, self._throttle,
+                target['destination'])
+
+        scanner = None
+        if self._cfg.get('prescan', True) and os.path.exists(path):
+            scanner = Scanner(self._output, self._cfg, job, excludes,
+                    state_dir)
+
+        t_start = time.time()
+        try:
+            scan_index = None
+            if scanner:
+                (changes, scan_index) = scanner.compare(self.walk_once(walk,
+                    scanner, path))
+                self.debug('{0}: {1} new, {2} changed, {3} deleted files,' \
+                    ' {4} changed'.format(job['name'], changes['new_files'],
+                        changes['changed_files'], changes['deleted_files'],
+                        self.human_byte(changes['changed_size'])))
+                planner.set_changes(changes)
+
+                if not scanner.has_changes(changes) and \
+                        not collection.is_stale() and \
+                        collection.has_backups():
+                    result['skipped'] = 'nothing changed'
+                    return
+
+            result['stats'] = duplicity.backup(path)
+            if not result['stats']:
+                result['error'] = 'nothing backed up'
+            elif result['stats']['backup_type'] == 'skip':
+                result['skipped'] = result['stats']['reason']
+                result['stats'] = None
+            elif scan_index is not None:
+                scanner.save(scan_index)
+        except SystemExit:
+            # error() and critical() exit, which only ends this thread
+            result['error'] = 'backup failed'
+        except Exception, errmsg:
+            self.debug(traceback.format_exc())
+            result['error'] = str(errmsg)
+        finally:
+            result['duration'] = time.time() - t_start
+            with self._lock:
+                results.append(result)
+
+    def run_task(self, queue, task, path, runs, results):
+        try:
+            self.run_job(task, queue['target'], path, queue['bwlimit'],
+                    runs, results)
+        finally:
+            with self._done:
+                queue['running'] -= 1
+                self._done.notify()
+
+    def run(self, jobs, root='/'):
+        # the history database can only be used from this thread
+        since = time.time() - self._history_days * 86400
+        runs = {}
+        self._walks = {}
+
+        results = []
+        order = []
+        queues = []
+        for target in self._targets:
+            dest = target['destination']
+            tasks = [self.get_task(job, dest) for job in jobs]
+            order.extend([task['name'] for task in tasks])
+            if target.get('error'):
+                results.extend([self.get_result(task, dest, target['error'])
+                    for task in tasks])
+                continue
+
+            for task in tasks:
+                runs[task['name']] = self._history.query(task['name'], since,
+                        succeeded=True)
+
+            parallel = self.get_parallelism(len(tasks), dest)
+            bwlimit = 0
+            budget = dest.get('bandwidth_budget') or 0
+            if budget:
+                bwlimit = budget / parallel
+
+            self.debug('running {0} jobs on {1}, {2} at a time'.format(
+                len(tasks), dest['name'], parallel))
+            queues.append({
+                'target': target,
+                'pending': tasks,
+                'running': 0,
+                'parallel': parallel,
+                'bwlimit': bwlimit,
+            })
+
+        if self._throttle:
+            self._throttle.start()
+
+        # a job which finishes signals _done, so its slot is refilled
+        # right away
+        threads = []
+        with self._done:
+            while [q for q in queues if q['pending'] or q['running']]:
+                for queue in queues:
+                    while queue['pending'] and \
+                            queue['running'] < queue['parallel']:
+                        task = queue['pending'].pop(0)
+                        t = threading.Thread(target=self.run_task,
+                            args=(queue, task, self.get_job_path(task, root),
+                                runs[task['name']], results),
+                            name=task['name'])
+                        queue['running'] += 1
+                        t.start()
+                        threads.append(t)
+                if [q for q in queues if q['running']]:
+                    self._done.wait()
+
+        for t in threads:
+            t.join()
+
+        if self._throttle:
+            self._throttle.stop()
+
+        # report in configuration order
+        results.sort(key=lambda r: order.index(r['job']['name']))
+        return results
+
+    def report(self, results):
+        failed = [r['job']['name'] for r in results if r['error']]
+        for result in results:
+            if result['error']:
+                self.warning('{0}: {1}'.format(result['job']['name'],
+                    result['error']))
+            elif result['skipped']:
+                self.info('{0}: skipped, {1}'.format(result['job']['name'],
+                    result['skipped']))
+            else:
+                self.info('{0}: {1} {2}'.format(result['job']['name'],
+                    result['stats']['backup_type'],
+                    self.format_stats(result['stats'])))
+
+        succeeded = [r['stats'] for r in results if r['stats']]
+        total = {
+            'errors': sum([s['errors'] for s in succeeded]) + len(failed),
+            'elapsed_time': max([r['duration'] for r in results] + [0]),
+            'dest_size_change': sum([s['dest_size_change'] for s in succeeded]),
+            'changed_files': sum([s['changed_files'] for s in succeeded]),
+            'deleted_files': sum([s['deleted_files'] for s in succeeded]),
+            'new_files': sum([s['new_files'] for s in succeeded]),
+        }
+
+        output = '{0} jobs, {1}'.format(len(results), self.format_stats(total))
+        if len(failed) > 0:
+            self.critical('Backup failed for {0}'.format(', '.join(failed)),
+                    output)
+        elif total['errors'] > 0:
+            self.critical('Backup completed', output)
+        else:
+            self.normal('Backup completed', output)
+
+    def format_stats(self, stats):
+        return 'E:{0}, T:{1}, S:{2}, C:{3}, D:{4}, N:{5}'.format(
+            stats['errors'],
+            time.strftime('%H:%M:%S', time.gmtime(stats['elapsed_time'])),
+            self.human_byte(stats['dest_size_change']),
+            stats['changed_files'],
+            stats['deleted_files'],
+            stats['new_files'],
+        )
@@ -0,0 +1,107 @@
+
+import threading
+import time
+
+from rbackup import BaseClass
+
+class SnapshotMonitor(BaseClass):
+    """Watches how full the copy-on-write space of the snapshots gets while
+    the backup runs, and extends them before they overflow. An overflowing
+    snapshot is invalidated by LVM, after which it can not be read"""
+    _d_interval = 10
+    _d_extend_threshold = 70
+
+    # snapshots grow by this share of their size, or by the space they are
+    # expected to fill before the next two polls when that is more
+    _extend_by = 0.5
+
+    def __init__(self, output, config, lvm):
+        BaseClass.__init__(self, output)
+        self._cfg = config
+        self._lvm = lvm
+        self._thread = None
+        self._stop = threading.Event()
+        self._samples = {}
+        self._invalid = {}
+
+    def get_invalid(self):
+        """Snapshots which overflowed, backups read from them are
+        unusable"""
+        return [self._invalid[path] for path in sorted(self._invalid)]
+
+    def check(self):
+        interval = self._cfg.get('snapshot_monitor_interval',
+                self._d_interval)
+        threshold = self._cfg.get('snapshot_extend_threshold',
+                self._d_extend_threshold)
+
+        # thin snapshots allocate from their pool and can not overflow
+        snapshots = [s for s in self._lvm.get_created_snapshots()
+                if not s['thin']]
+        if not snapshots:
+            return
+
+        now = time.time()
+        usage = self._lvm.get_usage([s['path'] for s in snapshots])
+        for snapshot in snapshots:
+            path = snapshot['path']
+            if path not in usage or path in self._invalid:
+                continue
+
+            (size, data_percent, attr) = usage[path]
+            # the fifth lv_attr character is I for invalid snapshots
+            if len(attr) > 4 and attr[4] == 'I':
+                self.warning('snapshot {0} overflowed'.format(path))
+                self._invalid[path] = snapshot
+                continue
+
+            # fill rate in MiB per second since the previous poll
+            rate = 0
+            previous = self._samples.get(path)
+            used = size * data_percent / 100
+            if previous and now > previous[0]:
+                rate = max(used - previous[1], 0) / (now - previous[0])
+            self._samples[path] = (now, used)
+
+            expected = used + rate * interval * 2
+            if data_percent < threshold and \
+                    expected < size * threshold / 100:
+                continue
+
+            grow = max(size * self._extend_by, rate * interval * 2)
+            self.info('snapshot {0} is {1:.0f}% full, extending by' \
+                ' {2:.0f}M'.format(path, data_percent, grow))
+            self._lvm.extend_snapshot(path, grow)
+
+    def monitor(self):
+        interval = self._cfg.get('snapshot_monitor_interval',
+                self._d_interval)
+        while not self._stop.wait(interval):
+            # error() exits, and neither that nor anything else should end
+            # the monitor while the snapshots are in use
+            try:
+                self.check()
+            except SystemExit:
+                continue
+            except Exception, errmsg:
+                self.warning('snapshot monitor: {0}'.format(errmsg))
+                continue
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.monitor,
+                name='snapshot-monitor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if not self._thread:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+        # a snapshot might have overflowed since the last poll
+        self.check()
@@ -0,0 +1,107 @@
+
+import os
+import pipes
+import shutil
+import tempfile
+
+from rbackup import BaseClass
+
+class SSH(BaseClass):
+    """Owns a multiplexed ssh connection to the backup server, which is
+    shared by all remote commands and by duplicity's rsync transport"""
+    _start_timeout = 60
+    _d_timeout = 300
+
+    _family_options = {'ipv4': '-4', 'ipv6': '-6'}
+
+    def __init__(self, output, config, destination=None):
+        BaseClass.__init__(self, output)
+        self._cfg = config
+        # remote_host and ssh_config come from the destination
+        self._dest = destination or config
+        self._control_dir = None
+        self._control_path = None
+        self._family = None
+
+    def is_running(self):
+        return self._control_path is not None
+
+    def options(self):
+        options = ['-F', self._dest['ssh_config']]
+        if self._family:
+            options.append(self._family_options[self._family])
+        if self._control_path:
+            options.extend(['-o', 'ControlMaster=no', '-o',
+                'ControlPath={0}'.format(self._control_path)])
+        return options
+
+    def argv(self):
+        return ['ssh'] + self.options()
+
+    def command(self):
+        """The ssh command as a string, for rsync -e"""
+        return ' '.join([pipes.quote(arg) for arg in self.argv()])
+
+    def check(self):
+        """Returns True if the control connection is still alive"""
+        cmd = ['ssh', '-F', self._dest['ssh_config'],
+               '-o', 'ControlPath={0}'.format(self._control_path),
+               '-O', 'check', self._dest['remote_host']]
+        (returncode, output) = self.run(cmd, timeout=self._start_timeout)
+        return returncode == 0
+
+    def start(self, throttle=None, family=None):
+        """Starts the control connection. With a throttle it is started in
+        the throttled cgroup, so the ssh processes carrying the transfers
+        are limited together with duplicity and rsync. family is the
+        address family new connections use, by default ssh picks one. A
+        connection which is still alive is kept, whatever its family"""
+        self._family = family
+        if self.is_running():
+            if self.check():
+                return True
+            # the connection died, for example on a network change
+            self.stop()
+
+        self._control_dir = tempfile.mkdtemp(prefix='rbackup-ssh-')
+        control_path = os.path.join(self._control_dir, 'control')
+
+        cmd = self.argv() + [
+               '-o', 'ControlMaster=yes',
+               '-o', 'ControlPath={0}'.format(control_path),
+               '-o', 'ControlPersist=yes', '-f', '-N',
+               self._dest['remote_host']]
+        preexec = None
+        if throttle:
+            cmd = throttle.wrap(cmd)
+            preexec = throttle.preexec
+        (returncode, output) = self.run(cmd, timeout=self._start_timeout,
+                preexec=preexec)
+        if returncode != 0:
+            self.warning('failed to setup ssh control connection')
+            shutil.rmtree(self._control_dir, True)
+            self._control_dir = None
+            return False
+
+        self._control_path = control_path
+        return True
+
+    def stop(self):
+        if not self.is_running():
+            return
+
+        cmd = ['ssh', '-F', self._dest['ssh_config'],
+               '-o', 'ControlPath={0}'.format(self._control_path),
+               '-O', 'exit', self._dest['remote_host']]
+        self.run(cmd, timeout=self._start_timeout)
+
+        shutil.rmtree(self._control_dir, True)
+        self._control_dir = None
+        self._control_path = None
+
+    def run_remote(self, command, timeout=None, on_line=None, stdin=None):
+        """Runs command with the shell of the remote user"""
+        if timeout is None:
+            timeout = self._cfg.get('remote_timeout', self._d_timeout)
+        cmd = self.argv() + [self._dest['remote_host'], command]
+        return self.run(cmd, timeout=timeout, on_line=on_line, stdin=stdin)
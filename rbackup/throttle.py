@@ -0,0 +1,425 @@
+
+import multiprocessing
+import os
+import threading
+import time
+
+from rbackup import BaseClass
+
+class Throttle(BaseClass):
+    """Runs duplicity and its rsync/ssh children in a cgroup v2 group with
+    io and cpu limits, which are tightened when the system reports pressure
+    stall time and relaxed again when it is idle. systemd owns the cgroup
+    tree, so the group is either created below the cgroup of the service
+    when it has Delegate=yes, or is a transient slice managed through
+    systemd. Without either the commands are started with ionice and nice"""
+    _d_throttle = 'auto'
+    _d_io_weight = 50
+    _d_cpu_weight = 50
+    _d_pressure_high = 20.0
+    _d_pressure_low = 5.0
+    _d_interval = 5
+
+    _cgroup_root = '/sys/fs/cgroup'
+    _systemd_dir = '/run/systemd/system'
+    _d_cgroup_name = 'rbackup'
+    _supervisor_name = 'supervisor'
+    _controllers = ['io', 'cpu']
+
+    _nice_command = ['ionice', '-c', '2', '-n', '7', 'nice', '-n', '10']
+
+    # io limits never go below this many bytes per second
+    _min_io_rate = 1024 * 1024
+
+    # cpu.max period and the smallest share of a cpu the backup may get
+    _cpu_period = 100000
+    _min_cpu_share = 0.1
+
+    def __init__(self, output, config, filesystems=None,
+            proc_root='/proc', sys_root='/sys'):
+        BaseClass.__init__(self, output)
+        self._cfg = config
+        self._filesystems = filesystems
+        self._proc_root = proc_root
+        self._sys_root = sys_root
+        self._mode = None
+        self._cgroup = None
+        self._delegated = None
+        self._slice = None
+        self._devices = []
+        self._io_limit = None
+        self._cpu_quota = None
+        self._last_io = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def get_mode(self):
+        mode = self._cfg.get('throttle', self._d_throttle)
+        if mode in [False, 'no']:
+            return 'no'
+        if mode in ['auto', 'cgroup']:
+            if os.path.exists(os.path.join(self._cgroup_root,
+                    'cgroup.controllers')):
+                self._delegated = self.get_delegated_cgroup()
+                if self._delegated:
+                    return 'cgroup'
+                if os.path.isdir(self._systemd_dir):
+                    return 'systemd'
+            if mode == 'cgroup':
+                self.warning('cgroup v2 not available, using ionice')
+        return 'nice'
+
+    def setup(self):
+        self._mode = self.get_mode()
+        if self._mode == 'cgroup' and not self.setup_cgroup():
+            self._mode = 'nice'
+        if self._mode == 'systemd' and not self.setup_systemd():
+            self._mode = 'nice'
+        self.debug('throttling backups using {0}'.format(self._mode))
+        return self._mode
+
+    def write(self, fname, value):
+        try:
+            open(fname, 'w').write(value)
+        except IOError, errmsg:
+            self.debug('{0}: {1}'.format(fname, errmsg))
+            return False
+        return True
+
+    def get_own_cgroup(self):
+        """The cgroup v2 path rbackup runs in, relative to the root"""
+        try:
+            lines = open(os.path.join(self._proc_root, 'self', 'cgroup'),
+                'r').readlines()
+        except IOError:
+            return None
+        for line in lines:
+            if line.startswith('0::'):
+                return line[3:].strip()
+        return None
+
+    def get_delegated_cgroup(self):
+        """The directory of the cgroup of the service rbackup runs in, if
+        systemd delegated it using Delegate=yes"""
+        path = self.get_own_cgroup()
+        if not path:
+            return None
+        # moved there by an earlier run of a resident rbackup
+        if os.path.basename(path) == self._supervisor_name:
+            path = os.path.dirname(path)
+        unit = os.path.basename(path)
+        if not unit.endswith('.service') and not unit.endswith('.scope'):
+            return None
+
+        (returncode, output) = self.run(['systemctl', 'show', '-p',
+            'Delegate', unit])
+        if returncode != 0 or 'Delegate=yes' not in [line.strip()
+                for line in output]:
+            return None
+        return os.path.join(self._cgroup_root, path.lstrip('/'))
+
+    def make_cgroup(self, path):
+        if os.path.exists(path):
+            return True
+        try:
+            os.mkdir(path)
+        except OSError, errmsg:
+            self.warning('failed to create cgroup: {0}'.format(errmsg))
+            return False
+        return True
+
+    def setup_cgroup(self):
+        """Creates the cgroup below the delegated cgroup of the service"""
+        parent = self._delegated
+        available = open(os.path.join(parent, 'cgroup.controllers'),
+            'r').read().split()
+        controllers = [c for c in self._controllers if c in available]
+        if not controllers:
+            self.warning('no io or cpu cgroup controller available')
+            return False
+
+        # a cgroup containing processes can not enable controllers for its
+        # children, so rbackup itself moves into a leaf cgroup first
+        supervisor = os.path.join(parent, self._supervisor_name)
+        if not self.make_cgroup(supervisor) or not self.write(
+                os.path.join(supervisor, 'cgroup.procs'), str(os.getpid())):
+            return False
+        if not self.write(os.path.join(parent, 'cgroup.subtree_control'),
+                ' '.join(['+' + c for c in controllers])):
+            self.warning('failed to enable the io and cpu controllers')
+            return False
+
+        self._cgroup = os.path.join(parent,
+                self._cfg.get('cgroup_name', self._d_cgroup_name))
+        if not self.make_cgroup(self._cgroup):
+            self._cgroup = None
+            return False
+
+        self.write(os.path.join(self._cgroup, 'io.weight'),
+                'default {0}'.format(self._cfg.get('io_weight',
+                    self._d_io_weight)))
+        self.write(os.path.join(self._cgroup, 'cpu.weight'), str(
+            self._cfg.get('cpu_weight', self._d_cpu_weight)))
+
+        self._devices = self.get_devices()
+        self.set_io_limit(None)
+        self.set_cpu_quota(None)
+        return True
+
+    def set_property(self, *assignments):
+        """Changes the properties of the transient slice at runtime"""
+        (returncode, output) = self.run(['systemctl', 'set-property',
+            '--runtime', self._slice] + list(assignments))
+        if returncode != 0:
+            self.debug('{0}: {1}'.format(self._slice, ' '.join(output)))
+            return False
+        return True
+
+    def setup_systemd(self):
+        """Sets up a slice, the throttled commands are started in scopes
+        below it by systemd-run"""
+        self._slice = self._cfg.get('cgroup_name',
+                self._d_cgroup_name) + '.slice'
+        if not self.set_property('IOWeight={0}'.format(self._cfg.get(
+                'io_weight', self._d_io_weight)), 'CPUWeight={0}'.format(
+                    self._cfg.get('cpu_weight', self._d_cpu_weight))):
+            self.warning('failed to setup {0}'.format(self._slice))
+            self._slice = None
+            return False
+        self._cgroup = os.path.join(self._cgroup_root, self._slice)
+
+        self._devices = self.get_devices()
+        self.set_io_limit(None)
+        self.set_cpu_quota(None)
+        return True
+
+    def get_slaves(self, devno):
+        """Returns the physical disks below a (device mapper) device"""
+        slaves_dir = os.path.join(self._sys_root, 'dev', 'block', devno,
+                'slaves')
+        if not os.path.isdir(slaves_dir) or not os.listdir(slaves_dir):
+            return set([devno])
+
+        devices = set()
+        for name in os.listdir(slaves_dir):
+            dev_file = os.path.join(slaves_dir, name, 'dev')
+            try:
+                devices |= self.get_slaves(open(dev_file).read().strip())
+            except IOError:
+                continue
+        return devices
+
+    def get_devices(self):
+        """major:minor of the disks holding the backed up filesystems,
+        partitions are resolved to the disk they are on"""
+        if not self._filesystems:
+            return []
+
+        devices = set()
+        for mountpoint in self._filesystems.keys():
+            try:
+                st = os.stat(self._filesystems[mountpoint]['device'])
+            except OSError:
+                continue
+            devno = '{0}:{1}'.format(os.major(st.st_rdev),
+                    os.minor(st.st_rdev))
+            for slave in self.get_slaves(devno):
+                partition = os.path.join(self._sys_root, 'dev', 'block',
+                        slave, 'partition')
+                if os.path.exists(partition):
+                    parent = os.path.realpath(os.path.join(self._sys_root,
+                        'dev', 'block', slave, '..'))
+                    try:
+                        slave = open(os.path.join(parent,
+                            'dev')).read().strip()
+                    except IOError:
+                        pass
+                devices.add(slave)
+        return sorted(devices)
+
+    def set_io_limit(self, rate):
+        if self._mode == 'systemd':
+            assignments = ['IOReadBandwidthMax=', 'IOWriteBandwidthMax=']
+            if rate is not None:
+                for device in self._devices:
+                    path = os.path.join('/dev/block', device)
+                    assignments.append('IOReadBandwidthMax={0} {1}'.format(
+                        path, int(rate)))
+                    assignments.append('IOWriteBandwidthMax={0} {1}'.format(
+                        path, int(rate)))
+            self.set_property(*assignments)
+            self._io_limit = rate
+            return
+
+        if rate is None:
+            limit = 'rbps=max wbps=max'
+        else:
+            limit = 'rbps={0} wbps={0}'.format(int(rate))
+        for device in self._devices:
+            self.write(os.path.join(self._cgroup, 'io.max'),
+                    '{0} {1}'.format(device, limit))
+        self._io_limit = rate
+
+    def set_cpu_quota(self, quota):
+        if self._mode == 'systemd':
+            if quota is None:
+                self.set_property('CPUQuota=')
+            else:
+                self.set_property('CPUQuota={0}%'.format(max(1,
+                    int(quota * 100 / self._cpu_period))))
+            self._cpu_quota = quota
+            return
+
+        if quota is None:
+            value = 'max {0}'.format(self._cpu_period)
+        else:
+            value = '{0} {1}'.format(int(quota), self._cpu_period)
+        self.write(os.path.join(self._cgroup, 'cpu.max'), value)
+        self._cpu_quota = quota
+
+    def get_pressure(self, resource):
+        """The 10 second average of the share of time some tasks stalled
+        on resource, in percent"""
+        try:
+            lines = open(os.path.join(self._proc_root, 'pressure',
+                resource), 'r').readlines()
+        except IOError:
+            return None
+        for line in lines:
+            fields = line.split()
+            if fields[0] != 'some':
+                continue
+            for field in fields[1:]:
+                (key, value) = field.split('=')
+                if key == 'avg10':
+                    return float(value)
+        return None
+
+    def get_io_bytes(self):
+        """Bytes read and written by the cgroup on the throttled devices"""
+        total = 0
+        try:
+            lines = open(os.path.join(self._cgroup, 'io.stat'),
+                'r').readlines()
+        except IOError:
+            return None
+        for line in lines:
+            fields = line.split()
+            if fields[0] not in self._devices:
+                continue
+            for field in fields[1:]:
+                (key, value) = field.split('=')
+                if key in ['rbytes', 'wbytes']:
+                    total += int(value)
+        return total
+
+    def get_io_rate(self):
+        now = time.time()
+        io_bytes = self.get_io_bytes()
+        if io_bytes is None:
+            return None
+
+        rate = None
+        if self._last_io and now > self._last_io[0]:
+            rate = (io_bytes - self._last_io[1]) / (now - self._last_io[0])
+        self._last_io = (now, io_bytes)
+        return rate
+
+    def adjust(self):
+        """Halve the limits while the system is under pressure, and double
+        them while it is idle until they no longer limit anything"""
+        high = self._cfg.get('throttle_pressure_high', self._d_pressure_high)
+        low = self._cfg.get('throttle_pressure_low', self._d_pressure_low)
+        io_pressure = self.get_pressure('io')
+        cpu_pressure = self.get_pressure('cpu')
+        io_rate = self.get_io_rate()
+        max_quota = multiprocessing.cpu_count() * self._cpu_period
+
+        if io_pressure is not None and io_rate is not None and self._devices:
+            if io_pressure > high:
+                if self._io_limit is None:
+                    limit = io_rate / 2
+                else:
+                    limit = self._io_limit / 2
+                self.set_io_limit(max(limit, self._min_io_rate))
+                self.debug('io pressure {0:.1f}%, limiting io to {1}/s'.format(
+                    io_pressure, self.human_byte(self._io_limit)))
+            elif io_pressure < low and self._io_limit is not None:
+                if self._io_limit * 2 > io_rate * 4:
+                    self.set_io_limit(None)
+                    self.debug('io pressure {0:.1f}%, removing io' \
+                        ' limit'.format(io_pressure))
+                else:
+                    self.set_io_limit(self._io_limit * 2)
+
+        if cpu_pressure is not None:
+            if cpu_pressure > high:
+                if self._cpu_quota is None:
+                    quota = max_quota / 2
+                else:
+                    quota = self._cpu_quota / 2
+                self.set_cpu_quota(max(quota,
+                    self._min_cpu_share * self._cpu_period))
+                self.debug('cpu pressure {0:.1f}%, limiting cpu to' \
+                    ' {1:.0%} of a cpu'.format(cpu_pressure,
+                        float(self._cpu_quota) / self._cpu_period))
+            elif cpu_pressure < low and self._cpu_quota is not None:
+                if self._cpu_quota * 2 >= max_quota:
+                    self.set_cpu_quota(None)
+                else:
+                    self.set_cpu_quota(self._cpu_quota * 2)
+
+    def control(self):
+        interval = self._cfg.get('throttle_interval', self._d_interval)
+        while not self._stop.wait(interval):
+            try:
+                self.adjust()
+            except (IOError, OSError, ValueError), errmsg:
+                self.debug('throttle: {0}'.format(errmsg))
+
+    def start(self):
+        """Start adjusting the limits to the system pressure"""
+        if self._mode not in ['cgroup', 'systemd'] or self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.control,
+                name='throttle')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def cleanup(self):
+        """Remove the cgroup, once nothing runs in it anymore. systemd
+        removes the slice by itself once it is empty"""
+        self.stop()
+        if self._mode == 'cgroup' and self._cgroup:
+            try:
+                os.rmdir(self._cgroup)
+            except OSError, errmsg:
+                self.debug('{0}: {1}'.format(self._cgroup, errmsg))
+            self._cgroup = None
+
+    def wrap(self, argv):
+        """Returns argv as it should be started to be throttled"""
+        if self._mode == 'nice':
+            return self._nice_command + argv
+        if self._mode == 'systemd':
+            return ['systemd-run', '--scope', '--quiet', '--collect',
+                    '--slice={0}'.format(self._slice)] + argv
+        return argv
+
+    def preexec(self):
+        """Moves the calling process into the cgroup, to be called in the
+        child before it executes the throttled command"""
+        if self._mode != 'cgroup' or not self._cgroup:
+            return
+        fd = os.open(os.path.join(self._cgroup, 'cgroup.procs'), os.O_WRONLY)
+        try:
+            os.write(fd, '0')
+        finally:
+            os.close(fd)
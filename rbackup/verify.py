@@ -0,0 +1,315 @@
+
+import json
+import math
+import os
+import random
+import shutil
+import stat
+import tempfile
+import time
+
+from rbackup.restore import Restore
+from rbackup.scanner import Scanner
+
+class Verify(Restore):
+    """Checks a sample of the current backup chain on every run. Volumes
+    are fetched and compared against the hashes in their manifests, and
+    files which did not change since the last backup are compared against
+    the snapshot with duplicity verify. Both are stratified over the
+    backup sets of the chain and weighted toward the recent incrementals.
+    The verified volumes are recorded, so that every volume of the chain
+    is verified at least once every verify_cycle runs"""
+    _d_volumes = 4
+    _d_files = 16
+    _d_cycle = 30
+    _d_state_dir = '/var/lib/rbackup'
+
+    # fetched volumes are staged on tmpfs by default, staging them on a
+    # snapshotted volume would use up the space of its snapshot
+    _d_staging_dir = '/dev/shm'
+
+    _store_version = 1
+
+    def __init__(self, output, config, ssh, destination, jobs):
+        Restore.__init__(self, output, config, ssh, destination, jobs)
+        self._output = output
+        self._state_dir = config.get('state_dir', self._d_state_dir)
+
+    def setting(self, name):
+        return self._cfg.get('verify_' + name, getattr(self, '_d_' + name))
+
+    def get_store_file(self, task):
+        return os.path.join(self._state_dir, '{0}.verify'.format(
+            task['name']))
+
+    def load(self, task):
+        store = {'version': self._store_version, 'cycle_start': time.time(),
+                'runs': 0, 'volumes': {}}
+        store_file = self.get_store_file(task)
+        if not os.path.exists(store_file):
+            return store
+        try:
+            loaded = json.load(open(store_file, 'r'))
+        except ValueError, errmsg:
+            self.warning('{0}: {1}'.format(store_file, errmsg))
+            return store
+        if loaded.get('version') != self._store_version:
+            return store
+        return loaded
+
+    def save(self, task, store):
+        self.atomic_write(self.get_store_file(task), json.dumps(store))
+
+    def get_weight(self, position):
+        """Backup sets are weighted by their position in the chain, the
+        full backup has the lowest weight and the last incremental the
+        highest"""
+        return position + 1
+
+    def weighted_sample(self, items, weights, n):
+        """Picks n items without replacement, with a chance proportional
+        to their weight"""
+        keys = [(random.random() ** (1.0 / weights[i]), item)
+                for (i, item) in enumerate(items)]
+        keys.sort(reverse=True)
+        return [item for (key, item) in keys[:n]]
+
+    def pick_volumes(self, chain, store):
+        """Picks the volumes which were not verified during this cycle,
+        at least verify_volumes of them and enough to finish the cycle in
+        time, topped up with the volumes verified longest ago"""
+        volumes = []
+        weights = []
+        for (position, backup_set) in enumerate(chain):
+            for name in backup_set['volumes'].values():
+                volumes.append(name)
+                weights.append(self.get_weight(position))
+
+        verified = store['volumes']
+        pending = [i for (i, name) in enumerate(volumes)
+                if verified.get(name, {}).get('time', 0) <
+                    store['cycle_start']]
+        runs_left = max(self.setting('cycle') - store['runs'], 1)
+        n = max(self.setting('volumes'),
+                int(math.ceil(len(pending) / float(runs_left))))
+
+        picked = self.weighted_sample([volumes[i] for i in pending],
+                [weights[i] for i in pending], n)
+        if len(picked) < n:
+            rest = [name for name in volumes if name not in picked]
+            rest.sort(key=lambda name: verified.get(name, {}).get('time', 0))
+            picked.extend(rest[:n - len(picked)])
+        return picked
+
+    def get_position(self, chain, entry):
+        """Position in the chain of the backup set which holds the file
+        as it is now, judging by its last change"""
+        changed = max(entry[2], entry[3])
+        for (position, backup_set) in enumerate(chain):
+            if backup_set['time'] >= changed:
+                return position
+        return None
+
+    def pick_files(self, task, chain, path):
+        """Picks files which did not change since the last backup, spread
+        over the backup sets they were last backed up in"""
+        index = Scanner(self._output, self._cfg, task, None,
+                self._state_dir).load()
+        if not index:
+            self.debug('{0}: no scan index, not verifying files'.format(
+                task['name']))
+            return []
+
+        strata = {}
+        for (relpath, entry) in index.iteritems():
+            position = self.get_position(chain, entry)
+            if position is not None:
+                strata.setdefault(position, []).append(relpath)
+
+        # every backup set gets a share of the files by its weight, some
+        # extra candidates are drawn as files might have changed since
+        n = self.setting('files')
+        total = sum([self.get_weight(p) for p in strata])
+        files = []
+        for position in sorted(strata):
+            share = max(n * self.get_weight(position) / total, 1)
+            candidates = random.sample(strata[position],
+                    min(share * 4, len(strata[position])))
+            picked = [relpath for relpath in candidates
+                    if self.is_unchanged(path, relpath, index[relpath])]
+            files.extend(picked[:share])
+        return files
+
+    def is_unchanged(self, path, relpath, entry):
+        """Returns True for regular files which look exactly as they did
+        when they were last backed up"""
+        try:
+            st = os.lstat(os.path.join(path, relpath))
+        except OSError:
+            return False
+        return stat.S_ISREG(st.st_mode) and entry == (st.st_ino, st.st_size,
+                st.st_mtime, st.st_ctime)
+
+    def check_volumes(self, names, staging_dir, chain):
+        """Returns a process which hashes the fetched volumes, or None if
+        there are none, and a map of their names to the hash in the
+        manifest"""
+        expected = {}
+        for backup_set in chain:
+            for (number, start, end, sha1) in backup_set['ranges']:
+                name = backup_set['volumes'].get(number)
+                if name in names:
+                    expected[name] = sha1
+        if not names:
+            return (None, expected)
+        argv = ['sha1sum'] + [os.path.join(staging_dir, name)
+                for name in sorted(names)]
+        return (self.process(argv, name='sha1sum'), expected)
+
+    def check_file(self, task, relpath, chain, staging_dir, cache_dir, path):
+        argv = ['duplicity', 'verify', '--no-encryption', '--compare-data',
+                '--time', str(int(chain[-1]['time'])), '--archive-dir',
+                cache_dir, '--file-to-restore', relpath,
+                'file://' + staging_dir, os.path.join(path, relpath)]
+        return self.process(argv, name='duplicity')
+
+    def show_progress(self, force=False):
+        progress = self._progress
+        now = time.time()
+        if not force and now - progress['last'] < self._progress_interval:
+            return
+        progress['last'] = now
+        self.progress('Verify progress', 'fetched {0} of {1}'.format(
+            self.human_byte(progress['done']),
+            self.human_byte(progress['total'])))
+
+    def verify_job(self, job, root, staging_dir):
+        """Verifies a sample of the chain of job, returns a dict with the
+        number of checked and failed volumes and files"""
+        task = dict(job)
+        task['name'] = job['name'] + self._dest['suffix']
+        path = os.path.join(root, job['source'].lstrip('/'))
+        result = {'job': task['name'], 'volumes': 0, 'files': 0,
+                'failed_volumes': [], 'failed_files': [], 'coverage': 0}
+
+        with self.span('verify_probe'):
+            (backup_sets, sizes) = self.probe(self.get_remote_path(job))
+        chain = self.get_chain(backup_sets, time.time())
+        if not chain:
+            self.warning('{0}: no backups to verify'.format(task['name']))
+            return result
+
+        store = self.load(task)
+        volumes = self.pick_volumes(chain, store)
+        files = self.pick_files(task, chain, path)
+
+        # the volumes holding the files are verified as well, as they are
+        # fetched anyway
+        manifests = [s['manifest'] for s in chain]
+        volumes = set(volumes)
+        file_volumes = {}
+        for relpath in files:
+            file_volumes[relpath] = [n for n in self.get_volumes(chain,
+                [tuple(relpath.split('/'))]) if n not in manifests]
+            volumes.update(file_volumes[relpath])
+        names = manifests + sorted(volumes)
+        self.debug('{0}: verifying {1} volumes and {2} files'.format(
+            task['name'], len(volumes), len(files)))
+
+        job_dir = os.path.join(staging_dir, task['name'])
+        os.mkdir(job_dir)
+        parallel = self._cfg.get('verify_parallel', self._d_parallel)
+        self._progress['total'] += sum([sizes.get(n, 0) for n in names])
+        with self.span('verify_fetch'):
+            fetches = self.run_many(self.fetch(job, list(names), sizes,
+                job_dir, parallel), parallel)
+        if [p for p in fetches if p.returncode != 0]:
+            self.warning('{0}: failed to fetch volumes'.format(task['name']))
+            result['failed_volumes'] = [n for n in volumes
+                    if not os.path.exists(os.path.join(job_dir, n))]
+
+        fetched = [n for n in volumes if n not in result['failed_volumes']]
+        (hasher, expected) = self.check_volumes(fetched, job_dir, chain)
+
+        # files can not be compared when any of their volumes is missing
+        if [n for n in manifests
+                if not os.path.exists(os.path.join(job_dir, n))]:
+            files = []
+        files = [f for f in files if not [n for n in file_volumes[f]
+            if n in result['failed_volumes']]]
+        checks = []
+        for (i, relpath) in enumerate(files):
+            checks.append(self.check_file(task, relpath, chain, job_dir,
+                os.path.join(staging_dir, '{0}-cache-{1}'.format(
+                    task['name'], i)), path))
+        with self.span('verify_check'):
+            self.run_many([p for p in [hasher] if p] + checks, parallel)
+
+        hashes = {}
+        for line in hasher and hasher.output or []:
+            fields = line.split()
+            if len(fields) == 2:
+                hashes[os.path.basename(fields[1])] = fields[0]
+
+        now = time.time()
+        for name in fetched:
+            result['volumes'] += 1
+            if not expected.get(name) or hashes.get(name) != expected[name]:
+                self.warning('{0}: {1} does not match its manifest'.format(
+                    task['name'], name))
+                result['failed_volumes'].append(name)
+                continue
+            store['volumes'][name] = {'time': now}
+
+        for (relpath, check) in zip(files, checks):
+            result['files'] += 1
+            if check.returncode != 0:
+                self.warning('{0}: {1} differs from the backup: {2}'.format(
+                    task['name'], relpath, ', '.join(check.output[-3:])))
+                result['failed_files'].append(relpath)
+        shutil.rmtree(job_dir, True)
+
+        # forget volumes of chains which are gone, and start a new cycle
+        # once every volume of the chain has been verified in this one
+        current = set([n for s in chain for n in s['volumes'].values()])
+        for name in store['volumes'].keys():
+            if name not in current:
+                del store['volumes'][name]
+        covered = [n for n in current if store['volumes'].get(n,
+            {}).get('time', 0) >= store['cycle_start']]
+        result['coverage'] = float(len(covered)) / max(len(current), 1)
+        store['runs'] += 1
+        if len(covered) == len(current):
+            store['cycle_start'] = now
+            store['runs'] = 0
+        self.save(task, store)
+        return result
+
+    def verify(self, root='/'):
+        """Verifies a sample of every job, returns 1 if anything failed"""
+        staging_dir = tempfile.mkdtemp(prefix='rbackup-verify-',
+                dir=self.setting('staging_dir'))
+        self._progress = {'start': time.time(), 'last': 0, 'done': 0,
+                'total': 0}
+        results = []
+        try:
+            for job in self._jobs:
+                results.append(self.verify_job(job, root, staging_dir))
+        finally:
+            shutil.rmtree(staging_dir, True)
+
+        failed = []
+        for result in results:
+            self.info('{0}: {1} volumes and {2} files verified, {3:.0%} of' \
+                ' the chain in this cycle'.format(result['job'],
+                    result['volumes'], result['files'], result['coverage']))
+            if result['failed_volumes'] or result['failed_files']:
+                failed.append(result['job'])
+
+        if failed:
+            self.critical('Verification failed', 'for {0}'.format(
+                ', '.join(failed)))
+            return 1
+        self.normal('Verification completed', '{0} volumes, {1} files'.format(
+            sum([r['volumes'] for r in results]),
+            sum([r['files'] for r in results])))
@@ -0,0 +1,41 @@
+"""Stand-ins for the output and configuration objects rbackup classes are
+constructed with"""
+
+from rbackup.metrics import NullSpan
+
+class Output:
+    """Records notifications, error() and critical() raise like the real
+    ones exit"""
+    def __init__(self):
+        self.messages = []
+
+    def info(self, msg):
+        pass
+
+    def debug(self, msg):
+        pass
+
+    def warning(self, msg):
+        self.messages.append(('warning', msg))
+
+    def error(self, msg):
+        raise RuntimeError(msg)
+
+    def progress(self, title, msg=''):
+        self.messages.append(('progress', msg))
+
+    def low(self, title, msg=''):
+        pass
+
+    def normal(self, title, msg=''):
+        pass
+
+    def critical(self, title, msg=''):
+        raise RuntimeError('{0}: {1}'.format(title, msg))
+
+    def span(self, name, kind='phase'):
+        return NullSpan()
+
+class Config(dict):
+    def get(self, cfgitem, default=None):
+        return dict.get(self, cfgitem, default)
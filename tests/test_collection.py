@@ -0,0 +1,84 @@
+import calendar
+import shutil
+import tempfile
+import time
+import unittest
+
+from rbackup.collection import Collection
+from tests.fakes import Output
+
+FULL = 'duplicity-full.20200101T000000Z'
+INC1 = 'duplicity-inc.20200101T000000Z.to.20200102T000000Z'
+INC2 = 'duplicity-inc.20200102T000000Z.to.20200103T000000Z'
+
+def timestamp(value):
+    return calendar.timegm(time.strptime(value, '%Y%m%dT%H%M%SZ'))
+
+class ReconcileTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp(prefix='rbackup-test-')
+        self.collection = Collection(Output(), self.state_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def test_reconcile(self):
+        self.collection.reconcile([
+            (FULL + '.vol1.difftar.gpg', 1000),
+            (FULL + '.vol2.difftar.gpg', 500),
+            (FULL + '.manifest.gpg', 10),
+            ('duplicity-full-signatures.20200101T000000Z.sigtar.gpg', 100),
+            (INC1 + '.vol1.difftar.gpg', 200),
+            (INC1 + '.manifest.gpg', 10),
+            ('duplicity-new-signatures.20200101T000000Z.to.' \
+                '20200102T000000Z.sigtar.gpg', 20),
+            ('unrelated.txt', 5),
+        ])
+
+        self.assertFalse(self.collection.is_stale())
+        self.assertEqual(self.collection.get_chains(), [{
+            'full': {'time': timestamp('20200101T000000Z'),
+                'end_time': None, 'volumes': 2, 'size': 1610},
+            'incrementals': [{'time': timestamp('20200102T000000Z'),
+                'end_time': None, 'volumes': 1, 'size': 230}],
+        }])
+
+    def test_incomplete_sets_are_skipped(self):
+        # the second incremental has no manifest yet
+        self.collection.reconcile([
+            (FULL + '.vol1.difftar.gpg', 1000),
+            (FULL + '.manifest.gpg', 10),
+            (INC1 + '.vol1.difftar.gpg', 200),
+            (INC1 + '.manifest.gpg', 10),
+            (INC2 + '.vol1.difftar.gpg', 200),
+        ])
+        self.assertEqual(self.collection.get_number_of_incrementals(), 1)
+
+    def test_incrementals_without_full_are_dropped(self):
+        self.collection.reconcile([
+            (INC1 + '.vol1.difftar.gpg', 200),
+            (INC1 + '.manifest.gpg', 10),
+        ])
+        self.assertFalse(self.collection.has_backups())
+
+    def test_new_full_starts_a_chain(self):
+        full2 = 'duplicity-full.20200104T000000Z'
+        self.collection.reconcile([
+            (FULL + '.manifest.gpg', 10),
+            (INC1 + '.manifest.gpg', 10),
+            (full2 + '.vol1.difftar.gpg', 1000),
+            (full2 + '.manifest.gpg', 10),
+        ])
+        chains = self.collection.get_chains()
+        self.assertEqual(len(chains), 2)
+        self.assertEqual(len(chains[0]['incrementals']), 1)
+        self.assertEqual(chains[1]['full']['size'], 1010)
+        self.assertEqual(self.collection.get_number_of_incrementals(), 0)
+
+    def test_index_is_saved(self):
+        self.collection.reconcile([(FULL + '.manifest.gpg', 10)])
+        loaded = Collection(Output(), self.state_dir)
+        self.assertEqual(loaded.get_chains(), self.collection.get_chains())
+
+if __name__ == '__main__':
+    unittest.main()
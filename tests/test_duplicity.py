@@ -0,0 +1,96 @@
+import time
+import unittest
+
+from rbackup.duplicity import Duplicity
+from tests.fakes import Config, Output
+
+class ParseDuplicityLineTest(unittest.TestCase):
+    def setUp(self):
+        self.output = Output()
+        job = {'name': 'slash', 'destination': ''}
+        destination = {'remote_host': 'backup', 'remote_path': '/backup'}
+        self.duplicity = Duplicity(self.output, Config(), None, None, None,
+                job, None, destination=destination)
+        self.state = {
+            'stats': {},
+            'error': None,
+            'files': 0,
+            'uploads': 0,
+            'last_progress': 0,
+        }
+
+    def parse(self, *lines):
+        for line in lines:
+            self.duplicity._parse_duplicity_line(line, self.state)
+
+    def test_statistics(self):
+        self.parse('StartTime 1600000000.12 (Sun Sep 13 12:26:40 2020)',
+                'ElapsedTime 3.50 (3.50 seconds)',
+                'SourceFiles 12',
+                'TotalDestinationSizeChange 4096 (4.00 KB)')
+        self.assertEqual(self.state['stats'], {
+            'start_time': 1600000000.12,
+            'elapsed_time': 3.5,
+            'source_files': 12,
+            'dest_size_change': 4096,
+        })
+
+    def test_statistics_keep_first_value(self):
+        self.parse('Errors 0', 'Errors 5')
+        self.assertEqual(self.state['stats']['errors'], 0)
+
+    def test_invalid_statistics_are_ignored(self):
+        self.parse('SourceFiles many', 'NewFiles')
+        self.assertEqual(self.state['stats'], {})
+
+    def test_log_fd_file_and_upload_codes(self):
+        self.parse('. INFO 4 A etc/passwd', '. INFO 5 M etc/group',
+                '. INFO 6 D etc/shadow', '. NOTICE 13 vol1',
+                '. NOTICE 14 vol2', '. INFO 99 other', '. INFO x')
+        self.assertEqual(self.state['files'], 3)
+        self.assertEqual(self.state['uploads'], 2)
+
+    def test_progress(self):
+        self.parse('. NOTICE 16 1048576 2.5 10.0 3661.7 524288.0 False')
+        self.assertEqual(len(self.output.messages), 1)
+        msg = self.output.messages[0][1]
+        self.assertTrue(msg.startswith('10%, '))
+        self.assertTrue(msg.endswith('ETA 01:01:01'))
+        self.assertTrue(self.state['last_progress'] > 0)
+
+    def test_progress_is_rate_limited(self):
+        self.state['last_progress'] = time.time()
+        self.parse('. NOTICE 16 1048576 2.5 10.0 3661 524288 False')
+        self.assertEqual(self.output.messages, [])
+
+    def test_stalled_progress(self):
+        self.parse('. NOTICE 16 1048576 2.5 10.0 3661 524288 True')
+        self.assertTrue(self.output.messages[0][1].endswith('ETA stalled'))
+
+    def test_invalid_progress_is_ignored(self):
+        self.parse('. NOTICE 16 1048576 2.5 ten 3661 524288 False',
+                '. NOTICE 16 1048576 2.5')
+        self.assertEqual(self.output.messages, [])
+
+    def test_last_full_backup_date(self):
+        self.parse('Last full backup date: Sun Sep 13 12:26:40 2020')
+        self.assertEqual(self.state['stats']['last_full'], time.mktime(
+            time.strptime('Sun Sep 13 12:26:40 2020',
+                '%a %b %d %H:%M:%S %Y')))
+
+    def test_no_last_full_backup(self):
+        self.parse('Last full backup date: none')
+        self.assertEqual(self.state['stats'], {'last_full': None})
+
+    def test_error(self):
+        self.parse('duplicity: error: unrecognized arguments: --bogus')
+        self.assertEqual(self.state['error'],
+                'unrecognized arguments: --bogus')
+
+    def test_empty_lines(self):
+        self.parse('', '. ', '   ')
+        self.assertEqual(self.state['stats'], {})
+        self.assertEqual(self.state['files'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
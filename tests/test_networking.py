@@ -0,0 +1,61 @@
+import socket
+import unittest
+
+from rbackup.networking import Networking
+from tests.fakes import Config, Output
+
+def packed(address):
+    if ':' in address:
+        return (socket.AF_INET6, socket.inet_pton(socket.AF_INET6, address))
+    return (socket.AF_INET, socket.inet_pton(socket.AF_INET, address))
+
+class NetworksTest(unittest.TestCase):
+    def setUp(self):
+        self.output = Output()
+        self.networking = Networking(self.output, Config())
+
+    def matches(self, networks, address):
+        compiled = self.networking.compile_networks(networks)
+        (family, address) = packed(address)
+        return self.networking.in_networks(compiled, family, address)
+
+    def test_compile_merges_overlapping_and_adjacent_ranges(self):
+        compiled = self.networking.compile_networks(['10.0.1.0/24',
+            '10.0.0.0/24', '10.0.0.128/25', '10.0.3.0/24'])
+        self.assertEqual(compiled[socket.AF_INET], (
+            [0x0a000000, 0x0a000300], [0x0a0001ff, 0x0a0003ff]))
+        self.assertEqual(compiled[socket.AF_INET6], ([], []))
+
+    def test_compile_address_without_prefix(self):
+        compiled = self.networking.compile_networks(['192.168.1.1'])
+        self.assertEqual(compiled[socket.AF_INET],
+                ([0xc0a80101], [0xc0a80101]))
+
+    def test_compile_invalid_network(self):
+        compiled = self.networking.compile_networks(['10.0.0.300/8',
+            '2001:db8::/32'])
+        self.assertEqual(compiled[socket.AF_INET], ([], []))
+        self.assertEqual(len(compiled[socket.AF_INET6][0]), 1)
+        self.assertEqual(self.output.messages,
+                [('warning', 'invalid network 10.0.0.300/8')])
+
+    def test_in_networks(self):
+        networks = ['192.168.0.0/16', '10.0.0.0/24']
+        self.assertTrue(self.matches(networks, '192.168.0.0'))
+        self.assertTrue(self.matches(networks, '192.168.255.255'))
+        self.assertTrue(self.matches(networks, '10.0.0.42'))
+        self.assertFalse(self.matches(networks, '10.0.1.0'))
+        self.assertFalse(self.matches(networks, '192.169.0.0'))
+        self.assertFalse(self.matches(networks, '9.255.255.255'))
+
+    def test_in_networks_ipv6(self):
+        networks = ['2001:db8::/32', '192.168.0.0/16']
+        self.assertTrue(self.matches(networks, '2001:db8:ffff::1'))
+        self.assertFalse(self.matches(networks, '2001:db9::1'))
+        self.assertFalse(self.matches(networks, '::ffff:192.168.0.1'))
+
+    def test_in_no_networks(self):
+        self.assertFalse(self.matches([], '10.0.0.1'))
+
+if __name__ == '__main__':
+    unittest.main()
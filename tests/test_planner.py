@@ -0,0 +1,103 @@
+import unittest
+
+from rbackup.planner import Planner
+from tests.fakes import Config, Output
+
+class FakeCollection:
+    def __init__(self, chains):
+        self._chains = chains
+
+    def has_backups(self):
+        return len(self._chains) > 0
+
+    def get_chains(self):
+        return self._chains
+
+def chain(full_size, *incremental_sizes):
+    return {'full': {'size': full_size},
+            'incrementals': [{'size': size} for size in incremental_sizes]}
+
+def run(backup_type, size, elapsed=100, source_size=0):
+    return {'backup_type': backup_type, 'dest_size_change': size,
+            'elapsed_time': elapsed, 'source_file_s': source_size}
+
+class PlannerTest(unittest.TestCase):
+    def planner(self, chains, runs=None, bandwidth=None, max_incrementals=0,
+            **config):
+        job = {'name': 'slash', 'max_incrementals': max_incrementals}
+        return Planner(Output(), Config(config), job,
+                FakeCollection(chains), runs or [], bandwidth)
+
+    def test_no_backups(self):
+        self.assertEqual(self.planner([]).plan_by_cost()[0], 'full')
+
+    def test_max_incrementals(self):
+        planner = self.planner([chain(1000, 1, 1, 1)], max_incrementals=3)
+        self.assertEqual(planner.plan_by_cost(),
+                ('full', '3 incrementals, limit is 3'))
+        planner = self.planner([chain(1000, 1, 1)], max_incrementals=3)
+        self.assertEqual(planner.plan_by_cost()[0], 'incr')
+
+    def test_cheap_chain(self):
+        planner = self.planner([chain(1000, 100, 100)])
+        self.assertEqual(planner.plan_by_cost()[0], 'incr')
+
+    def test_chain_exceeds_full_size(self):
+        planner = self.planner([chain(1000, 400, 400)],
+                runs=[run('incr', 300)])
+        self.assertEqual(planner.plan_by_cost()[0], 'full')
+        planner = self.planner([chain(1000, 400, 400)],
+                runs=[run('incr', 300)], full_backup_threshold=1.5)
+        self.assertEqual(planner.plan_by_cost()[0], 'incr')
+
+    def test_changes_from_prescan(self):
+        planner = self.planner([chain(1000, 100)], runs=[run('incr', 100)])
+        planner.set_changes({'indexed': True, 'changed_size': 2000})
+        self.assertEqual(planner.plan_by_cost()[0], 'full')
+
+    def test_max_restore_time(self):
+        # 10 bytes per second, restoring 1000 + 300 bytes takes 130s
+        runs = [run('incr', 100, elapsed=10)]
+        planner = self.planner([chain(1000, 100, 100)], runs=runs,
+                max_restore_time=120)
+        self.assertEqual(planner.plan_by_cost()[0], 'full')
+        planner = self.planner([chain(1000, 100, 100)], runs=runs,
+                max_restore_time=140)
+        self.assertEqual(planner.plan_by_cost()[0], 'incr')
+
+    def test_gate_without_limit(self):
+        planner = self.planner([chain(1000)], bandwidth=1)
+        self.assertEqual(planner.gate_by_bandwidth('full', 'reason'),
+                ('full', 'reason'))
+
+    def test_gate_full_fits(self):
+        planner = self.planner([chain(1000)], bandwidth=10,
+                max_transfer_time=100)
+        self.assertEqual(planner.gate_by_bandwidth('full', 'reason'),
+                ('full', 'reason'))
+
+    def test_gate_postpones_full(self):
+        planner = self.planner([chain(1000, 100)], bandwidth=10,
+                max_transfer_time=50)
+        (backup_type, reason) = planner.gate_by_bandwidth('full', 'reason')
+        self.assertEqual(backup_type, 'incr')
+        self.assertTrue(reason.startswith('postponing full backup'))
+
+    def test_gate_skips_incremental(self):
+        planner = self.planner([chain(1000, 600)], bandwidth=10,
+                max_transfer_time=50)
+        self.assertEqual(planner.gate_by_bandwidth('incr', 'reason')[0],
+                'skip')
+
+    def test_gate_skips_first_full(self):
+        planner = self.planner([], runs=[run('full', 0, source_size=1000)],
+                bandwidth=10, max_transfer_time=50)
+        self.assertEqual(planner.gate_by_bandwidth('full', 'reason')[0],
+                'skip')
+        planner = self.planner([], runs=[run('full', 0, source_size=1000)],
+                bandwidth=10, max_transfer_time=100)
+        self.assertEqual(planner.gate_by_bandwidth('full', 'reason')[0],
+                'full')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+
+from rbackup.restore import Restore
+from tests.fakes import Config, Output
+
+MANIFEST = [
+    'Hostname host',
+    'Localdir /',
+    'Volume 1:',
+    '    StartingPath   .',
+    '    EndingPath     "etc/foo bar" 3',
+    '    Hash SHA1 0123abcd',
+    'Volume 2:',
+    '    StartingPath   "etc/foo bar" 3',
+    '    EndingPath     usr/lib',
+    '    Hash SHA1 4567ef01',
+    'Volume 3:',
+    '    StartingPath   var',
+]
+
+class FakeSSH:
+    def __init__(self, output):
+        self.output = output
+
+    def run_remote(self, command, timeout=None, on_line=None, stdin=None):
+        return (0, self.output)
+
+def ls_line(name, size):
+    return '-rw------- 1 1000 1000 {0} Jan  1 00:00 {1}'.format(size, name)
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.restore = Restore(Output(), Config(), None,
+                {'remote_host': 'backup', 'remote_path': '/backup'}, [])
+
+    def test_parse_manifest(self):
+        self.assertEqual(self.restore.parse_manifest(MANIFEST), [
+            (1, (), ('etc', 'foo bar'), '0123abcd'),
+            (2, ('etc', 'foo bar'), ('usr', 'lib'), '4567ef01'),
+        ])
+
+    def test_parse_manifest_path(self):
+        parse = self.restore.parse_manifest_path
+        self.assertEqual(parse('.'), ())
+        self.assertEqual(parse('etc/passwd 12'), ('etc', 'passwd'))
+        self.assertEqual(parse('"a\\"b/c\\x41"'), ('a"b', 'cA'))
+
+    def test_probe(self):
+        full = 'duplicity-full.20200101T000000Z'
+        inc = 'duplicity-inc.20200101T000000Z.to.20200102T000000Z'
+        self.restore._ssh = FakeSSH(['listing', 'total 4',
+            ls_line(full + '.manifest', 100),
+            ls_line(full + '.vol1.difftar.gpg', 1000),
+            ls_line(full + '.vol2.difftar.gpg', 2000),
+            ls_line(inc + '.vol1.difftar.gpg', 300),
+            ls_line('duplicity-full-signatures.20200101T000000Z.sigtar.gpg',
+                50),
+            'manifest ' + full + '.manifest'] + MANIFEST)
+
+        (backup_sets, sizes) = self.restore.probe('/backup')
+        self.assertEqual(sizes[full + '.vol2.difftar.gpg'], 2000)
+        # the incremental has no manifest, so it is incomplete
+        self.assertEqual(len(backup_sets), 1)
+        self.assertEqual(backup_sets[0]['type'], 'full')
+        self.assertEqual(backup_sets[0]['volumes'], {
+            1: full + '.vol1.difftar.gpg',
+            2: full + '.vol2.difftar.gpg',
+        })
+        self.assertEqual(len(backup_sets[0]['ranges']), 2)
+
+    def test_get_chain(self):
+        sets = [
+            {'type': 'full', 'start': 'a', 'end': None, 'time': 1},
+            {'type': 'inc', 'start': 'a', 'end': 'b', 'time': 2},
+            {'type': 'inc', 'start': 'b', 'end': 'c', 'time': 3},
+            {'type': 'full', 'start': 'd', 'end': None, 'time': 4},
+            {'type': 'inc', 'start': 'x', 'end': 'e', 'time': 5},
+        ]
+        self.assertEqual(self.restore.get_chain(sets, 0), [])
+        self.assertEqual(self.restore.get_chain(sets, 2), sets[0:2])
+        self.assertEqual(self.restore.get_chain(sets, 3), sets[0:3])
+        # an incremental which does not continue the chain is left out
+        self.assertEqual(self.restore.get_chain(sets, 5), sets[3:4])
+
+    def test_get_volumes(self):
+        chain = [{
+            'manifest': 'full.manifest',
+            'volumes': {1: 'full.vol1', 2: 'full.vol2'},
+            'ranges': self.restore.parse_manifest(MANIFEST),
+        }]
+        get_volumes = self.restore.get_volumes
+        self.assertEqual(get_volumes(chain, [('etc', 'fonts')]),
+                ['full.manifest', 'full.vol1'])
+        self.assertEqual(get_volumes(chain, [('etc', 'passwd'), ('usr',)]),
+                ['full.manifest', 'full.vol2'])
+        # a file split over two volumes needs both
+        self.assertEqual(get_volumes(chain, [('etc', 'foo bar')]),
+                ['full.manifest', 'full.vol1', 'full.vol2'])
+        # a directory spans every volume holding a part of it
+        self.assertEqual(get_volumes(chain, [()]),
+                ['full.manifest', 'full.vol1', 'full.vol2'])
+        self.assertEqual(get_volumes(chain, [('var', 'log')]),
+                ['full.manifest'])
+
+    def test_get_volumes_missing_volume(self):
+        chain = [{
+            'manifest': 'full.manifest',
+            'volumes': {1: 'full.vol1'},
+            'ranges': self.restore.parse_manifest(MANIFEST),
+        }]
+        self.assertRaises(RuntimeError, self.restore.get_volumes, chain,
+                [('usr', 'bin')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import time
+import unittest
+
+from rbackup.verify import Verify
+from tests.fakes import Config, Output
+
+def backup_set(*names):
+    return {'volumes': dict([(i + 1, name) for (i, name) in
+        enumerate(names)])}
+
+class PickVolumesTest(unittest.TestCase):
+    def setUp(self):
+        self.verify = Verify(Output(), Config(verify_volumes=2,
+            verify_cycle=10), None, {}, [])
+        self.chain = [backup_set('full1', 'full2', 'full3'),
+                backup_set('inc1'), backup_set('inc2', 'inc3')]
+        self.names = ['full1', 'full2', 'full3', 'inc1', 'inc2', 'inc3']
+        self.now = time.time()
+
+    def store(self, runs=0, verified=None):
+        volumes = {}
+        for (name, age) in (verified or {}).items():
+            volumes[name] = {'time': self.now - age}
+        return {'cycle_start': self.now - 100, 'runs': runs,
+                'volumes': volumes}
+
+    def test_picks_verify_volumes(self):
+        picked = self.verify.pick_volumes(self.chain, self.store())
+        self.assertEqual(len(picked), 2)
+        self.assertEqual(len(set(picked)), 2)
+        self.assertTrue(set(picked) <= set(self.names))
+
+    def test_picks_only_pending_volumes(self):
+        store = self.store(verified={'full1': 10, 'full2': 10, 'full3': 10,
+            'inc1': 10})
+        picked = self.verify.pick_volumes(self.chain, store)
+        self.assertEqual(sorted(picked), ['inc2', 'inc3'])
+
+    def test_finishes_cycle_in_time(self):
+        # one run left in the cycle, so every pending volume is picked
+        store = self.store(runs=9, verified={'full1': 10})
+        picked = self.verify.pick_volumes(self.chain, store)
+        self.assertEqual(sorted(picked), sorted(self.names[1:]))
+
+    def test_tops_up_with_oldest_verified(self):
+        # everything was verified during this cycle
+        store = self.store(verified={'full1': 50, 'full2': 10, 'full3': 90,
+            'inc1': 20, 'inc2': 30, 'inc3': 40})
+        picked = self.verify.pick_volumes(self.chain, store)
+        self.assertEqual(picked, ['full3', 'full1'])
+
+    def test_tops_up_pending_volumes(self):
+        store = self.store(verified={'full1': 50, 'full2': 10, 'full3': 90,
+            'inc1': 20, 'inc2': 30})
+        picked = self.verify.pick_volumes(self.chain, store)
+        self.assertEqual(picked, ['inc3', 'full3'])
+
+    def test_weighted_sample(self):
+        picked = self.verify.weighted_sample(self.names, [1] * 6, 4)
+        self.assertEqual(len(set(picked)), 4)
+        picked = self.verify.weighted_sample(self.names, [1] * 6, 10)
+        self.assertEqual(sorted(picked), sorted(self.names))
+
+if __name__ == '__main__':
+    unittest.main()